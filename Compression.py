@@ -0,0 +1,77 @@
+import threading
+import zlib
+
+
+class CompressionStats:
+    """Tracks how well the pieces of one torrent compress on the wire.
+
+    Compression stays on while the recent ratio (compressed / raw bytes, a
+    moving average that gives each new piece a weight of smoothing) is below
+    min_ratio. Once enough pieces have been sampled and the ratio is poor,
+    compression is switched off for the torrent, except for one probe piece
+    every probe_interval pieces so that a change in content is noticed. As
+    the average forgets old pieces, a compressible probe can switch it back
+    on however long the incompressible stretch before it was.
+    """
+
+    def __init__(
+        self,
+        min_ratio=0.9,
+        sample_pieces=4,
+        probe_interval=32,
+        level=1,
+        smoothing=0.25,
+    ):
+        self.min_ratio = min_ratio
+        self.sample_pieces = sample_pieces
+        self.probe_interval = probe_interval
+        self.level = level
+        self.smoothing = smoothing
+
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.recent_ratio = None
+        self.sampled_pieces = 0
+        self.skipped_pieces = 0
+        self.enabled = True
+        self.lock = threading.Lock()
+
+    @property
+    def ratio(self):
+        with self.lock:
+            if self.raw_bytes == 0:
+                return 1.0
+            return self.compressed_bytes / self.raw_bytes
+
+    def should_compress(self):
+        """Returns True if the next piece should be compressed."""
+        with self.lock:
+            if self.enabled:
+                return True
+            self.skipped_pieces += 1
+            return self.skipped_pieces % self.probe_interval == 0
+
+    def record(self, raw_size: int, compressed_size: int):
+        """Record the outcome of compressing one piece."""
+        with self.lock:
+            self.raw_bytes += raw_size
+            self.compressed_bytes += compressed_size
+            self.sampled_pieces += 1
+            if raw_size == 0:
+                return
+            piece_ratio = compressed_size / raw_size
+            if self.recent_ratio is None:
+                self.recent_ratio = piece_ratio
+            else:
+                self.recent_ratio += self.smoothing * (piece_ratio - self.recent_ratio)
+            if self.sampled_pieces < self.sample_pieces:
+                return
+            self.enabled = self.recent_ratio < self.min_ratio
+
+    def compress(self, piece_data: bytes):
+        """Compress a piece and record the result; returns None if it did not shrink."""
+        compressed = zlib.compress(piece_data, self.level)
+        self.record(len(piece_data), len(compressed))
+        if len(compressed) >= len(piece_data):
+            return None
+        return compressed
@@ -1,16 +1,45 @@
-import queue
-import socket
+import asyncio
+import math
 import threading
-from threading import Thread
+import time
+from collections import deque
+from typing import NamedTuple
+
+import bencodepy
+import requests
 
 from Torrent import Torrent
 from FileManager import FileManager
 from PieceManager import PieceManager
-from PeerCommunicator import PeerCommunicator
+from PieceScheduler import PieceScheduler, SKIP, NORMAL
+from ResourceManager import ResourceManager
+from ResumeState import ResumeState
+from PeerBans import PeerBans
+from PeerCommunicator import RequestRejected, SUPPORTED_EXTENSIONS
+from PeerEngine import PeerEngine
+from PeerPool import PeerPool, PeerSession
+from PeerStats import PeerStats, PeerStatus
+from StreamReader import StreamReader
+from RateLimiter import RateLimiter
+from TorrentWorker import TorrentWorker
 from TrackerCommunicator import TrackerCommunicator
 from UploadManager import UploadManager
 
 
+class DownloadStatus(NamedTuple):
+    """State of one download, see DownloadManager.snapshot."""
+
+    infohash: str
+    name: str
+    downloaded: int
+    total: int
+    num_peers: int
+    num_connected_peers: int
+    queued: bool
+    # PeerStatus of every peer that downloaded for the torrent, best first
+    peers: tuple[PeerStatus, ...]
+
+
 class DownloadManager:
     def __init__(
         self,
@@ -19,14 +48,72 @@ class DownloadManager:
         dest_dir: str,
         uploadManager: UploadManager,
         trackerCommunicator: TrackerCommunicator,
+        peerEngine: PeerEngine,
+        extensions=SUPPORTED_EXTENSIONS,
+        rateLimiter: RateLimiter | None = None,
+        resourceManager: ResourceManager | None = None,
+        worker_processes=False,
     ):
+        """With worker_processes, each download runs in a TorrentWorker process.
+
+        This manager then only queues the downloads, hands the torrents'
+        incoming connections to their workers and seeds what they finish.
+        Their files cannot be streamed while they download.
+        """
         self.torrent_dir = torrent_dir
         self.dest_dir = dest_dir
         self.id = id
         self.uploadManager = uploadManager
         self.trackerCommunicator = trackerCommunicator
+        self.peerEngine = peerEngine
+        self.rateLimiter = rateLimiter or RateLimiter()
+        self.resourceManager = resourceManager or ResourceManager()
+        self.worker_processes = worker_processes
+        # Peers that sent bad pieces, banned from every torrent
+        self.peerBans = PeerBans()
+        self.peerPool = PeerPool(
+            id,
+            self.rateLimiter,
+            extensions=extensions,
+            listen_port=uploadManager.port,
+            resourceManager=self.resourceManager,
+            peerBans=self.peerBans,
+        )
         self.MAXIMUM_CONNECT_RETRY = 5
+        self.CONNECT_BACKOFF = 0.5
         self.MAXIMUM_DOWNLOAD_RETRY = 3
+        self.MAXIMUM_PIECE_FAILURES = 8
+        # Requests queued at one peer, see _pipeline_depth
+        self.MAXIMUM_PIPELINE_DEPTH = 4
+        # Peers below this share of the best peer's score get one piece at a
+        # time, and below the drop share they are disconnected
+        self.SLOW_PEER_RATIO = 0.25
+        self.DROP_PEER_RATIO = 0.05
+        # Pieces a peer must have delivered before it can be judged slow
+        self.SLOW_PEER_MIN_PIECES = 4
+        # Remaining pieces below which idle peers duplicate in-flight requests
+        self.ENDGAME_THRESHOLD = 8
+        # Hand each peer runs of consecutive pieces, see PieceScheduler
+        self.CONTIGUOUS_RUNS = False
+        # Requests in flight longer than this share of recent pieces took get
+        # a second copy at another peer, see PieceScheduler; None disables it
+        self.HEDGE_PERCENTILE = 0.95
+        # Times its peer's expected time a request must also have taken
+        self.HEDGE_SLACK = 2.0
+        # Seconds an idle worker or the download waits before looking again
+        self.IDLE_RECHECK = 1.0
+        # Seconds to wait for a peer to announce a piece nobody has yet
+        self.STALL_TIMEOUT = 10.0
+        # Pieces ahead of a stream's read cursor that are fetched first
+        self.STREAMING_WINDOW = 16
+        # Seconds between saves of a download's resume state
+        self.RESUME_INTERVAL = 30.0
+        # Below this many downloading peers the tracker is asked again before
+        # its announce interval is up, but no more often than the minimum
+        self.MINIMUM_CONNECTED_PEERS = 5
+        self.MINIMUM_REANNOUNCE_INTERVAL = 30.0
+        # Announce interval used until the tracker has sent one
+        self.DEFAULT_ANNOUNCE_INTERVAL = 1800
         self.BATCH_SIZE = 10
 
         self.active_downloads: dict[str, dict] = (
@@ -34,127 +121,263 @@ class DownloadManager:
         )  # A dictionary to store active downloads
         self.lock = threading.Lock()
 
-    def new_download(self, torrent: Torrent, peer_list: list):
+    def new_download(
+        self, torrent: Torrent, peer_list: list, priority=0, file_priorities=None
+    ):
+        """Start downloading the torrent, or queue it behind the active downloads.
+
+        Queued downloads start in order of priority, lower numbers first.
+        file_priorities holds a SKIP, LOW, NORMAL or HIGH priority for each
+        file of the torrent, all NORMAL by default. Skipped files are not
+        created, see _piece_priorities for the pieces they share.
+        """
+        files = torrent.files
+        if file_priorities is None:
+            file_priorities = [NORMAL] * len(files)
+        piece_priorities = self._piece_priorities(torrent, file_priorities)
+        pieceManager = PieceManager(torrent, self.dest_dir)
+        pieceManager.skipped_files = {
+            path
+            for (path, _), file_priority in zip(files, file_priorities)
+            if file_priority == SKIP
+        }
         with self.lock:
             infohash = torrent.infohash
             self.active_downloads[infohash] = {
                 "peer_list": peer_list,
                 "torrent": torrent,
-                "download_thread": Thread(target=self._download, args=(infohash,)),
+                "download_future": None,
                 "downloaded_data": [],
-                "downloaded_total": 0,
+                # Bytes verified before a restart; the bytes downloaded since
+                # are counted by each peer's PeerStats, see _downloaded
+                "resumed_total": 0,
                 "num_connected_peers": 0,
                 "remaining_pieces": 0,
+                "piece_manager": pieceManager,
+                "file_priorities": list(file_priorities),
+                "piece_priorities": piece_priorities,
+                # Bytes of the pieces to download
+                "total": sum(
+                    pieceManager.get_piece_length(piece_index)
+                    for piece_index, piece_priority in enumerate(piece_priorities)
+                    if piece_priority != SKIP
+                ),
+                "scheduler": None,
+                "resume_state": None,
+                # First piece of the streaming window, see open_stream
+                "stream_piece": None,
+                "priority": priority,
+                "queued": True,
+                # PeerStats of every peer that downloaded for this torrent
+                "peer_stats": {},
+                # The TorrentWorker running the download, see worker_processes
+                "worker": None,
             }
-            self.active_downloads[infohash]["download_thread"].start()
+            self.active_downloads[infohash]["download_future"] = self.peerEngine.submit(
+                self._download(infohash)
+            )
 
-    def _download(self, infohash: str):
+    async def _download(self, infohash: str):
         download_info = self.active_downloads[infohash]
-        peer_list = download_info["peer_list"]
-
-        # Initialize the piece manager
-        pieceManager = PieceManager(download_info["torrent"], self.dest_dir)
-
-        # Connect to peers
-        connected_peers = []
-        peer_to_connect = peer_list.copy()
-
-        for _ in range(self.MAXIMUM_CONNECT_RETRY):
-            for peer in peer_to_connect[:]:
-                socket = self._connect_peer(infohash, peer)
-                if socket:
-                    connected_peers.append({"socket": socket, "peer": peer})
-                    peer_to_connect.remove(peer)
-
-            if len(connected_peers) >= len(peer_list):
-                break
-
-        # print(
-        #     f"Connected to {len(connected_peers)} out of {len(peer_list)} peers for {download_info['torrent'].name}"
-        # )
-        # print("Connected peers: ", connected_peers)
-
-        # Retrieve bitfields from connected peers
+        await self.resourceManager.acquire_download(infohash, download_info["priority"])
+        try:
+            with self.lock:
+                download_info["queued"] = False
+            if self.worker_processes:
+                await self._run_download_process(infohash)
+            else:
+                await self._run_download(infohash)
+        finally:
+            self.resourceManager.release_download(infohash)
 
-        bitfields: dict[str, bytearray] = {}
-        for peer in connected_peers:
-            Thread(
-                target=self._retrieve_bitfield,
-                args=(peer["peer"]["peer_id"], peer["socket"], bitfields),
-            ).start()
+    async def _run_download(self, infohash: str):
+        download_info = self.active_downloads[infohash]
+        peer_list = download_info["peer_list"]
 
-        # Wait for all bitfields to be retrieved
-        while len(bitfields) < len(connected_peers):
-            pass
+        pieceManager = download_info["piece_manager"]
 
-        print("All bitfields retrieved.")
+        # Pieces verified before a restart are not downloaded again
+        resumeState = ResumeState(self.dest_dir, infohash)
+        resumed = await asyncio.to_thread(resumeState.load, pieceManager)
+        with self.lock:
+            download_info["resume_state"] = resumeState
 
-        # Initialize the failed pieces queue
-        failed_pieces: queue.Queue = queue.Queue()
+        # Pieces are written straight to their final location as they verify
+        await asyncio.to_thread(
+            FileManager.allocate_files,
+            download_info["torrent"],
+            self.dest_dir,
+            pieceManager.skipped_files,
+        )
 
-        # Download and retry loop
-        for retry_attempt in range(self.MAXIMUM_DOWNLOAD_RETRY + 1):
-            print(f"Download attempt {retry_attempt + 1}")
+        # Connect to every peer concurrently; each peer starts downloading as
+        # soon as its bitfield is in, without waiting for the slower ones
+        scheduler = PieceScheduler(
+            pieceManager.num_pieces,
+            self.MAXIMUM_PIECE_FAILURES,
+            self.ENDGAME_THRESHOLD,
+            self.CONTIGUOUS_RUNS,
+            self.HEDGE_PERCENTILE,
+        )
+        scheduler.set_priorities(download_info["piece_priorities"])
+        for piece_index in resumed:
+            pieceManager.mark_downloaded(piece_index)
+            scheduler.complete(piece_index)
+        with self.lock:
+            download_info["scheduler"] = scheduler
+            if download_info["stream_piece"] is not None:
+                scheduler.set_window(
+                    download_info["stream_piece"], self.STREAMING_WINDOW
+                )
+        if resumed:
+            print(
+                f"Resuming {download_info['torrent'].name} with {len(resumed)} of {pieceManager.num_pieces} pieces"
+            )
+            download_info["resumed_total"] = sum(
+                pieceManager.get_piece_length(piece_index) for piece_index in resumed
+            )
+        # Seed the verified pieces while the rest download, peers hear of
+        # new ones through broadcast_have
+        self.uploadManager.new_upload(download_info["torrent"], pieceManager)
+        connected_peers: list[PeerSession] = []
+        workers = []
+        # Addresses of known peers whose worker exited, which a re-announce
+        # or peer exchange may admit again
+        retired: set[tuple[str, int]] = set()
+        # Set whenever a worker or the connection setup finishes
+        progress = asyncio.Event()
 
-            if retry_attempt == 0:
-                pieces_to_download = self._get_rarest_pieces(bitfields)
-            else:
-                if failed_pieces.empty():
-                    print("No failed pieces to retry.")
-                    break
-                pieces_to_download = list(failed_pieces.queue)
-                failed_pieces.queue.clear()
+        def start_worker(session: PeerSession):
+            connected_peers.append(session)
+            self._update_connected_peers(infohash)
+            worker = asyncio.create_task(
+                self._download_pieces(
+                    pieceManager,
+                    scheduler,
+                    infohash,
+                    session.peer,
+                    session.bitfield,
+                    self.MAXIMUM_DOWNLOAD_RETRY,
+                )
+            )
+            address = (session.peer["ip"], session.peer["port"])
+            worker.add_done_callback(lambda _: retired.add(address))
+            worker.add_done_callback(lambda _: progress.set())
+            workers.append(worker)
 
-            print(f"Pieces to download: {pieces_to_download}")
+        async def start_workers():
+            setups = [
+                asyncio.create_task(
+                    self._connect_peer(infohash, peer, pieceManager.num_pieces)
+                )
+                for peer in peer_list
+            ]
+            try:
+                for setup in asyncio.as_completed(setups):
+                    session = await setup
+                    if session is not None:
+                        start_worker(session)
+            finally:
+                for setup in setups:
+                    setup.cancel()
 
-            # Assign pieces to peers in a Round-Robin manner
-            assigned_dict: dict[str, list] = {
-                peer["peer"]["peer_id"]: [] for peer in connected_peers
-            }
-            for i, piece_idx in enumerate(pieces_to_download):
-                peer = connected_peers[i % len(connected_peers)]
-                peer_id = peer["peer"]["peer_id"]
-
-                if bitfields[peer_id][piece_idx] == 1:
-                    assigned_dict[peer_id].append(piece_idx)
-
-            print(f"Assigned pieces: {assigned_dict}")
-
-            # Start download threads
-            threads = []
-            for peer in connected_peers:
-                peer_id = peer["peer"]["peer_id"]
-                assigned_pieces = assigned_dict[peer_id]
-
-                if assigned_pieces:
-                    thread = Thread(
-                        target=self._download_piece_thread,
-                        args=(
-                            pieceManager,
-                            assigned_pieces,
-                            infohash,
-                            peer["socket"],
-                            failed_pieces,
-                            self.MAXIMUM_DOWNLOAD_RETRY,
-                        ),
-                    )
-                    threads.append(thread)
-                    thread.start()
+        def start_announce():
+            announce = asyncio.create_task(self._reannounce(infohash))
+            announce.add_done_callback(lambda _: progress.set())
+            return announce
 
-            # Wait for all threads to finish
-            for thread in threads:
-                thread.join()
+        setup_task = asyncio.create_task(start_workers())
+        setup_task.add_done_callback(lambda _: progress.set())
+        stalled_since = None
+        last_saved = time.monotonic()
+        # The peer list came from an announce just before the download
+        last_announced = time.monotonic()
+        announce_task = None
+        # Whether the tracker was asked since the last worker finished
+        announced_when_idle = False
+        # Peers still connecting or backing off are not waited for once
+        # every piece is in
+        try:
+            while not scheduler.finished():
+                # Peers learned through peer exchange join while pieces are missing
+                for session in await self._admit_pex_peers(
+                    infohash, pieceManager.num_pieces, connected_peers, retired
+                ):
+                    start_worker(session)
+                # And so do peers that joined the tracker since the last announce
+                if announce_task is not None and announce_task.done():
+                    for session in await self._admit_tracker_peers(
+                        infohash,
+                        pieceManager.num_pieces,
+                        connected_peers,
+                        announce_task.result(),
+                        retired,
+                    ):
+                        start_worker(session)
+                    announce_task = None
+                downloading = sum(not worker.done() for worker in workers)
+                if downloading:
+                    announced_when_idle = False
+                if announce_task is None and self._announce_due(
+                    last_announced, downloading
+                ):
+                    announce_task = start_announce()
+                    last_announced = time.monotonic()
+                if setup_task.done() and not downloading and announce_task is None:
+                    if announced_when_idle:
+                        break
+                    # Every peer left, the tracker may know new ones
+                    announce_task = start_announce()
+                    last_announced = time.monotonic()
+                    announced_when_idle = True
+                # Connected peers may still announce the missing pieces with HAVE
+                if setup_task.done() and scheduler.stalled():
+                    stalled_since = stalled_since or time.monotonic()
+                    if time.monotonic() - stalled_since >= self.STALL_TIMEOUT:
+                        break
+                else:
+                    stalled_since = None
+                if time.monotonic() - last_saved >= self.RESUME_INTERVAL:
+                    await self._save_resume_state(infohash)
+                    last_saved = time.monotonic()
+                try:
+                    async with asyncio.timeout(self.IDLE_RECHECK):
+                        await progress.wait()
+                except TimeoutError:
+                    pass
+                progress.clear()
+        finally:
+            # Also when the loop fails, so no worker outlives the download
+            setup_task.cancel()
+            for worker in workers:
+                worker.cancel()
+            if announce_task is not None:
+                announce_task.cancel()
+                workers.append(announce_task)
+            await asyncio.gather(setup_task, *workers, return_exceptions=True)
+            # The pooled sessions are only needed while pieces are being fetched
+            await self.peerPool.release_torrent(infohash)
+            if not scheduler.succeeded():
+                await self._save_resume_state(infohash)
+        connected = {session.peer_id for session in connected_peers}
+        print(f"Connected to {len(connected)} out of {len(peer_list)} peers.")
 
-        if not failed_pieces.empty():
-            print(
-                f"Failed to download some pieces after {self.MAXIMUM_DOWNLOAD_RETRY} retries."
-            )
+        if not scheduler.succeeded():
+            missing = sorted(scheduler.pending | scheduler.given_up)
+            print(f"Failed to download pieces {missing}.")
             return
 
         print(f"Download finished for {download_info['torrent'].name}")
 
         # Verify the downloaded data
-        success = pieceManager.verify_all_pieces()
+        wanted = [
+            piece_index
+            for piece_index, piece_priority in enumerate(
+                download_info["piece_priorities"]
+            )
+            if piece_priority != SKIP
+        ]
+        success = await asyncio.to_thread(pieceManager.verify_all_pieces, wanted)
         if not success:
             print(
                 f"Downloaded data verification failed for {download_info['torrent'].name}"
@@ -164,172 +387,830 @@ class DownloadManager:
             f"Downloaded data verification passed for {download_info['torrent'].name}"
         )
 
-        # Finalize download
-        piece_data = pieceManager.get_all_piece_data()
-        FileManager.create_file_tree(download_info["torrent"], self.dest_dir)
-        FileManager.write_file(
-            self.dest_dir, piece_data, download_info["torrent"].files
-        )
-
+        await asyncio.to_thread(resumeState.delete)
         with self.lock:
             del self.active_downloads[infohash]
         print(f"Write file completed for {download_info['torrent'].name}")
 
-        self.uploadManager.new_upload(download_info["torrent"])
-        self.trackerCommunicator.upload_announce(download_info["torrent"])
+        if pieceManager.skipped_files:
+            # Only a seed of the whole torrent announces completion. The parts
+            # file stays, the pieces it completes are still seeded
+            return
+        # No piece is read from the parts file any more
+        await asyncio.to_thread(
+            FileManager.delete_parts, download_info["torrent"], self.dest_dir
+        )
+        await asyncio.to_thread(
+            self.trackerCommunicator.upload_announce, download_info["torrent"]
+        )
+
+    async def _run_download_process(self, infohash: str):
+        """Run the download in a TorrentWorker, then seed what it downloaded."""
+        download_info = self.active_downloads[infohash]
+        torrent = download_info["torrent"]
+        with self.lock:
+            peer_list = list(download_info["peer_list"])
+        worker = TorrentWorker(
+            self._worker_config(), torrent, peer_list, download_info["file_priorities"]
+        )
+        await asyncio.to_thread(worker.start)
+        with self.lock:
+            download_info["worker"] = worker
+        self.uploadManager.set_handoff(infohash, worker.hand_off)
+        try:
+            succeeded = await worker.wait()
+            if succeeded:
+                # The worker verified every wanted piece before it finished
+                pieceManager = download_info["piece_manager"]
+                for piece_index, piece_priority in enumerate(
+                    download_info["piece_priorities"]
+                ):
+                    if piece_priority != SKIP:
+                        pieceManager.mark_downloaded(piece_index)
+                self.uploadManager.new_upload(torrent, pieceManager)
+        finally:
+            # Seeded from here on, if it finished
+            self.uploadManager.set_handoff(infohash)
+        if succeeded:
+            with self.lock:
+                del self.active_downloads[infohash]
+
+    def _worker_config(self):
+        """Settings a TorrentWorker builds its managers from."""
+        return {
+            "id": self.id,
+            "ip": self.uploadManager.ip,
+            "port": self.uploadManager.port,
+            "torrent_dir": self.torrent_dir,
+            "dest_dir": self.dest_dir,
+            "extensions": self.peerPool.extensions,
+            "tracker": self.trackerCommunicator,
+            "limits": self.rateLimiter.get_limits(),
+            "max_connections": self.resourceManager.max_torrent_connections,
+            "contiguous_runs": self.CONTIGUOUS_RUNS,
+            # Each worker gets an equal share of the memory budget
+            "max_memory": self.resourceManager.max_memory
+            // self.resourceManager.max_active_downloads,
+        }
+
+    def resume_downloads(self):
+        """Restart the downloads an earlier run left unfinished, returns their torrents.
+
+        Peers come from the tracker, or from the saved peer list if it has none.
+        """
+        resumed = []
+        for infohash in ResumeState.list_unfinished(self.dest_dir):
+            torrent_path = FileManager.get_torrent_file_path(infohash, self.torrent_dir)
+            if torrent_path is None:
+                print(
+                    f"[INFO-DownloadManager-resume_downloads] No torrent file for {infohash}"
+                )
+                continue
+            torrent = Torrent.read(torrent_path)
+            state = ResumeState(self.dest_dir, infohash).read() or {}
+            peer_list = self.trackerCommunicator.download_announce(torrent)
+            if peer_list is None:
+                peer_list = state.get("peer_list", [])
+            if not peer_list:
+                print(
+                    f"[INFO-DownloadManager-resume_downloads] No peers for {torrent.name}"
+                )
+                continue
+            print(f"Resuming download for {torrent.name}")
+            self.new_download(
+                torrent, peer_list, file_priorities=state.get("file_priorities")
+            )
+            resumed.append(torrent)
+        return resumed
+
+    def open_stream(self, infohash: str, file_index=0, timeout=None):
+        """Returns a blocking StreamReader of one file of a running download.
+
+        Reads favor the pieces ahead of the reader over rarest-first.
+        """
+        if self.worker_processes:
+            raise ValueError("Downloads in worker processes cannot be streamed")
+        return StreamReader(self, infohash, file_index, timeout)
+
+    def set_stream_position(self, infohash: str, piece_index: int):
+        """Move the download's streaming window to start at piece_index."""
+        with self.lock:
+            download_info = self.active_downloads.get(infohash)
+            if download_info is None or download_info["stream_piece"] == piece_index:
+                return
+            download_info["stream_piece"] = piece_index
+            scheduler = download_info["scheduler"]
+        if scheduler is not None:
+            self.peerEngine.call_soon(
+                scheduler.set_window, piece_index, self.STREAMING_WINDOW
+            )
+
+    def stop(self):
+        """Save the resume state of every unfinished download."""
+        with self.lock:
+            workers = [
+                download_info["worker"]
+                for download_info in self.active_downloads.values()
+                if download_info["worker"] is not None
+            ]
+            downloads = [
+                (
+                    download_info["resume_state"],
+                    download_info["piece_manager"],
+                    list(download_info["peer_list"]),
+                    download_info["file_priorities"],
+                )
+                for download_info in self.active_downloads.values()
+            ]
+        for resumeState, pieceManager, peer_list, file_priorities in downloads:
+            if resumeState is not None:
+                resumeState.save(pieceManager, peer_list, file_priorities)
+        # Workers save their own
+        for worker in workers:
+            worker.stop()
+
+    async def _save_resume_state(self, infohash: str):
+        with self.lock:
+            download_info = self.active_downloads[infohash]
+            peer_list = list(download_info["peer_list"])
+        await asyncio.to_thread(
+            download_info["resume_state"].save,
+            download_info["piece_manager"],
+            peer_list,
+            download_info["file_priorities"],
+        )
+
+    async def _connect_peer(self, infohash: str, peer: dict, num_pieces: int):
+        """Connect to the peer and read its bitfield, returns None if it fails.
 
-    def _download_piece_thread(
+        The connection waits for a slot of the ResourceManager, and failed
+        attempts are retried with exponential backoff.
+        """
+        if self.peerBans.is_banned(peer["ip"], peer["port"]):
+            return None
+        delay = self.CONNECT_BACKOFF
+        for attempt in range(self.MAXIMUM_CONNECT_RETRY):
+            session = await self.peerPool.connect(infohash, peer)
+            if session is not None:
+                break
+            if attempt + 1 < self.MAXIMUM_CONNECT_RETRY:
+                await asyncio.sleep(delay)
+                delay *= 2
+        else:
+            print(
+                f"[ERROR-DownloadManager-_connect_peer] Giving up on {peer['ip']}:{peer['port']}"
+            )
+            return None
+
+        try:
+            await self.peerPool.exchange_bitfield(session, num_pieces)
+        except (ConnectionError, TimeoutError, OSError) as e:
+            print(f"[ERROR-DownloadManager-_connect_peer] {peer['peer_id']}: {e}")
+            await self.peerPool.discard(session)
+            return None
+        return session
+
+    async def _download_pieces(
         self,
         pieceManager: PieceManager,
-        assigned_pieces: list,
+        scheduler: PieceScheduler,
         infohash: str,
-        socket: socket.socket,
-        failed_pieces: queue.Queue,
+        peer: dict,
+        bitfield: bytes,
         MAXIMUM_RETRY: int,
     ):
-        peerCommunicator = PeerCommunicator(socket)
-        for piece_index in assigned_pieces:
-            # print("Attemping to download piece ", piece_index)
-            for attempt in range(MAXIMUM_RETRY):
+        """Download pieces from one peer until the scheduler has none left for it.
+
+        Returns when the download is finished, or gives up on the peer when it
+        is unreachable or banned, after MAXIMUM_RETRY failed pieces in a row,
+        or once it is persistently much slower than the best peer.
+        """
+        # One staging buffer per busy worker, reused for every piece it receives
+        staging = None
+        # Pieces the peer rejected while choking us, retried after a while
+        rejected = set()
+        # Pieces requested or about to be, in the order the peer answers them
+        outstanding: deque[int] = deque()
+        consecutive_failures = 0
+        with self.lock:
+            stats = self.active_downloads[infohash]["peer_stats"].setdefault(
+                peer["peer_id"], PeerStats(peer["peer_id"])
+            )
+        # Grows as the peer announces new pieces with HAVE
+        bitfield = bytearray(bitfield)
+        scheduler.add_peer(bitfield)
+        session = None
+
+        def is_overdue(piece_index, holder, waited):
+            return self._is_overdue(infohash, pieceManager.piece_size, holder, waited)
+
+        try:
+            while True:
+                previous = session
+                session = await self.peerPool.acquire(
+                    infohash, peer, pieceManager.num_pieces
+                )
+                if previous is not None and session is not previous:
+                    # Runs are per connection, the old one's is over
+                    scheduler.end_run(previous)
+                if session is None:
+                    print(f"[ERROR] Peer {peer['peer_id']} unreachable")
+                    return
+                if session is not previous:
+                    # The peer may have got pieces while it was disconnected
+                    self._apply_bitfield(session, scheduler, bitfield)
+                self._update_connected_peers(infohash)
+                self._apply_haves(session, scheduler, bitfield)
+                requestable = self._requestable(
+                    session, scheduler, bitfield, outstanding
+                )
+
+                depth = self._pipeline_depth(stats, infohash, pieceManager.piece_size)
+                while len(outstanding) < depth:
+                    # A request overdue at another peer goes before new pieces
+                    next_index = scheduler.hedge_piece(
+                        requestable, rejected, session, is_overdue
+                    )
+                    if next_index is None:
+                        next_index = scheduler.next_piece(
+                            requestable, rejected, session
+                        )
+                    if next_index is None:
+                        break
+                    outstanding.append(next_index)
+                if not outstanding:
+                    if staging is not None:
+                        # An idle worker holds no memory
+                        staging = None
+                        self.resourceManager.release_memory(pieceManager.piece_size)
+                    if scheduler.finished():
+                        return
+                    # Wait for a returned piece, for the peer to announce one
+                    # or for it to unchoke us
+                    try:
+                        woken = await session.peer_communicator.wait_for_haves(
+                            scheduler.changed, self.IDLE_RECHECK
+                        )
+                    except (ConnectionError, OSError) as e:
+                        print(f"[INFO] Peer {peer['peer_id']}: {e}")
+                        await self.peerPool.discard(session)
+                        continue
+                    if not woken:
+                        rejected.clear()
+                    continue
+                if staging is None:
+                    if not self.resourceManager.try_reserve_memory(
+                        pieceManager.piece_size
+                    ):
+                        # Over the memory budget: the pieces go to workers
+                        # that have a buffer while this one waits for memory
+                        self._release_pieces(scheduler, session, outstanding)
+                        await self.resourceManager.reserve_memory(
+                            pieceManager.piece_size
+                        )
+                    staging = bytearray(pieceManager.piece_size)
+                    if not outstanding:
+                        continue
+                # print("Attemping to download piece ", piece_index)
+
+                piece_index = outstanding.popleft()
+                session.in_use = True
                 try:
-                    peerCommunicator.send_request(piece_index)
+                    peerCommunicator = session.peer_communicator
+                    for request_index in (piece_index, *outstanding):
+                        if request_index not in peerCommunicator.requested_pieces:
+                            await peerCommunicator.send_request(request_index)
                     # print("DownloadManager: sent request for piece ", piece_index)
-                    received_idx, piece_data = peerCommunicator.receive_piece()
+                    since = max(
+                        peerCommunicator.requested_pieces[piece_index],
+                        peerCommunicator.last_piece_at,
+                    )
+                    received_idx, length, digest = (
+                        await peerCommunicator.receive_piece_into(
+                            staging, pieceManager.piece_size
+                        )
+                    )
                     # print("DownloadManager: received piece ", received_idx)
 
                     if received_idx != piece_index:
-                        raise Exception(
+                        # The stream is out of step with our requests
+                        raise ConnectionError(
                             f"Received idx {received_idx} not match requested idx {piece_index}"
                         )
 
-                    if pieceManager.verify_piece(piece_data, piece_index):
-                        pieceManager.add_downloaded_piece(piece_data, piece_index)
-                        with self.lock:
-                            self.active_downloads[infohash]["downloaded_total"] += len(
-                                piece_data
+                    if piece_index in scheduler.completed:
+                        # Another peer's copy won the endgame race
+                        continue
+                    if length == pieceManager.get_piece_length(
+                        piece_index
+                    ) and pieceManager.verify_digest(digest, piece_index):
+                        stats.add_piece(
+                            length,
+                            peerCommunicator.last_piece_at - since,
+                            peerCommunicator.timeouts.srtt,
+                        )
+                        await asyncio.to_thread(
+                            pieceManager.add_downloaded_piece,
+                            memoryview(staging)[:length],
+                            piece_index,
+                        )
+                        consecutive_failures = 0
+                        duplicates = scheduler.complete(piece_index, session)
+                        if duplicates is None:
+                            continue
+                        stats.add_completed(length)
+                        self.uploadManager.broadcast_have(infohash, piece_index)
+                        for duplicate in duplicates:
+                            await self._cancel_request(duplicate, piece_index)
+                        if self._is_slow_peer(stats, infohash, scheduler, bitfield):
+                            print(
+                                f"[INFO] Dropping slow peer {peer['peer_id']} at {stats.download_rate:.0f} B/s"
                             )
-                        break
-
+                            # Frees its connection slot for another peer
+                            await self.peerPool.discard(session)
+                            return
                     else:
-                        raise Exception("Piece verification failed")
+                        print(
+                            f"[ERROR] Piece {piece_index} from peer {peer['peer_id']} failed its hash check"
+                        )
+                        stats.add_failure(hash_failure=True)
+                        scheduler.fail(piece_index, session)
+                        consecutive_failures += 1
+                        if self.peerBans.add_hash_failure(peer["ip"], peer["port"]):
+                            print(f"[INFO] Banning peer {peer['peer_id']}")
+                            # Every torrent's worker on the peer loses its
+                            # connection and gives up on reconnecting
+                            await self.peerPool.discard_peer(peer["ip"], peer["port"])
+                            return
+                except RequestRejected as e:
+                    if e.piece_index != piece_index:
+                        # Rejects arrive in request order, but be lenient
+                        outstanding.appendleft(piece_index)
+                        if e.piece_index in outstanding:
+                            outstanding.remove(e.piece_index)
+                    if e.piece_index in scheduler.completed:
+                        # The answer to our cancel
+                        continue
+                    # The peer is choking us; the piece goes back for the others
+                    print(f"[INFO] Peer {peer['peer_id']}: {e}")
+                    rejected.add(e.piece_index)
+                    scheduler.release(e.piece_index, session)
+                except TimeoutError as e:
+                    # A peer that misses its deadline leaves its pieces to the
+                    # other peers and is tried again on a new connection
+                    await self.peerPool.discard(session)
+                    print(
+                        f"[ERROR] Peer {peer['peer_id']} timed out on piece {piece_index}: {e}"
+                    )
+                    stats.add_failure()
+                    scheduler.fail(piece_index, session)
+                    self._release_pieces(scheduler, session, outstanding)
+                    consecutive_failures += 1
+                    if consecutive_failures < MAXIMUM_RETRY:
+                        await asyncio.sleep(
+                            self.CONNECT_BACKOFF * 2 ** (consecutive_failures - 1)
+                        )
+                except (ConnectionError, OSError) as e:
+                    # A broken connection is dropped; the next piece reconnects
+                    await self.peerPool.discard(session)
+                    print(f"[ERROR] Download failed for piece {piece_index}: {e}")
+                    stats.add_failure()
+                    scheduler.fail(piece_index, session)
+                    self._release_pieces(scheduler, session, outstanding)
+                    consecutive_failures += 1
                 except Exception as e:
+                    if piece_index in scheduler.completed:
+                        # A cancelled duplicate, cut short by the peer
+                        continue
+                    print(f"[ERROR] Download failed for piece {piece_index}: {e}")
+                    stats.add_failure()
+                    scheduler.fail(piece_index, session)
+                    consecutive_failures += 1
+                finally:
+                    session.in_use = False
+                    session.touch()
+
+                if consecutive_failures >= MAXIMUM_RETRY:
                     print(
-                        f"[ERROR] Download failed for piece {piece_index}, attempt {attempt + 1}/{MAXIMUM_RETRY}: {e}"
+                        f"[ERROR] Giving up on peer {peer['peer_id']} after {consecutive_failures} failed pieces"
                     )
+                    await self.peerPool.discard(session)
+                    return
+        finally:
+            if outstanding:
+                # Answers to these requests may still arrive, the session is
+                # of no further use
+                await self.peerPool.discard(session)
+                self._release_pieces(scheduler, session, outstanding)
+            if staging is not None:
+                self.resourceManager.release_memory(pieceManager.piece_size)
+            scheduler.remove_peer(bitfield, session)
 
-                    if attempt + 1 == MAXIMUM_RETRY:
-                        failed_pieces.put(piece_index)
-                    else:
-                        continue
-        peerCommunicator.send_choke()
-        socket.close()
+    def _pipeline_depth(self, stats: PeerStats, infohash: str, piece_size: int):
+        """Number of requests to keep queued at the peer.
+
+        Enough to cover one round trip at the peer's rate, so the next piece
+        is on its way when one completes. Peers far slower than the best one
+        get a single piece at a time, leaving the rest to the faster peers.
+        """
+        if stats.score is None or stats.latency is None:
+            return 2
+        best_score = self._best_score(infohash)
+        if best_score is not None and stats.score < best_score * self.SLOW_PEER_RATIO:
+            return 1
+        depth = 1 + math.ceil(stats.score * stats.latency / piece_size)
+        return min(depth, self.MAXIMUM_PIPELINE_DEPTH)
+
+    def _is_overdue(
+        self, infohash: str, piece_size: int, holder: PeerSession, waited: float
+    ):
+        """True if a request has taken HEDGE_SLACK times what its peer's rate predicts.
+
+        A request may wait behind a full pipeline of others at the peer, so
+        that is what is expected. Without stats yet, the scheduler's hedge
+        delay alone decides.
+        """
+        stats = self.active_downloads[infohash]["peer_stats"].get(holder.peer_id)
+        if stats is None or stats.score is None or stats.latency is None:
+            return True
+        depth = self._pipeline_depth(stats, infohash, piece_size)
+        expected = stats.latency + depth * piece_size / stats.download_rate
+        return waited > self.HEDGE_SLACK * expected
 
-    def _retrieve_bitfield(
+    def _is_slow_peer(
         self,
-        peer_id: str,
-        socket: socket.socket,
-        bitfields: dict,
+        stats: PeerStats,
+        infohash: str,
+        scheduler: PieceScheduler,
+        bitfield: bytearray,
+    ):
+        """True if the peer is persistently far slower than the best peer.
+
+        A peer is only dropped if every piece it could still give us is held
+        by another connected peer, and never in endgame.
+        """
+        if stats.pieces < self.SLOW_PEER_MIN_PIECES or scheduler.in_endgame():
+            return False
+        best_score = self._best_score(infohash)
+        if best_score is None or stats.score >= best_score * self.DROP_PEER_RATIO:
+            return False
+        return all(
+            scheduler.availability[piece_index] > 1
+            for piece_index in scheduler.pending
+            if bitfield[piece_index]
+        )
+
+    def _best_score(self, infohash: str):
+        # peer_stats only changes on the event loop, reading it there is safe
+        scores = [
+            stats.score
+            for stats in self.active_downloads[infohash]["peer_stats"].values()
+            if stats.score is not None
+        ]
+        return max(scores, default=None)
+
+    @staticmethod
+    def _piece_priorities(torrent: Torrent, file_priorities: list):
+        """Map the file priorities onto the pieces through the file layout.
+
+        A piece shared by several files gets the highest of their priorities,
+        so a boundary piece is downloaded whole if any of its files is
+        selected. Its part in a skipped file goes to the parts file.
+        """
+        priorities = [SKIP] * torrent.pieces
+        file_start = 0
+        for (_, size), file_priority in zip(torrent.files, file_priorities):
+            if size > 0:
+                first_piece = file_start // torrent.piece_size
+                last_piece = (file_start + size - 1) // torrent.piece_size
+                for piece_index in range(first_piece, last_piece + 1):
+                    priorities[piece_index] = max(
+                        priorities[piece_index], file_priority
+                    )
+            file_start += size
+        return priorities
+
+    @staticmethod
+    def _release_pieces(scheduler: PieceScheduler, session, outstanding: deque):
+        """Return requested pieces that will not be answered to the scheduler."""
+        for piece_index in outstanding:
+            scheduler.release(piece_index, session)
+        outstanding.clear()
+
+    @staticmethod
+    def _requestable(
+        session: PeerSession, scheduler: PieceScheduler, bitfield, outstanding: deque
     ):
-        peerCommunicator = PeerCommunicator(socket)
-        peerCommunicator.receive_unchoke()
-        # print("received unchoke from peer ", peer_id)
-        peerCommunicator.send_interested()
-        # print("sent interested to peer ", peer_id)
-        bitfield = peerCommunicator.receive_bitfield()
-        # print("received bitfield from peer ", peer_id)
+        """The pieces of the peer's bitfield that may be requested from it now.
+
+        A peer choking us only serves its allowed-fast pieces, so the other
+        pieces are left to the unchoked peers. Queued pieces it would reject
+        that were not requested yet go back to the scheduler.
+        """
+        peer_communicator = session.peer_communicator
+        if not peer_communicator.peer_choking:
+            return bitfield
+        allowed_fast = peer_communicator.allowed_fast
+        for piece_index in [
+            piece_index
+            for piece_index in outstanding
+            if piece_index not in allowed_fast
+            and piece_index not in peer_communicator.requested_pieces
+        ]:
+            outstanding.remove(piece_index)
+            scheduler.release(piece_index, session)
+        requestable = bytearray(len(bitfield))
+        for piece_index in allowed_fast:
+            if piece_index < len(bitfield):
+                requestable[piece_index] = bitfield[piece_index]
+        return requestable
+
+    @staticmethod
+    def _apply_bitfield(session: PeerSession, scheduler: PieceScheduler, bitfield):
+        """Add the pieces in the bitfield of a new connection to the peer's bitfield."""
+        for piece_index, bit in enumerate(session.bitfield[: len(bitfield)]):
+            if bit == 1 and not bitfield[piece_index]:
+                bitfield[piece_index] = 1
+                scheduler.add_have(piece_index)
+
+    @staticmethod
+    def _apply_haves(session: PeerSession, scheduler: PieceScheduler, bitfield):
+        """Add the pieces the peer announced since the last look to its bitfield."""
+        peer_haves = session.peer_communicator.peer_haves
+        for piece_index in peer_haves:
+            if piece_index < len(bitfield) and not bitfield[piece_index]:
+                bitfield[piece_index] = 1
+                scheduler.add_have(piece_index)
+        peer_haves.clear()
+
+    async def _cancel_request(self, session: PeerSession, piece_index: int):
+        """Cancel a duplicate request, its worker reads the peer's answer."""
+        try:
+            await session.peer_communicator.send_cancel(piece_index)
+        except (ConnectionError, OSError) as e:
+            print(f"[INFO] Could not cancel piece {piece_index}: {e}")
+
+    def _announce_due(self, last_announced: float, downloading: int):
+        """True once the tracker's interval is up, or sooner when peers are few."""
+        interval = (
+            self.trackerCommunicator.announce_interval or self.DEFAULT_ANNOUNCE_INTERVAL
+        )
+        if downloading < self.MINIMUM_CONNECTED_PEERS:
+            interval = min(interval, self.MINIMUM_REANNOUNCE_INTERVAL)
+        return time.monotonic() - last_announced >= interval
+
+    async def _reannounce(self, infohash: str):
+        """Announce the download to the tracker again, returns its peers."""
         with self.lock:
-            bitfields[peer_id] = bitfield
+            download_info = self.active_downloads[infohash]
+            torrent = download_info["torrent"]
+            left = torrent.size - self._downloaded(download_info)
+        try:
+            peer_list = await asyncio.to_thread(
+                self.trackerCommunicator.download_reannounce, torrent, left
+            )
+        except requests.exceptions.RequestException:
+            # Already reported, the next announce tries again
+            return []
+        except (bencodepy.DecodingError, KeyError, ValueError, AttributeError) as e:
+            # A reply that is not a tracker response, e.g. an error page
+            print(f"[ERROR-DownloadManager-_reannounce] Bad tracker reply: {e}")
+            return []
+        return peer_list or []
 
-    def _connect_peer(
+    async def _admit_tracker_peers(
         self,
         infohash: str,
-        peer_info: dict,
+        num_pieces: int,
+        connected_peers: list[PeerSession],
+        peer_list: list,
+        retired: set,
     ):
-        ip = peer_info["ip"]
-        port = peer_info["port"]
+        """Connect to the peers of a re-announce the download is not using.
 
-        try:
-            # Connect to the peer
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            buffer_size = 1024 * 1024
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
-            s.connect((ip, port))
-
-            # Handshake with the peer
-            peer_communicator = PeerCommunicator(s)
-            peer_communicator.send_handshake(self.id, infohash)
-            # print(f"Sent handshake to {ip}:{port}")
-            handshake = peer_communicator.receive_handshake()
-            # print(f"Received handshake from {ip}:{port}")
-            infohash = handshake[28:48].hex()
-            peer_id = handshake[48:].decode("utf-8")
-
-            valid = peer_communicator.validate_handshake(handshake, infohash, peer_id)
-            if not valid:
-                raise Exception("Handshake failed")
-
-            # Successfully connected to the peer
-            with self.lock:
-                self.active_downloads[infohash]["num_connected_peers"] += 1
-            return s
-        except Exception as e:
-            print(e)
-            return None
+        That is peers it does not know yet and known peers whose worker
+        exited, in retired. Returns the new sessions, ready to download from.
+        Peers beyond the free connection slots are left for the next announce.
+        """
+        known = self._known_peers(infohash, retired)
+        connected_ids = {
+            session.peer_id
+            for session in connected_peers
+            if (session.peer["ip"], session.peer["port"]) not in retired
+        }
+        connected_ids.add(self.id)
 
-    def _get_rarest_pieces(self, bitfields):
-        """Returns a list of pieces ordered by rarity."""
-        piece_count = {}
+        free = self.resourceManager.free_connections(infohash)
+        new_peers = [
+            peer
+            for peer in peer_list
+            if (peer["ip"], peer["port"]) not in known
+            and peer["peer_id"] not in connected_ids
+        ][:free]
+        if not new_peers:
+            return []
+        print(f"Learned {len(new_peers)} new peers from the tracker")
+        return await self._admit_peers(
+            infohash, num_pieces, connected_peers, new_peers, retired
+        )
 
-        for bitfield in bitfields.values():
-            for idx, bit in enumerate(bitfield):
-                if bit == 1:
-                    piece_count[idx] = piece_count.get(idx, 0) + 1
+    async def _admit_pex_peers(
+        self,
+        infohash: str,
+        num_pieces: int,
+        connected_peers: list[PeerSession],
+        retired: set,
+    ):
+        """Connect to the peers our sessions learned through ut_pex.
 
-        # Sort pieces by rarity (ascending)
-        return [
-            piece for piece, _ in sorted(piece_count.items(), key=lambda item: item[1])
-        ]
+        Returns the new sessions, ready to download from. Every learned peer is
+        added to the download's peer list so it is only tried again once its
+        worker exits, see retired. Only as many peers are tried as there are
+        free connection slots, the others wait for a later round.
+        """
+        known = self._known_peers(infohash, retired)
+
+        new_peers = []
+        free = self.resourceManager.free_connections(infohash)
+        for session in connected_peers:
+            peer_communicator = session.peer_communicator
+            waiting = []
+            for ip, port in peer_communicator.pex_peers:
+                if (ip, port) in known:
+                    continue
+                if len(new_peers) < free:
+                    known.add((ip, port))
+                    new_peers.append({"peer_id": None, "ip": ip, "port": port})
+                else:
+                    waiting.append((ip, port))
+            peer_communicator.pex_peers[:] = waiting
+        if not new_peers:
+            return []
+        print(f"Learned {len(new_peers)} new peers through peer exchange")
+        return await self._admit_peers(
+            infohash, num_pieces, connected_peers, new_peers, retired
+        )
+
+    def _known_peers(self, infohash: str, retired: set):
+        """Addresses of the peers the download is using, ourselves included."""
+        with self.lock:
+            known = {
+                (peer["ip"], peer["port"])
+                for peer in self.active_downloads[infohash]["peer_list"]
+            }
+        known -= retired
+        known.add((self.uploadManager.ip, self.uploadManager.port))
+        return known
+
+    async def _admit_peers(
+        self,
+        infohash: str,
+        num_pieces: int,
+        connected_peers: list[PeerSession],
+        new_peers: list,
+        retired: set,
+    ):
+        """Add the peers to the download's peer list and connect to them.
+
+        Returns the sessions that exchanged bitfields, skipping ourselves and
+        peers we are already connected to under another address. Retired
+        peers admitted again are taken out of retired.
+        """
+        with self.lock:
+            peer_list = self.active_downloads[infohash]["peer_list"]
+            listed = {(peer["ip"], peer["port"]) for peer in peer_list}
+            peer_list.extend(
+                peer for peer in new_peers if (peer["ip"], peer["port"]) not in listed
+            )
+        connected_ids = {
+            session.peer_id
+            for session in connected_peers
+            if (session.peer["ip"], session.peer["port"]) not in retired
+        }
+        retired.difference_update((peer["ip"], peer["port"]) for peer in new_peers)
+        sessions = await asyncio.gather(
+            *(self.peerPool.connect(infohash, peer, wait=False) for peer in new_peers)
+        )
+        admitted = []
+        for session in sessions:
+            if session is None:
+                continue
+            if session.peer_id == self.id or session.peer_id in connected_ids:
+                # Ourselves or a peer we already have, under another address
+                await self.peerPool.discard(session)
+                continue
+            try:
+                await self.peerPool.exchange_bitfield(session, num_pieces)
+            except (ConnectionError, TimeoutError, OSError) as e:
+                print(f"[ERROR-DownloadManager-_admit_peers] {e}")
+                await self.peerPool.discard(session)
+                continue
+            admitted.append(session)
+        self._update_connected_peers(infohash)
+        return admitted
+
+    def _update_connected_peers(self, infohash: str):
+        """Refresh the connected peer count from the live pooled sessions."""
+        # A single assignment from the event loop, readers need no lock
+        download_info = self.active_downloads.get(infohash)
+        if download_info is not None:
+            download_info["num_connected_peers"] = len(
+                self.peerPool.get_sessions(infohash)
+            )
+
+    @staticmethod
+    def _downloaded(download_info: dict):
+        """Bytes downloaded so far, from the per-peer counters."""
+        return download_info["resumed_total"] + sum(
+            stats.completed for stats in list(download_info["peer_stats"].values())
+        )
+
+    def snapshot(self):
+        """Returns a DownloadStatus of every download, in one consistent order.
+
+        The counters are read without stopping the workers, so a piece that
+        completes meanwhile may or may not be counted.
+        """
+        with self.lock:
+            return tuple(
+                self._status(infohash, download_info)
+                for infohash, download_info in self.active_downloads.items()
+            )
+
+    def _status(self, infohash: str, download_info: dict):
+        worker = download_info["worker"]
+        if worker is not None and worker.status is not None:
+            # The worker's own DownloadManager counted it
+            return worker.status
+        return DownloadStatus(
+            infohash,
+            download_info["torrent"].name,
+            self._downloaded(download_info),
+            download_info["total"],
+            len(download_info["peer_list"]),
+            download_info["num_connected_peers"],
+            download_info["queued"],
+            tuple(
+                sorted(
+                    (
+                        stats.snapshot()
+                        for stats in download_info["peer_stats"].values()
+                    ),
+                    key=lambda status: status.score or 0,
+                    reverse=True,
+                )
+            ),
+        )
 
     def get_downloaded(self):
         """Returns the total downloaded data."""
-        downloaded = []
-        with self.lock:
-            for download_info in self.active_downloads.values():
-                downloaded.append(download_info["downloaded_total"])
-        return downloaded
+        return [status.downloaded for status in self.snapshot()]
 
     def get_total(self):
-        """Returns the total file size."""
-        total = []
-        with self.lock:
-            for download_info in self.active_downloads.values():
-                total.append(download_info["torrent"].size)
-        return total
+        """Returns the size of the pieces each download fetches."""
+        return [status.total for status in self.snapshot()]
 
     def get_num_peers(self):
         """Returns the number of peers."""
-        num_peers = []
-        with self.lock:
-            for download_info in self.active_downloads.values():
-                num_peers.append(len(download_info["peer_list"]))
-        return num_peers
+        return [status.num_peers for status in self.snapshot()]
 
     def get_num_connected_peers(self):
         """Returns the number of connected peers."""
-        num_connected_peers = []
+        return [status.num_connected_peers for status in self.snapshot()]
+
+    def get_peer_stats(self):
+        """Returns the PeerStatus of each download's peers, best score first."""
+        return [status.peers for status in self.snapshot()]
+
+    def get_banned_peers(self):
+        """Returns a BannedPeer for every peer banned for sending bad pieces."""
+        banned = self.peerBans.get_banned()
         with self.lock:
             for download_info in self.active_downloads.values():
-                num_connected_peers.append(download_info["num_connected_peers"])
-        return num_connected_peers
+                if download_info["worker"] is not None:
+                    # Bans of a worker process only hold in that process
+                    banned.extend(download_info["worker"].banned)
+        return banned
+
+    def get_memory_usage(self):
+        """Returns the piece data in memory, see ResourceManager.get_memory_usage."""
+        return self.resourceManager.get_memory_usage()
+
+    def get_torrents(self):
+        """Returns the torrents of the downloads."""
+        with self.lock:
+            return [
+                download_info["torrent"]
+                for download_info in self.active_downloads.values()
+            ]
+
+    def get_queued(self):
+        """Returns whether each download is still waiting for its turn."""
+        return [status.queued for status in self.snapshot()]
 
     def get_num_downloading(self):
         """Returns the number of downloading files."""
         return len(self.active_downloads)
 
     def get_file_names(self):
-        file_names = []
-        with self.lock:
-            for download_info in self.active_downloads.values():
-                file_names.append(download_info["torrent"].name)
-        return file_names
+        return [status.name for status in self.snapshot()]
@@ -5,24 +5,113 @@ from Torrent import Torrent
 
 class FileManager:
     @classmethod
-    def write_file(cls, destination, data, file_infos=None):
-        if file_infos is None:  # Single file mode
-            with open(destination, "wb") as f:
-                for _, piece_data in sorted(data.items()):
-                    f.write(piece_data)
-        else:  # Multi-file mode
-            offset = 0
-            concat_data = b"".join(piece_data for _, piece_data in sorted(data.items()))
-            for file_info in file_infos:
-                size = file_info[1]
-                write_path = os.path.join(destination, str(file_info[0]))
-                os.makedirs(
-                    os.path.dirname(write_path), exist_ok=True
-                )  # Ensure directories exist
-                with open(write_path, "wb") as f:
-                    file_data = concat_data[offset : offset + size]
-                    f.write(file_data)
-                offset += size
+    def allocate_files(cls, torrent: Torrent, destination, skipped=()):
+        """Create the torrent's files at their final size, keeping existing data.
+
+        Files in skipped are not created, see write_piece.
+        """
+        for path, size in torrent.files:
+            if path in skipped:
+                continue
+            file_path = os.path.join(destination, str(path))
+            os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+            with open(file_path, "r+b" if os.path.exists(file_path) else "wb") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() != size:
+                    f.truncate(size)
+
+    @classmethod
+    def piece_spans(cls, torrent: Torrent, piece_idx: int):
+        """Map a piece onto the files it covers.
+
+        Returns:
+            spans (list): (file path, offset in file, offset in piece, length)
+        """
+        piece_start = piece_idx * torrent.piece_size
+        piece_end = min(piece_start + torrent.piece_size, torrent.size)
+        spans = []
+        file_start = 0
+        for path, size in torrent.files:
+            file_end = file_start + size
+            if file_end > piece_start and file_start < piece_end:
+                start = max(piece_start, file_start)
+                end = min(piece_end, file_end)
+                spans.append(
+                    (path, start - file_start, start - piece_start, end - start)
+                )
+            if file_end >= piece_end:
+                break
+            file_start = file_end
+        return spans
+
+    @classmethod
+    def parts_path(cls, torrent: Torrent, destination):
+        """Sparse file holding the parts of pieces that fall in skipped files.
+
+        It is addressed by offset in the torrent, so a piece shared by a
+        selected and a skipped file can still be read back whole. It is kept
+        while such pieces are seeded, see delete_parts.
+        """
+        return os.path.join(destination, ".parts", torrent.infohash)
+
+    @classmethod
+    def delete_parts(cls, torrent: Torrent, destination):
+        """Remove the parts file once every file of the torrent is complete."""
+        parts_path = cls.parts_path(torrent, destination)
+        try:
+            os.remove(parts_path)
+        except FileNotFoundError:
+            pass
+        try:
+            # Only if no other torrent has parts left
+            os.rmdir(os.path.dirname(parts_path))
+        except OSError:
+            pass
+
+    @classmethod
+    def write_piece(
+        cls, torrent: Torrent, destination, piece_idx: int, piece_data, skipped=()
+    ):
+        """Write a verified piece straight to its place in the destination files.
+
+        The parts of the piece that belong to skipped files go to the parts file.
+        """
+        piece_data = memoryview(piece_data)
+        for path, file_offset, piece_offset, length in cls.piece_spans(
+            torrent, piece_idx
+        ):
+            if path in skipped:
+                parts_path = cls.parts_path(torrent, destination)
+                os.makedirs(os.path.dirname(parts_path), exist_ok=True)
+                fd = os.open(parts_path, os.O_WRONLY | os.O_CREAT, 0o644)
+                file_offset = piece_idx * torrent.piece_size + piece_offset
+            else:
+                fd = os.open(os.path.join(destination, str(path)), os.O_WRONLY)
+            try:
+                chunk = piece_data[piece_offset : piece_offset + length]
+                while chunk:
+                    written = os.pwrite(fd, chunk, file_offset)
+                    chunk = chunk[written:]
+                    file_offset += written
+            finally:
+                os.close(fd)
+
+    @classmethod
+    def read_piece(cls, torrent: Torrent, source, piece_idx: int, skipped=()):
+        """Read one piece from the files it spans, and from the parts file."""
+        chunks = []
+        for path, file_offset, piece_offset, length in cls.piece_spans(
+            torrent, piece_idx
+        ):
+            if path in skipped:
+                file_path = cls.parts_path(torrent, source)
+                file_offset = piece_idx * torrent.piece_size + piece_offset
+            else:
+                file_path = os.path.join(source, str(path))
+            with open(file_path, "rb") as f:
+                f.seek(file_offset)
+                chunks.append(f.read(length))
+        return b"".join(chunks)
 
     @classmethod
     def list_files(cls, path):
@@ -55,30 +144,3 @@ class FileManager:
         for file in files:
             if Torrent.read(torrent_dir + file).infohash == infohash:
                 return original_dir + Torrent.read(torrent_dir + file).name
-
-    @classmethod
-    def create_file_tree(cls, torrent: Torrent, dest_path):
-        cls._process_file_tree(torrent.filetree, dest_path)
-
-    @staticmethod
-    def _process_file_tree(tree, base_path):
-        for item, value in tree.items():
-            if isinstance(value, dict):  # Directory
-                dir_path = os.path.join(base_path, item)
-                FileManager._create_directory(dir_path)
-                FileManager._process_file_tree(value, dir_path)
-            else:  # File
-                file_path = os.path.join(base_path, item)
-                FileManager._create_file(file_path)
-
-    @staticmethod
-    def _create_directory(path):
-        try:
-            os.makedirs(path)
-        except FileExistsError:
-            pass
-
-    @staticmethod
-    def _create_file(path):
-        with open(path, "w"):
-            pass
@@ -0,0 +1,77 @@
+import threading
+import time
+from typing import NamedTuple
+
+
+class BannedPeer(NamedTuple):
+    """A ban in force, see PeerBans.get_banned."""
+
+    ip: str
+    port: int
+    hash_failures: int
+    # Seconds until the ban ends
+    expires_in: float
+
+
+class PeerBans:
+    """Peers that sent pieces failing their hash check, shared by every torrent.
+
+    Pieces are requested whole from a single peer, so a piece that fails its
+    hash check is always the fault of the peer that sent it. Peers are keyed
+    by address. Once a peer has sent max_hash_failures bad pieces, over any
+    number of torrents, it is banned for ban_duration seconds and no new
+    connections are made to it. Its count starts over when the ban ends.
+
+    Failures are added from the peer engine's event loop; the bans are also
+    read by the user interface, under a lock.
+    """
+
+    def __init__(self, max_hash_failures=3, ban_duration=1800.0):
+        self.max_hash_failures = max_hash_failures
+        self.ban_duration = ban_duration
+        self.hash_failures: dict[tuple[str, int], int] = {}
+        # Address -> (monotonic time the ban ends, bad pieces that caused it)
+        self.bans: dict[tuple[str, int], tuple[float, int]] = {}
+        self.lock = threading.Lock()
+
+    def add_hash_failure(self, ip: str, port: int):
+        """Count a bad piece from the peer, returns True if it is now banned."""
+        address = (ip, port)
+        with self.lock:
+            if self._is_banned(address):
+                return True
+            failures = self.hash_failures.get(address, 0) + 1
+            if failures < self.max_hash_failures:
+                self.hash_failures[address] = failures
+                return False
+            del self.hash_failures[address]
+            self.bans[address] = (time.monotonic() + self.ban_duration, failures)
+            return True
+
+    def is_banned(self, ip: str, port: int):
+        with self.lock:
+            return self._is_banned((ip, port))
+
+    def unban(self, ip: str, port: int):
+        with self.lock:
+            self.bans.pop((ip, port), None)
+
+    def get_banned(self):
+        """Returns a BannedPeer for every ban in force, longest first."""
+        now = time.monotonic()
+        with self.lock:
+            banned = [
+                BannedPeer(ip, port, failures, expires - now)
+                for (ip, port), (expires, failures) in self.bans.items()
+                if expires > now
+            ]
+        return sorted(banned, key=lambda ban: ban.expires_in, reverse=True)
+
+    def _is_banned(self, address: tuple[str, int]):
+        ban = self.bans.get(address)
+        if ban is None:
+            return False
+        if ban[0] <= time.monotonic():
+            del self.bans[address]
+            return False
+        return True
@@ -1,25 +1,133 @@
+import asyncio
+import hashlib
+import socket
 import struct
 import time
-import select
-from socket import socket
+import zlib
+
+import bencodepy
+
+from SessionTimeouts import SessionTimeouts
+
+# Extensions negotiated through the handshake reserved bytes: name -> (byte, mask)
+EXTENSION_BITS = {
+    "compression": (7, 0x20),
+    "fast": (7, 0x04),
+    "extended": (5, 0x10),
+}
+SUPPORTED_EXTENSIONS = frozenset(EXTENSION_BITS)
+
+# Fast Extension (BEP 6) message ids
+HAVE_ALL = 0x0E
+HAVE_NONE = 0x0F
+REJECT_REQUEST = 0x10
+ALLOWED_FAST = 0x11
+
+# Extension protocol (BEP 10) message id and the extended messages we understand,
+# with the ids peers should use when sending them to us
+EXTENDED = 20
+EXTENDED_MESSAGES = {"ut_pex": 1}
+# BEP 11 caps the number of peers added by one message
+MAX_PEX_PEERS = 50
+
+# Upper bound for a decompressed piece, guards against decompression bombs
+MAX_DECOMPRESSED_PIECE = 64 * 1024 * 1024
+
+
+class RequestRejected(Exception):
+    """The peer explicitly rejected a piece request (Fast Extension)."""
+
+    def __init__(self, piece_index: int):
+        super().__init__(f"Request for piece {piece_index} rejected")
+        self.piece_index = piece_index
+
+
+def allowed_fast_set(ip: str, infohash: str, num_pieces: int, k=10):
+    """The canonical allowed-fast set of a peer as described in BEP 6.
+
+    The set only depends on the peer's /24 network and the torrent, so a peer
+    cannot get a larger set by reconnecting from another port or address.
+    """
+    k = min(k, num_pieces)
+    allowed = []
+    x = bytes(int(part) for part in ip.split(".")[:3]) + b"\x00"
+    x += bytes.fromhex(infohash)
+    while len(allowed) < k:
+        x = hashlib.sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(allowed) == k:
+                break
+            index = struct.unpack(">I", x[i : i + 4])[0] % num_pieces
+            if index not in allowed:
+                allowed.append(index)
+    return allowed
 
 
 class PeerCommunicator:
-    def __init__(self, socket: socket, timeout=10, max_retries=5):
-        self.socket = socket
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        timeout=10,
+        max_retries=5,
+        extensions=SUPPORTED_EXTENSIONS,
+        timeouts: SessionTimeouts | None = None,
+    ):
+        self.reader = reader
+        self.writer = writer
+        # Idle limit for a single read, receive_piece applies tighter deadlines
         self.timeout = timeout
         self.max_retries = max_retries
+        self.timeouts = timeouts or SessionTimeouts()
+        self.handshake_sent_at: float | None = None
+        # When the last piece finished, a pipelined request waits for it
+        self.last_piece_at = 0.0
+        # Time spent waiting on the download rate limit, not held against the peer
+        self.throttled_time = 0.0
+        self.local_extensions = frozenset(extensions)
+        self.peer_extensions: frozenset = frozenset()
+        # Set by the managers once the torrent is known, see RateLimiter.session
+        self.limiter = None
+        # What the peer told us about itself, updated as its messages arrive
+        self.peer_choking = True
+        self.allowed_fast: set[int] = set()
+        # Outstanding requests in the order they were sent, with their send time
+        self.requested_pieces: dict[int, float] = {}
+        # Pieces the peer announced with HAVE, drained by the download worker
+        self.peer_haves: list[int] = []
+        # Requests the peer cancelled, checked while their pieces are sent
+        self.cancelled_requests: set[int] = set()
+        # Extension protocol state: the peer's message ids and listen port,
+        # and swarm members it told us about through ut_pex
+        self.peer_extended_ids: dict[str, int] | None = None
+        self.peer_listen_port: int | None = None
+        self.pex_peers: list[tuple[str, int]] = []
+
+    @property
+    def extensions(self):
+        """Extensions supported by both sides of the connection."""
+        return self.local_extensions & self.peer_extensions
+
+    def supports(self, extension: str):
+        return extension in self.extensions
+
+    async def _read_exactly(self, num_bytes):
+        """Read exactly num_bytes from the peer, giving up after timeout * max_retries idle seconds."""
+        try:
+            async with asyncio.timeout(self.timeout * self.max_retries):
+                return await self.reader.readexactly(num_bytes)
+        except TimeoutError:
+            raise TimeoutError("Multiple attempts to wait for data failed")
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Peer disconnected")
 
-    def _wait_for_data(self):
-        """Wait for data with retries, returns True if data is ready."""
-        for attempt in range(self.max_retries):
-            try:
-                ready, _, _ = select.select([self.socket], [], [], self.timeout)
-                if ready:
-                    return True
-            except Exception as e:
-                print(f"Wait for data error (attempt {attempt + 1}): {e}")
-        raise TimeoutError("Multiple attempts to wait for data failed")
+    async def close(self):
+        """Close the connection to the peer."""
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
 
     def validate_handshake(self, peer_handshake, expected_info_hash, expected_peer_id):
         """Validate the handshake received from the peer."""
@@ -50,67 +158,321 @@ class PeerCommunicator:
 
         return True
 
-    def send_handshake(self, id: str, infohash: str):
+    async def send_handshake(self, id: str, infohash: str):
         """Send a handshake to the peer."""
         pstrlen = struct.pack("B", 19)
         pstr = b"BitTorrent protocol"
-        reserved = b"\x00" * 8
+        reserved = bytearray(8)
+        for extension in self.local_extensions:
+            byte, mask = EXTENSION_BITS[extension]
+            reserved[byte] |= mask
         infohash_as_bytes = bytes.fromhex(infohash)
         peer_id = id.encode("utf-8")
-        handshake = pstrlen + pstr + reserved + infohash_as_bytes + peer_id
-        self.socket.send(handshake)
-
-    def receive_handshake(self):
-        """Receive the handshake from the peer."""
-        self._wait_for_data()
-        return self.socket.recv(68)
-
-    def _send_message(self, message_id, payload=None):
+        handshake = pstrlen + pstr + bytes(reserved) + infohash_as_bytes + peer_id
+        self.handshake_sent_at = time.monotonic()
+        self.writer.write(handshake)
+        await self.writer.drain()
+
+    async def receive_handshake(self):
+        """Receive the handshake from the peer and note the extensions it supports.
+
+        If we sent our handshake first, the reply must arrive within the
+        session's handshake deadline and is used as a round-trip sample.
+        """
+        if self.handshake_sent_at is None:
+            handshake = await self._read_exactly(68)
+        else:
+            timeout = self.timeouts.handshake()
+            try:
+                async with asyncio.timeout(timeout):
+                    handshake = await self._read_exactly(68)
+            except TimeoutError:
+                raise TimeoutError(f"No handshake within {timeout:.1f}s")
+            self.timeouts.add_rtt_sample(time.monotonic() - self.handshake_sent_at)
+        self.note_extensions(handshake)
+        return handshake
+
+    def note_extensions(self, handshake: bytes):
+        """Note the extensions the peer supports from its handshake."""
+        reserved = handshake[20:28]
+        self.peer_extensions = frozenset(
+            extension
+            for extension, (byte, mask) in EXTENSION_BITS.items()
+            if reserved[byte] & mask
+        )
+
+    async def _send_message(self, message_id, payload=None):
         """Helper function to send messages with or without payload."""
         length = len(payload) + 1 if payload else 1
         message = struct.pack(">I", length) + struct.pack(">B", message_id)
         if payload:
             message += payload
-        self.socket.send(message)
-
-    def _receive_message(self):
-        """Helper function to receive messages."""
-        self._wait_for_data()
-        length_bytes = self.socket.recv(4)
-        if not length_bytes:
-            raise ConnectionError("Peer disconnected")
-        length = struct.unpack(">I", length_bytes)[0]
-        message_id = struct.unpack(">B", self.socket.recv(1))[0]
-        payload = self.socket.recv(length - 1) if length > 1 else b""
+        if self.limiter is not None:
+            await self.limiter.throttle_upload(len(message))
+        self.writer.write(message)
+        await self.writer.drain()
+
+    async def _receive_message(self):
+        """Helper function to receive messages, skipping keep-alives."""
+        length = 0
+        while length == 0:
+            length_bytes = await self._read_exactly(4)
+            length = struct.unpack(">I", length_bytes)[0]
+        return await self._receive_message_body(length)
+
+    async def _receive_message_body(self, length):
+        """Receive the rest of a message whose length prefix has been read."""
+        if self.limiter is not None:
+            self.throttled_time += await self.limiter.throttle_download(length + 4)
+        message_id = struct.unpack(">B", await self._read_exactly(1))[0]
+        payload = await self._read_exactly(length - 1) if length > 1 else b""
         return message_id, payload
 
-    def send_choke(self):
-        self._send_message(0)
-
-    def send_unchoke(self):
-        self._send_message(1)
-
-    def send_interested(self):
-        self._send_message(2)
-
-    def send_not_interested(self):
-        self._send_message(3)
-
-    def send_have(self, piece_index):
+    async def receive_message(self):
+        """Receive the next message as a (message_id, payload) pair."""
+        return await self._receive_message()
+
+    async def wait_for_haves(self, wake: asyncio.Event, timeout: float):
+        """Handle the peer's messages while no request is out.
+
+        Returns True once the peer announces a piece, unchokes us, allows a
+        fast piece or wake is set, and False after timeout seconds. Only the
+        wait for a message's length prefix is interrupted, so a message is
+        never cut in half.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        woken = asyncio.create_task(wake.wait())
+        length_prefix = None
+        choking = self.peer_choking
+        num_allowed_fast = len(self.allowed_fast)
+        try:
+            while (
+                not self.peer_haves
+                and self.peer_choking == choking
+                and len(self.allowed_fast) == num_allowed_fast
+            ):
+                length_prefix = asyncio.create_task(self._read_exactly(4))
+                done, _ = await asyncio.wait(
+                    {length_prefix, woken},
+                    timeout=max(deadline - loop.time(), 0),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if length_prefix not in done:
+                    return woken in done
+                length = struct.unpack(">I", length_prefix.result())[0]
+                if length == 0:
+                    continue
+                message_id, payload = await self._receive_message_body(length)
+                self._handle_control_message(message_id, payload)
+            return True
+        finally:
+            woken.cancel()
+            if length_prefix is not None and not length_prefix.done():
+                # Wait for the read to let go of the stream, or the next read
+                # of the session finds it still waiting for data
+                length_prefix.cancel()
+                await asyncio.wait({length_prefix})
+
+    async def send_keep_alive(self):
+        """Send a zero-length keep-alive message."""
+        self.writer.write(struct.pack(">I", 0))
+        await self.writer.drain()
+
+    async def send_choke(self):
+        await self._send_message(0)
+
+    async def send_unchoke(self):
+        await self._send_message(1)
+
+    async def send_interested(self):
+        await self._send_message(2)
+
+    async def send_not_interested(self):
+        await self._send_message(3)
+
+    async def send_have(self, piece_index):
         """Send a 'have' message indicating the peer has a piece."""
-        self._send_message(4, struct.pack(">I", piece_index))
+        await self._send_message(4, struct.pack(">I", piece_index))
 
-    def send_bitfield(self, bitfield):
+    async def send_bitfield(self, bitfield):
         """Send the bitfield indicating the pieces the peer has."""
-        self._send_message(5, bitfield)
+        await self._send_message(5, bitfield)
 
-    def send_request(self, piece_index):
+    async def send_request(self, piece_index):
         """Send a request for a specific piece from the peer."""
         # print(f"PeerCommunicator: Sending request for piece {piece_index}")
-        self._send_message(6, struct.pack(">I", piece_index))
+        await self._send_message(6, struct.pack(">I", piece_index))
+        self.requested_pieces[piece_index] = time.monotonic()
+
+    async def send_cancel(self, piece_index):
+        """Cancel a request, the peer answers with a reject or an empty last block."""
+        await self._send_message(8, struct.pack(">I", piece_index))
+
+    async def send_cancelled_piece(self, piece_index):
+        """End the answer to a cancelled request without sending its data."""
+        if self.supports("fast"):
+            await self.send_reject_request(piece_index)
+        else:
+            await self._send_message(
+                7, struct.pack(">I", piece_index) + struct.pack(">B", 1)
+            )
 
-    def send_piece(self, piece_index, piece_data):
-        """Send a piece of data, divided into blocks."""
+    async def send_have_all(self):
+        """Tell the peer we have every piece instead of sending a full bitfield."""
+        await self._send_message(HAVE_ALL)
+
+    async def send_have_none(self):
+        """Tell the peer we have no pieces yet."""
+        await self._send_message(HAVE_NONE)
+
+    async def send_reject_request(self, piece_index):
+        """Tell the peer its request for the piece will not be served."""
+        await self._send_message(REJECT_REQUEST, struct.pack(">I", piece_index))
+
+    async def send_allowed_fast(self, piece_index):
+        """Let the peer request the piece even while it is choked."""
+        await self._send_message(ALLOWED_FAST, struct.pack(">I", piece_index))
+
+    async def receive_session_start(
+        self, num_pieces: int, listen_port: int | None = None
+    ) -> bytes:
+        """Run the downloader side of the session start, returns the peer's bitfield.
+
+        Without the Fast Extension the peer unchokes us, we declare interest and
+        it sends its bitfield, in that order. With it, the peer sends its
+        bitfield (or have_all / have_none) right after the handshake and may
+        send allowed-fast pieces and an unchoke around it in any order; we
+        do not wait for the unchoke, since allowed-fast pieces can be
+        requested while choked.
+
+        With the extension protocol both sides then swap extended handshakes,
+        the seeder sending its own right after the bitfield.
+        """
+        if not self.supports("fast"):
+            await self.receive_unchoke()
+            await self.send_interested()
+            bitfield = await self.receive_bitfield()
+        else:
+            bitfield = None
+            while bitfield is None:
+                message_id, payload = await self._receive_message()
+                if message_id == 5:
+                    bitfield = payload
+                elif message_id == HAVE_ALL:
+                    bitfield = bytes([1]) * num_pieces
+                elif message_id == HAVE_NONE:
+                    bitfield = bytes(num_pieces)
+                else:
+                    self._handle_control_message(message_id, payload)
+            await self.send_interested()
+
+        if self.supports("extended"):
+            await self.send_extended_handshake(listen_port)
+            await self.receive_extended_handshake()
+        return bitfield
+
+    async def send_extended_handshake(self, listen_port: int | None = None):
+        """Announce the extended messages we support and the port we listen on."""
+        handshake = {"m": EXTENDED_MESSAGES, "v": "CNET"}
+        if listen_port is not None:
+            handshake["p"] = listen_port
+        await self._send_message(EXTENDED, b"\x00" + bencodepy.encode(handshake))
+
+    async def receive_extended_handshake(self):
+        """Read messages until the peer's extended handshake has arrived."""
+        while self.peer_extended_ids is None:
+            message_id, payload = await self._receive_message()
+            self._handle_control_message(message_id, payload)
+
+    async def send_pex(self, peers):
+        """Send swarm members as a ut_pex message, if the peer understands it.
+
+        peers is a list of (ip, port) pairs; only IPv4 addresses fit the
+        compact format and at most MAX_PEX_PEERS are sent.
+        """
+        if not peers or not self.peer_extended_ids:
+            return
+        ext_id = self.peer_extended_ids.get("ut_pex")
+        if not ext_id:
+            return
+        added = b""
+        for ip, port in peers[:MAX_PEX_PEERS]:
+            try:
+                added += socket.inet_aton(ip) + struct.pack(">H", port)
+            except OSError:
+                continue
+        message = {"added": added, "added.f": bytes(len(added) // 6), "dropped": b""}
+        await self._send_message(EXTENDED, bytes([ext_id]) + bencodepy.encode(message))
+
+    def handle_extended(self, payload):
+        """Process an extended message, returns its name or None if unknown.
+
+        The extended handshake sets peer_extended_ids and peer_listen_port;
+        peers from ut_pex messages are appended to pex_peers.
+        """
+        if not payload:
+            return None
+        try:
+            message = bencodepy.decode(bytes(payload[1:]))
+        except bencodepy.DecodingError as e:
+            print(f"[ERROR-PeerCommunicator-handle_extended] {e}")
+            return None
+        if not isinstance(message, dict):
+            return None
+        if payload[0] == 0:
+            ids = message.get(b"m")
+            self.peer_extended_ids = {
+                name.decode("utf-8", "replace"): ext_id
+                for name, ext_id in (ids.items() if isinstance(ids, dict) else ())
+                if isinstance(ext_id, int) and 0 < ext_id < 256
+            }
+            port = message.get(b"p")
+            if isinstance(port, int) and 0 < port < 65536:
+                self.peer_listen_port = port
+            return "handshake"
+        if payload[0] == EXTENDED_MESSAGES["ut_pex"]:
+            added = message.get(b"added", b"")
+            if not isinstance(added, bytes):
+                return None
+            for i in range(0, len(added) - len(added) % 6, 6):
+                ip = socket.inet_ntoa(added[i : i + 4])
+                port = struct.unpack(">H", added[i + 4 : i + 6])[0]
+                self.pex_peers.append((ip, port))
+            return "ut_pex"
+        return None
+
+    def _handle_control_message(self, message_id, payload):
+        """Track choke state, new pieces, allowed-fast pieces and extended messages."""
+        if message_id == EXTENDED:
+            self.handle_extended(payload)
+        elif message_id == 4:
+            self.peer_haves.append(struct.unpack(">I", payload)[0])
+        elif message_id == 0:
+            self.peer_choking = True
+        elif message_id == 1:
+            self.peer_choking = False
+        elif message_id == ALLOWED_FAST:
+            self.allowed_fast.add(struct.unpack(">I", payload)[0])
+
+    async def send_compressed_piece(self, piece_index, raw_size, compressed_data):
+        """Send a zlib-compressed piece, divided into blocks.
+
+        Only valid once the 'compression' extension has been negotiated.
+        """
+        return await self.send_piece(
+            piece_index,
+            compressed_data,
+            message_id=24,
+            header=struct.pack(">I", raw_size),
+        )
+
+    async def send_piece(self, piece_index, piece_data, message_id=7, header=b""):
+        """Send a piece of data, divided into blocks.
+
+        Stops early if the peer cancels the request meanwhile, returns True if
+        the whole piece was sent.
+        """
         block_size = 4 * 1024
         divided_piece = [
             piece_data[i : i + block_size]
@@ -119,94 +481,235 @@ class PeerCommunicator:
 
         try:
             for i, piece_block in enumerate(divided_piece):
+                if piece_index in self.cancelled_requests:
+                    self.cancelled_requests.discard(piece_index)
+                    await self.send_cancelled_piece(piece_index)
+                    return False
                 is_last_block = 1 if i == len(divided_piece) - 1 else 0
                 payload = (
                     struct.pack(">I", piece_index)
                     + struct.pack(">B", is_last_block)
+                    + header
                     + piece_block
                 )
                 try:
-                    self._send_message(7, payload)
+                    await self._send_message(message_id, payload)
                 except (ConnectionResetError, BrokenPipeError):
                     print(f"Connection lost while sending piece {piece_index}")
                     raise
+            return True
 
         except Exception as e:
             print(f"Error sending piece {piece_index}: {e}")
             raise
 
-    def receive_message_type(self):
+    async def receive_message_type(self):
         """Receive and return the message type from the peer."""
-        self._wait_for_data()
-        message_id, _ = self._receive_message()
+        message_id, _ = await self._receive_message()
         return message_id
 
-    def receive_have(self):
+    async def receive_have(self):
         """Receive a 'have' message and return the piece index."""
-        self._wait_for_data()
-        _, payload = self._receive_message()
+        _, payload = await self._receive_message()
         return struct.unpack(">I", payload)[0]
 
-    def receive_bitfield(self) -> bytes:
+    async def receive_bitfield(self) -> bytes:
         """Receive a bitfield from the peer."""
-        self._wait_for_data()
-        _, payload = self._receive_message()
+        _, payload = await self._receive_message()
         return payload
 
-    def receive_request(self):
+    async def receive_request(self):
         """Receive a 'request' message and return the piece index requested."""
-        self._wait_for_data()
-        _, payload = self._receive_message()
+        _, payload = await self._receive_message()
         if not payload:
             return None
         piece_index = struct.unpack(">I", payload)[0]
         # print(f"PeerCommunicator: Received request for piece {piece_index}")
         return piece_index
 
-    def receive_piece(self):
-        """Receive a piece from the peer, handling multiple chunks."""
-        chunks = []
-        piece_index = None
-
-        while True:
-            try:
-                self._wait_for_data()
-                _, payload = self._receive_message()
+    async def receive_piece(self, piece_size=None):
+        """Receive a piece from the peer, handling multiple chunks.
 
-                if piece_index is None:
-                    piece_index = struct.unpack(">I", payload[:4])[0]
+        Compressed pieces are decompressed before they are returned, so the
+        caller always verifies the original piece data.
+        """
+        chunks = []
 
-                is_last_chunk = struct.unpack(">B", payload[4:5])[0]
-                chunks.append(payload[5:])
+        def on_block(payload):
+            chunks.append(payload)
 
-                if is_last_chunk == 1:
-                    break
-                time.sleep(0.003)
-            except Exception as e:
-                print(f"Error receiving piece: {e}")
-                raise
+        piece_index, raw_size = await self._receive_blocks(piece_size, on_block)
 
         # Join all chunks into the final piece data
         piece_data = b"".join(chunks)
+        if raw_size is not None:
+            piece_data = await asyncio.to_thread(
+                self._decompress_piece, piece_data, raw_size
+            )
         # print(f"Received piece {piece_index}")
         return piece_index, piece_data
 
-    def receive_choke(self):
+    async def receive_piece_into(self, buffer, piece_size=None):
+        """Receive a piece straight into a preallocated staging buffer.
+
+        Each block is copied once into its place in buffer and hashed as it
+        arrives, so the piece never exists as a list of chunks or a joined
+        copy. Returns the piece index, the number of bytes received and the
+        SHA-1 digest of those bytes.
+        """
+        staging = memoryview(buffer)
+        hasher = hashlib.sha1()
+        compressed = []
+        received = 0
+        overflow = False
+
+        def on_block(payload):
+            nonlocal received, overflow
+            if overflow:
+                return
+            end = received + len(payload)
+            if end > len(staging):
+                overflow = True
+                return
+            staging[received:end] = payload
+            hasher.update(payload)
+            received = end
+
+        def on_compressed_block(payload):
+            compressed.append(payload)
+
+        piece_index, raw_size = await self._receive_blocks(
+            piece_size, on_block, on_compressed_block
+        )
+        if overflow:
+            raise ValueError("Piece is larger than the staging buffer")
+
+        if raw_size is not None:
+            if raw_size > len(staging):
+                raise ValueError("Piece is larger than the staging buffer")
+            piece_data = await asyncio.to_thread(
+                self._decompress_piece, b"".join(compressed), raw_size
+            )
+            staging[:raw_size] = piece_data
+            hasher = hashlib.sha1(staging[:raw_size])
+            received = raw_size
+
+        return piece_index, received, hasher.digest()
+
+    async def _receive_blocks(self, piece_size, on_block, on_compressed_block=None):
+        """Read the blocks of one piece, passing each block's data to a callback.
+
+        The first block must arrive within the session's first-byte deadline
+        and, when piece_size is given, the rest within the piece deadline.
+        Both adapt to the round-trip time and throughput measured so far.
+        Returns the piece index and, for a compressed piece, its raw size.
+        """
+        piece_index = None
+        raw_size = None
+        received = 0
+        # A pipelined request is only served once the piece before it is done
+        requested_at = max(
+            min(self.requested_pieces.values(), default=time.monotonic()),
+            self.last_piece_at,
+        )
+        first_byte_at = None
+        throttled_at_start = self.throttled_time
+
+        timeout = self.timeouts.first_byte()
+        deadline = asyncio.timeout(timeout)
+        try:
+            async with deadline:
+                while True:
+                    throttled_before = self.throttled_time
+                    message_id, payload = await self._receive_message()
+                    if message_id not in (7, 24):
+                        if message_id == REJECT_REQUEST:
+                            rejected = struct.unpack(">I", payload)[0]
+                            if rejected in self.requested_pieces:
+                                del self.requested_pieces[rejected]
+                                raise RequestRejected(rejected)
+                        self._handle_control_message(message_id, payload)
+                        continue
+                    payload = memoryview(payload)
+
+                    if first_byte_at is None:
+                        first_byte_at = time.monotonic()
+                        throttled_at_start = self.throttled_time
+                        self.timeouts.add_rtt_sample(first_byte_at - requested_at)
+                        if piece_size is None:
+                            deadline.reschedule(None)
+                        else:
+                            timeout = self.timeouts.piece(piece_size)
+                            deadline.reschedule(
+                                asyncio.get_running_loop().time() + timeout
+                            )
+                    elif self.throttled_time > throttled_before:
+                        # Waiting on our own rate limit does not count against the peer
+                        if deadline.when() is not None:
+                            deadline.reschedule(
+                                deadline.when() + self.throttled_time - throttled_before
+                            )
+
+                    if piece_index is None:
+                        piece_index = struct.unpack(">I", payload[:4])[0]
+
+                    is_last_chunk = payload[4]
+                    if message_id == 24:
+                        raw_size = struct.unpack(">I", payload[5:9])[0]
+                        block = payload[9:]
+                        (on_compressed_block or on_block)(block)
+                    else:
+                        block = payload[5:]
+                        on_block(block)
+                    received += len(block)
+
+                    if is_last_chunk == 1:
+                        break
+        except TimeoutError:
+            stage = "first byte" if first_byte_at is None else "full piece"
+            print(f"Error receiving piece: no {stage} within {timeout:.1f}s")
+            raise TimeoutError(f"No {stage} within {timeout:.1f}s")
+        except RequestRejected:
+            raise
+        except Exception as e:
+            print(f"Error receiving piece: {e}")
+            raise
+
+        self.requested_pieces.pop(piece_index, None)
+        self.last_piece_at = time.monotonic()
+        self.timeouts.add_throughput_sample(
+            received,
+            self.last_piece_at
+            - first_byte_at
+            - (self.throttled_time - throttled_at_start),
+        )
+        return piece_index, raw_size
+
+    @staticmethod
+    def _decompress_piece(compressed_data, raw_size):
+        if raw_size > MAX_DECOMPRESSED_PIECE:
+            raise ValueError(f"Compressed piece too large: {raw_size} bytes")
+        decompressor = zlib.decompressobj()
+        piece_data = decompressor.decompress(compressed_data, raw_size)
+        if len(piece_data) != raw_size or decompressor.unconsumed_tail:
+            raise ValueError("Compressed piece does not match its declared size")
+        return piece_data
+
+    async def receive_choke(self):
         """Receive a 'choke' message."""
-        self._wait_for_data()
-        return self.receive_message_type() == 0
+        return await self.receive_message_type() == 0
 
-    def receive_unchoke(self):
+    async def receive_unchoke(self):
         """Receive an 'unchoke' message."""
-        self._wait_for_data()
-        return self.receive_message_type() == 1
+        unchoked = await self.receive_message_type() == 1
+        if unchoked:
+            self.peer_choking = False
+        return unchoked
 
-    def receive_interested(self):
+    async def receive_interested(self):
         """Receive an 'interested' message."""
-        self._wait_for_data()
-        return self.receive_message_type() == 2
+        return await self.receive_message_type() == 2
 
-    def receive_not_interested(self):
+    async def receive_not_interested(self):
         """Receive a 'not interested' message."""
-        self._wait_for_data()
-        return self.receive_message_type() == 3
+        return await self.receive_message_type() == 3
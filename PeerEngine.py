@@ -0,0 +1,50 @@
+import asyncio
+import threading
+from concurrent.futures import Executor, Future
+
+
+class PeerEngine:
+    """Owns the single asyncio event loop that runs every peer session.
+
+    Upload and download sessions are coroutines scheduled on this loop, so the
+    number of OS threads no longer grows with the number of connected peers.
+    Blocking work (disk I/O, hashing, tracker requests) is pushed to the loop's
+    default executor with ``asyncio.to_thread``, which can be a shared, bounded
+    executor such as ResourceManager.executor.
+    """
+
+    def __init__(self, executor: Executor | None = None):
+        self.loop = asyncio.new_event_loop()
+        if executor is not None:
+            self.loop.set_default_executor(executor)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start the event loop in a background thread."""
+        self.thread.start()
+
+    def stop(self):
+        """Cancel every pending session and stop the event loop."""
+        if not self.loop.is_running():
+            return
+        self.submit(self._cancel_tasks()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def submit(self, coro) -> Future:
+        """Schedule a coroutine on the loop from any thread."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, callback, *args):
+        """Schedule a plain callback on the loop from any thread."""
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    async def _cancel_tasks(self):
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
@@ -0,0 +1,256 @@
+import asyncio
+import socket
+import time
+
+from PeerBans import PeerBans
+from PeerCommunicator import PeerCommunicator, SUPPORTED_EXTENSIONS
+from RateLimiter import RateLimiter
+from ResourceManager import ResourceManager
+from SessionTimeouts import SessionTimeouts
+
+
+class PeerSession:
+    """A handshaked connection to one peer for one torrent."""
+
+    def __init__(self, infohash: str, peer: dict, peer_communicator: PeerCommunicator):
+        self.infohash = infohash
+        self.peer = peer
+        self.peer_communicator = peer_communicator
+        self.bitfield: bytes = b""
+        self.in_use = False
+        self.last_active = time.monotonic()
+        self.keepalive_task: asyncio.Task | None = None
+        # Whether the session still holds its ResourceManager connection slot
+        self.holds_connection = False
+
+    @property
+    def peer_id(self):
+        return self.peer["peer_id"]
+
+    def is_alive(self):
+        """A session is alive until either side closes the connection."""
+        return not (
+            self.peer_communicator.writer.is_closing()
+            or self.peer_communicator.reader.at_eof()
+        )
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+
+class PeerPool:
+    """Keeps handshaked, unchoked peer sessions open for the whole download.
+
+    Sessions are keyed by (infohash, peer_id) and shared by every download of
+    the DownloadManager. Idle sessions send keep-alive messages so that dead
+    peers are noticed, and a session is only re-established when the old
+    connection is gone. Every session holds one of the ResourceManager's
+    connection slots until it is discarded. Banned peers are not connected to.
+    """
+
+    def __init__(
+        self,
+        id: str,
+        rateLimiter: RateLimiter,
+        keepalive_interval=15,
+        extensions=SUPPORTED_EXTENSIONS,
+        listen_port: int | None = None,
+        resourceManager: ResourceManager | None = None,
+        peerBans: PeerBans | None = None,
+    ):
+        self.id = id
+        self.resourceManager = resourceManager or ResourceManager()
+        self.peerBans = peerBans or PeerBans()
+        # Our upload server's port, told to peers in the extended handshake
+        self.listen_port = listen_port
+        self.rateLimiter = rateLimiter
+        self.extensions = extensions
+        self.keepalive_interval = keepalive_interval
+        self.sessions: dict[tuple[str, str], PeerSession] = {}
+        # Measured timings outlive a session, so reconnects start from them
+        self.timeouts: dict[tuple[str, int], SessionTimeouts] = {}
+
+    async def acquire(self, infohash: str, peer: dict, num_pieces: int):
+        """Return a live session with the peer, reconnecting only if needed."""
+        session = self.sessions.get((infohash, peer["peer_id"]))
+        if session is not None and session.is_alive():
+            return session
+        if session is not None:
+            await self.discard(session)
+
+        session = await self.connect(infohash, peer)
+        if session is None:
+            return None
+        try:
+            await self.exchange_bitfield(session, num_pieces)
+        except (ConnectionError, TimeoutError, OSError) as e:
+            print(f"[ERROR-PeerPool-acquire] {peer['peer_id']}: {e}")
+            await self.discard(session)
+            return None
+        return session
+
+    async def connect(self, infohash: str, peer: dict, wait=True):
+        """Open a connection to the peer and exchange handshakes.
+
+        Waits for a connection slot first, or returns None if there is none
+        and wait is False. At most max_half_open connections are being set up
+        at a time. Returns None for a banned peer.
+        """
+        if self.peerBans.is_banned(peer["ip"], peer["port"]):
+            return None
+        if wait:
+            await self.resourceManager.acquire_connection(infohash)
+        elif not self.resourceManager.try_acquire_connection(infohash):
+            return None
+        try:
+            async with self.resourceManager.half_open:
+                session = await self._handshake(infohash, peer)
+        except BaseException:
+            self.resourceManager.release_connection(infohash)
+            raise
+        if session is None:
+            self.resourceManager.release_connection(infohash)
+            return None
+        session.holds_connection = True
+        self.sessions[(infohash, peer["peer_id"])] = session
+        session.keepalive_task = asyncio.create_task(self._keep_alive(session))
+        return session
+
+    async def _handshake(self, infohash: str, peer: dict):
+        ip = peer["ip"]
+        port = peer["port"]
+        timeouts = self.timeouts.setdefault((ip, port), SessionTimeouts())
+
+        try:
+            # Connect to the peer
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            buffer_size = 1024 * 1024
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+            s.setblocking(False)
+            try:
+                async with asyncio.timeout(timeouts.handshake()):
+                    await asyncio.get_running_loop().sock_connect(s, (ip, port))
+            except TimeoutError:
+                s.close()
+                raise TimeoutError(f"Connecting to {ip}:{port} timed out")
+            except (Exception, asyncio.CancelledError):
+                s.close()
+                raise
+            reader, writer = await asyncio.open_connection(sock=s)
+
+            # Handshake with the peer
+            peer_communicator = PeerCommunicator(
+                reader, writer, extensions=self.extensions, timeouts=timeouts
+            )
+            peer_communicator.limiter = self.rateLimiter.session(infohash)
+            await peer_communicator.send_handshake(self.id, infohash)
+            # print(f"Sent handshake to {ip}:{port}")
+            handshake = await peer_communicator.receive_handshake()
+            # print(f"Received handshake from {ip}:{port}")
+            received_infohash = handshake[28:48].hex()
+            peer_id = handshake[48:].decode("utf-8")
+
+            valid = peer_communicator.validate_handshake(
+                handshake, received_infohash, peer_id
+            )
+            if not valid or received_infohash != infohash:
+                await peer_communicator.close()
+                raise Exception("Handshake failed")
+            if peer.get("peer_id") is None:
+                # Peers learned through peer exchange come without an id
+                peer["peer_id"] = peer_id
+        except Exception as e:
+            print(e)
+            return None
+
+        return PeerSession(infohash, peer, peer_communicator)
+
+    async def exchange_bitfield(self, session: PeerSession, num_pieces: int):
+        """Declare interest and read the peer's bitfield, see receive_session_start.
+
+        Peers that support ut_pex are then told about the other peers of the
+        torrent we are connected to.
+        """
+        session.in_use = True
+        try:
+            peer_communicator = session.peer_communicator
+            session.bitfield = await peer_communicator.receive_session_start(
+                num_pieces, self.listen_port
+            )
+            # print("received bitfield from peer ", session.peer_id)
+            await peer_communicator.send_pex(
+                [
+                    (other.peer["ip"], other.peer["port"])
+                    for other in self.get_sessions(session.infohash)
+                    if other is not session
+                ]
+            )
+        finally:
+            session.in_use = False
+            session.touch()
+
+    async def discard(self, session: PeerSession):
+        """Close the session and forget it."""
+        key = (session.infohash, session.peer_id)
+        if self.sessions.get(key) is session:
+            del self.sessions[key]
+        if (
+            session.keepalive_task is not None
+            and session.keepalive_task is not asyncio.current_task()
+        ):
+            session.keepalive_task.cancel()
+        if session.holds_connection:
+            session.holds_connection = False
+            self.resourceManager.release_connection(session.infohash)
+        await session.peer_communicator.close()
+
+    async def release_torrent(self, infohash: str):
+        """Choke and close every session that belongs to the torrent."""
+        sessions = [
+            session
+            for (session_infohash, _), session in self.sessions.items()
+            if session_infohash == infohash
+        ]
+        for session in sessions:
+            try:
+                await session.peer_communicator.send_choke()
+            except (ConnectionError, OSError):
+                pass
+            await self.discard(session)
+
+    async def discard_peer(self, ip: str, port: int):
+        """Close every session with the peer, of every torrent."""
+        sessions = [
+            session
+            for session in self.sessions.values()
+            if (session.peer["ip"], session.peer["port"]) == (ip, port)
+        ]
+        for session in sessions:
+            await self.discard(session)
+
+    def get_sessions(self, infohash: str):
+        """Returns the live sessions of the torrent."""
+        return [
+            session
+            for (session_infohash, _), session in self.sessions.items()
+            if session_infohash == infohash and session.is_alive()
+        ]
+
+    async def _keep_alive(self, session: PeerSession):
+        """Send keep-alives while the session is idle, dropping it once the peer is gone."""
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            if session.in_use:
+                continue
+            if time.monotonic() - session.last_active < self.keepalive_interval:
+                continue
+            try:
+                if not session.is_alive():
+                    raise ConnectionError("Peer disconnected")
+                await session.peer_communicator.send_keep_alive()
+                session.touch()
+            except (ConnectionError, OSError) as e:
+                print(f"[INFO-PeerPool-_keep_alive] Dropping {session.peer_id}: {e}")
+                await self.discard(session)
+                return
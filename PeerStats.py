@@ -0,0 +1,89 @@
+from typing import NamedTuple
+
+
+class PeerStatus(NamedTuple):
+    """Immutable copy of a PeerStats, see PeerStats.snapshot."""
+
+    peer_id: str
+    download_rate: float | None
+    latency: float | None
+    pieces: int
+    downloaded: int
+    completed: int
+    failures: int
+    hash_failures: int
+    score: float | None
+
+
+class PeerStats:
+    """Download performance of one peer during a download.
+
+    The download rate is an EWMA over whole pieces, each timed from its
+    request, or from the end of the piece before it if that came later, to
+    its last byte, so pipelined requests are not charged for the pieces
+    queued ahead of them. The latency is the peer's smoothed request -> first
+    byte time from SessionTimeouts.
+
+    Only the worker downloading from the peer updates its stats, without a
+    lock; readers take a snapshot.
+    """
+
+    def __init__(self, peer_id: str, alpha=0.3):
+        self.peer_id = peer_id
+        self.alpha = alpha
+        self.download_rate: float | None = None
+        self.latency: float | None = None
+        self.pieces = 0
+        self.downloaded = 0
+        # Bytes of the pieces this peer delivered first, duplicates excluded
+        self.completed = 0
+        self.failures = 0
+        self.hash_failures = 0
+
+    def add_piece(self, num_bytes: int, seconds: float, latency: float | None = None):
+        if seconds > 0:
+            sample = num_bytes / seconds
+            if self.download_rate is None:
+                self.download_rate = sample
+            else:
+                self.download_rate = (
+                    1 - self.alpha
+                ) * self.download_rate + self.alpha * sample
+        if latency is not None:
+            self.latency = latency
+        self.pieces += 1
+        self.downloaded += num_bytes
+
+    def add_completed(self, num_bytes: int):
+        """Credit the peer with a piece that counts towards the download."""
+        self.completed += num_bytes
+
+    def add_failure(self, hash_failure=False):
+        if hash_failure:
+            self.hash_failures += 1
+        else:
+            self.failures += 1
+
+    @property
+    def score(self):
+        """Download rate discounted by failures, None until a piece has arrived.
+
+        A piece that failed its hash check counts double, it wasted a whole
+        transfer.
+        """
+        if self.download_rate is None:
+            return None
+        return self.download_rate / (1 + self.failures + 2 * self.hash_failures)
+
+    def snapshot(self):
+        return PeerStatus(
+            self.peer_id,
+            self.download_rate,
+            self.latency,
+            self.pieces,
+            self.downloaded,
+            self.completed,
+            self.failures,
+            self.hash_failures,
+            self.score,
+        )
@@ -1,5 +1,6 @@
 import threading
 import hashlib
+from FileManager import FileManager
 from Torrent import Torrent
 
 
@@ -10,30 +11,23 @@ class PieceManager:
         self.num_pieces = torrent.pieces
         self.hashes = torrent.hashes
         self.file_path = file_path
+        # Paths of the files not downloaded, see FileManager.write_piece
+        self.skipped_files: set = set()
         self.piece_offsets = [i * self.piece_size for i in range(self.num_pieces)]
         self.bitfield: bytearray = bytearray(self.num_pieces)
-        self.downloaded_pieces: dict[int, bytes] = {}
         self.remaining_pieces = self.num_pieces
         self.lock = threading.Lock()
+        # Notified whenever a piece is marked downloaded
+        self.piece_added = threading.Condition(self.lock)
 
     def generate_bitfield(self):
+        """Hash the files one piece at a time, returns the bitfield of the intact pieces."""
         bitfield = bytearray(self.num_pieces)
-        data = self._concat_data()
-        current_offset = 0
         try:
             for index, expected_hash in enumerate(self.hashes):
-                offset = self.piece_offsets[index]
-                remaining_size = min(self.piece_size, self.torrent.size - offset)
-                piece = data[current_offset : current_offset + remaining_size]
-                piece_hash = hashlib.sha1(piece).digest()
-
+                piece_hash = hashlib.sha1(self.get_piece_data(index)).digest()
                 if piece_hash == expected_hash:
                     bitfield[index] = 1
-                else:
-                    pass
-
-                current_offset += remaining_size
-
         except OSError as e:
             print(f"[ERROR-PieceManager-generate_bitfield]: OSError {e}")
         except Exception as e:
@@ -44,50 +38,66 @@ class PieceManager:
     def update_bitfield(self, piece_index):
         with self.lock:
             self.bitfield[piece_index] = 1
-
-    def _concat_data(self):
-        data = b""
-        for file_info in self.torrent.files:
-            file_path = self.file_path + "/" + str(file_info[0])
-
-            with open(file_path, "rb") as f:
-                data += f.read()
-        return data
+            self.piece_added.notify_all()
 
     def get_piece_data(self, piece_idx):
-        data = self._concat_data()
-        offset = self.piece_offsets[piece_idx]
-        remaining_size = min(self.piece_size, self.torrent.size - offset)
-        piece_data = data[offset : offset + remaining_size]
-        return piece_data
+        return FileManager.read_piece(
+            self.torrent, self.file_path, piece_idx, self.skipped_files
+        )
 
-    def get_all_piece_data(self):
-        with self.lock:
-            return self.downloaded_pieces
+    def get_piece_length(self, piece_idx):
+        offset = self.piece_offsets[piece_idx]
+        return min(self.piece_size, self.torrent.size - offset)
 
     def verify_piece(self, piece_data, piece_idx):
         calculated_hash = hashlib.sha1(piece_data).digest()
         # print(f"Calculated hash: {calculated_hash}")
         # print(f"Expected hash: {self.hashes[piece_idx]}")
+        return self.verify_digest(calculated_hash, piece_idx)
+
+    def verify_digest(self, digest: bytes, piece_idx):
+        """Compare an already computed SHA-1 digest with the piece hash."""
         with self.lock:
             expected_hash = self.hashes[piece_idx]
-        return calculated_hash == expected_hash
-
-    def verify_all_pieces(self):
-        for piece_idx, piece_data in self.downloaded_pieces.items():
-            if not self.verify_piece(piece_data, piece_idx):
-                print(
-                    f"[ERROR-PieceManager-verify_all_pieces]: Piece {piece_idx} is corrupted"
-                )
-                return False
+        return digest == expected_hash
+
+    def verify_all_pieces(self, piece_indexes=None):
+        """Every piece is verified before it is committed, so only check completeness.
+
+        Only the given pieces are checked if piece_indexes is set.
+        """
+        missing = self.get_not_downloaded_indexes()
+        if piece_indexes is not None:
+            missing = sorted(set(missing) & set(piece_indexes))
+        if missing:
+            print(
+                f"[ERROR-PieceManager-verify_all_pieces]: Pieces {missing} are missing"
+            )
+            return False
         return True
 
-    def add_downloaded_piece(self, piece_data: bytes, piece_idx: int):
+    def add_downloaded_piece(self, piece_data, piece_idx: int):
+        """Commit a verified piece to its final location in the destination files."""
+        FileManager.write_piece(
+            self.torrent, self.file_path, piece_idx, piece_data, self.skipped_files
+        )
+        self.mark_downloaded(piece_idx)
+
+    def mark_downloaded(self, piece_idx: int):
+        """Record a piece that is verified and already on disk."""
         with self.lock:
-            self.downloaded_pieces[piece_idx] = piece_data
+            if self.bitfield[piece_idx] == 1:
+                return
             self.remaining_pieces -= 1
         self.update_bitfield(piece_idx)
 
+    def wait_for_pieces(self, first_idx: int, last_idx: int, timeout=None):
+        """Block until pieces first_idx..last_idx are downloaded, False on timeout."""
+        with self.piece_added:
+            return self.piece_added.wait_for(
+                lambda: all(self.bitfield[first_idx : last_idx + 1]), timeout
+            )
+
     def get_num_remaining_pieces(self):
         """Returns the number of remaining pieces to download."""
         with self.lock:
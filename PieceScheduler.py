@@ -0,0 +1,467 @@
+import asyncio
+import random
+import time
+from collections import deque
+from itertools import islice
+
+# Piece and file priorities, higher ones are downloaded first
+SKIP, LOW, NORMAL, HIGH = 0, 1, 2, 3
+PRIORITY_NAMES = {"skip": SKIP, "low": LOW, "normal": NORMAL, "high": HIGH}
+
+
+class PieceScheduler:
+    """Hands out the pieces of one download to its per-peer workers.
+
+    Each worker asks with its peer's bitfield and gets the rarest pending
+    piece that peer has. A piece is pending, in flight, completed, given up
+    after max_failures failed attempts, or skipped. Pending pieces sit in
+    buckets[priority][availability]. Only used from the peer engine's event
+    loop, so it needs no locking.
+    """
+
+    # Pieces the walk looks at before it first checks how many the peer has
+    WALK_BUDGET = 1024
+    # The peer is gone through piece by piece if it has at most this many
+    # times fewer pieces than the walk has looked at
+    SPARSE_FACTOR = 16
+    # Pieces of the rarest bucket looked at for a new run to join another
+    RUN_START_CANDIDATES = 32
+    # Pieces in a run before the next one starts at a random rarest pick
+    MAX_RUN_LENGTH = 4
+    # Completed pieces whose times the hedge delay is taken from
+    HEDGE_SAMPLES = 64
+    # No request is hedged before this many pieces have completed
+    HEDGE_MIN_SAMPLES = 8
+
+    def __init__(
+        self,
+        num_pieces: int,
+        max_failures=8,
+        endgame_threshold=8,
+        contiguous_runs=False,
+        hedge_percentile=None,
+    ):
+        self.num_pieces = num_pieces
+        self.max_failures = max_failures
+        self.endgame_threshold = endgame_threshold
+        self.contiguous_runs = contiguous_runs
+        self.hedge_percentile = hedge_percentile
+        # Holder -> (last piece it took, length of its run so far)
+        self.run_ends: dict = {}
+        # Number of connected peers that have each piece
+        self.availability = [0] * num_pieces
+        self.failures = [0] * num_pieces
+        self.priority = [NORMAL] * num_pieces
+        self.pending: set[int] = set(range(num_pieces))
+        # buckets[p][n] holds the pending pieces of priority p that exactly n
+        # connected peers have, position[idx] is where a pending piece sits
+        # in its bucket
+        self.buckets: list[list[list[int]]] = [[[]] for _ in range(HIGH + 1)]
+        self.position = [0] * num_pieces
+        for piece_idx in range(num_pieces):
+            self._bucket_add(piece_idx)
+        # Pieces with priority SKIP that are neither in flight nor completed
+        self.skipped: set[int] = set()
+        # Pieces being downloaded, with the workers downloading them
+        self.in_flight: dict[int, set] = {}
+        # When each piece in flight was taken, and how long recent pieces took
+        self.taken_at: dict[int, float] = {}
+        self.piece_times: deque[float] = deque(maxlen=self.HEDGE_SAMPLES)
+        self.completed: set[int] = set()
+        self.given_up: set[int] = set()
+        # Pieces a stream is about to read, see set_window
+        self.window = range(0)
+        # Set when a piece is returned, completed or announced by a peer
+        self.changed = asyncio.Event()
+
+    def add_peer(self, bitfield):
+        for idx, bit in enumerate(bitfield[: self.num_pieces]):
+            if bit == 1:
+                self._move(idx, 1)
+
+    def add_have(self, piece_idx: int):
+        """A connected peer announced a new piece."""
+        self._move(piece_idx, 1)
+        if piece_idx in self.pending:
+            self._notify()
+
+    def remove_peer(self, bitfield, holder=None):
+        for idx, bit in enumerate(bitfield[: self.num_pieces]):
+            if bit == 1:
+                self._move(idx, -1)
+        self.end_run(holder)
+
+    def end_run(self, holder):
+        """Forget the run of a holder that takes no more pieces."""
+        self.run_ends.pop(holder, None)
+
+    def set_window(self, first_piece: int, num_pieces: int):
+        """Favor the num_pieces pieces from first_piece on, e.g. ahead of a read cursor.
+
+        They are picked before any other, nearest first, and the first
+        missing one may go to a second peer while it is in flight.
+        """
+        window = range(first_piece, min(first_piece + num_pieces, self.num_pieces))
+        if window != self.window:
+            self.window = window
+            # Idle workers pick from the new window right away
+            self._notify()
+
+    def set_priorities(self, priorities):
+        """Set the priority of every piece; SKIP pieces are no longer downloaded."""
+        for piece_idx, priority in enumerate(priorities):
+            if priority == self.priority[piece_idx]:
+                continue
+            pending = piece_idx in self.pending
+            if pending:
+                self._bucket_remove(piece_idx)
+                self.pending.remove(piece_idx)
+            self.priority[piece_idx] = priority
+            if pending or piece_idx in self.skipped:
+                self.skipped.discard(piece_idx)
+                self._add_pending(piece_idx)
+        self._notify()
+
+    def in_endgame(self):
+        return not self.pending and 0 < len(self.in_flight) <= self.endgame_threshold
+
+    def next_piece(self, bitfield, exclude=(), holder=None):
+        """Take the rarest pending piece the peer has, or None if there is none.
+
+        With contiguous_runs the pick may continue the holder's run, see
+        _continue_run. When a stream waits for a piece, or once at most
+        endgame_threshold pieces are in flight and none is pending, a piece
+        already in flight with another holder is returned, fewest holders
+        first; complete() returns the others so they can be cancelled.
+        """
+        for piece_idx in self.window:
+            if (
+                piece_idx in self.pending
+                and bitfield[piece_idx] == 1
+                and piece_idx not in exclude
+            ):
+                return self._take(piece_idx, holder)
+
+        piece_idx = self._rarest(bitfield, exclude)
+        if piece_idx is not None:
+            if self.contiguous_runs:
+                piece_idx = self._continue_run(piece_idx, bitfield, exclude, holder)
+            return self._take(piece_idx, holder)
+
+        # The piece a stream is blocked on gets a second holder
+        for piece_idx in self.window:
+            if piece_idx in self.completed:
+                continue
+            holders = self.in_flight.get(piece_idx)
+            if (
+                holders is not None
+                and len(holders) == 1
+                and holder not in holders
+                and bitfield[piece_idx] == 1
+                and piece_idx not in exclude
+            ):
+                holders.add(holder)
+                return piece_idx
+            break
+
+        if not self.in_endgame():
+            return None
+        candidates = [
+            idx
+            for idx, holders in self.in_flight.items()
+            if bitfield[idx] == 1 and idx not in exclude and holder not in holders
+        ]
+        if not candidates:
+            return None
+        piece_idx = min(candidates, key=lambda idx: (len(self.in_flight[idx]), idx))
+        self.in_flight[piece_idx].add(holder)
+        return piece_idx
+
+    def hedge_delay(self):
+        """Seconds after which a request is hedged, None while hedging is off."""
+        if (
+            self.hedge_percentile is None
+            or len(self.piece_times) < self.HEDGE_MIN_SAMPLES
+        ):
+            return None
+        times = sorted(self.piece_times)
+        return times[min(int(self.hedge_percentile * len(times)), len(times) - 1)]
+
+    def hedge_piece(self, bitfield, exclude=(), holder=None, overdue=None):
+        """Take a second copy of the piece whose request is most overdue, or None.
+
+        Only pieces with a single holder, in flight for longer than
+        hedge_delay(), are hedged, and only if overdue(piece_idx, other_holder,
+        seconds) agrees, if given. The first copy to complete wins, as in
+        endgame.
+        """
+        delay = self.hedge_delay()
+        if delay is None or self.in_endgame():
+            return None
+        now = time.monotonic()
+        hedged = None
+        longest = delay
+        for piece_idx, holders in self.in_flight.items():
+            waited = now - self.taken_at[piece_idx]
+            if (
+                waited < longest
+                or len(holders) != 1
+                or holder in holders
+                or bitfield[piece_idx] != 1
+                or piece_idx in exclude
+            ):
+                continue
+            if overdue is None or overdue(piece_idx, next(iter(holders)), waited):
+                hedged = piece_idx
+                longest = waited
+        if hedged is not None:
+            self.in_flight[hedged].add(holder)
+        return hedged
+
+    def complete(self, piece_idx: int, holder=None):
+        """Mark a piece downloaded, returns the other holders to cancel.
+
+        Returns None if another holder already completed it.
+        """
+        if piece_idx in self.completed:
+            return None
+        holders = self.in_flight.pop(piece_idx, set())
+        holders.discard(holder)
+        taken_at = self.taken_at.pop(piece_idx, None)
+        if taken_at is not None:
+            self.piece_times.append(time.monotonic() - taken_at)
+        if piece_idx in self.pending:
+            self._bucket_remove(piece_idx)
+            self.pending.remove(piece_idx)
+        self.skipped.discard(piece_idx)
+        self.completed.add(piece_idx)
+        self._notify()
+        return list(holders)
+
+    def fail(self, piece_idx: int, holder=None):
+        """Return a piece that could not be downloaded to the pending set."""
+        if not self._drop_holder(piece_idx, holder):
+            return
+        self.failures[piece_idx] += 1
+        if self.failures[piece_idx] >= self.max_failures:
+            print(
+                f"[ERROR-PieceScheduler-fail] Giving up on piece {piece_idx} after {self.failures[piece_idx]} failures"
+            )
+            self.given_up.add(piece_idx)
+        else:
+            self._add_pending(piece_idx)
+        self._notify()
+
+    def release(self, piece_idx: int, holder=None):
+        """Return a piece that was not attempted, e.g. a rejected request."""
+        if not self._drop_holder(piece_idx, holder):
+            return
+        self._add_pending(piece_idx)
+        self._notify()
+
+    def finished(self):
+        """True once every piece is either downloaded or given up."""
+        return not self.pending and not self.in_flight
+
+    def succeeded(self):
+        """True once every piece that is not skipped is downloaded."""
+        return len(self.completed) + len(self.skipped) == self.num_pieces
+
+    def stalled(self):
+        """True if nothing is in flight and no connected peer has a pending piece."""
+        return not self.in_flight and sum(
+            len(buckets[0]) for buckets in self.buckets
+        ) == len(self.pending)
+
+    def _rarest(self, bitfield, exclude):
+        """The first piece the peer has, from the highest priority and rarest up.
+
+        Pieces sit in random order within a bucket, so downloaders spread over
+        different pieces. A peer with few pieces would make the walk look at
+        most pending pieces, so once WALK_BUDGET (then twice, four times as
+        many) pieces are walked, a peer with SPARSE_FACTOR times fewer pieces
+        is gone through piece by piece instead. A pick costs
+        O(min(pending, max(WALK_BUDGET, SPARSE_FACTOR * peer pieces))).
+        """
+        walked = 0
+        budget = self.WALK_BUDGET
+        # Pieces nobody has are in bucket 0 and cannot be asked for
+        for priority in (HIGH, NORMAL, LOW):
+            for bucket in self.buckets[priority][1:]:
+                # Walked in slices that end where the budget runs out, so the
+                # inner loop does not count
+                start = 0
+                while start < len(bucket):
+                    end = start + budget - walked
+                    for piece_idx in islice(bucket, start, end):
+                        if bitfield[piece_idx] == 1 and piece_idx not in exclude:
+                            return piece_idx
+                    walked += min(end, len(bucket)) - start
+                    start = end
+                    if walked == budget:
+                        peer_pieces = self._peer_pieces(
+                            bitfield, walked // self.SPARSE_FACTOR
+                        )
+                        if peer_pieces is not None:
+                            return self._rarest_of(peer_pieces, exclude)
+                        budget *= 2
+        return None
+
+    def _peer_pieces(self, bitfield, limit):
+        """The pieces the peer has, or None if it has more than limit."""
+        peer_pieces = []
+        piece_idx = bitfield.find(1, 0, self.num_pieces)
+        while piece_idx != -1:
+            if len(peer_pieces) == limit:
+                return None
+            peer_pieces.append(piece_idx)
+            piece_idx = bitfield.find(1, piece_idx + 1, self.num_pieces)
+        return peer_pieces
+
+    def _rarest_of(self, peer_pieces, exclude):
+        # The piece the bucket walk would reach first: highest priority,
+        # rarest, then first in its bucket
+        rarest = None
+        rarest_key = None
+        for piece_idx in peer_pieces:
+            if (
+                piece_idx in self.pending
+                and piece_idx not in exclude
+                and self.availability[piece_idx] > 0
+            ):
+                key = (
+                    -self.priority[piece_idx],
+                    self.availability[piece_idx],
+                    self.position[piece_idx],
+                )
+                if rarest_key is None or key < rarest_key:
+                    rarest = piece_idx
+                    rarest_key = key
+        return rarest
+
+    def _continue_run(self, rarest: int, bitfield, exclude, holder):
+        """Swap the rarest piece for one just as rare that continues a run.
+
+        Runs of consecutive pieces keep disk access mostly sequential. A new
+        run starts right behind another run or a downloaded piece so the runs
+        join up, and a run ends after MAX_RUN_LENGTH pieces.
+        """
+        priority = self.priority[rarest]
+        count = self.availability[rarest]
+
+        def available(piece_idx):
+            return (
+                piece_idx in self.pending
+                and self.priority[piece_idx] == priority
+                and self.availability[piece_idx] == count
+                and bitfield[piece_idx] == 1
+                and piece_idx not in exclude
+            )
+
+        last, length = self.run_ends.get(holder, (None, 0))
+        if (
+            last is not None
+            and length < self.MAX_RUN_LENGTH
+            and last + 1 < self.num_pieces
+            and available(last + 1)
+        ):
+            self.run_ends[holder] = (last + 1, length + 1)
+            return last + 1
+        # Runs are capped: downloaders sharing a seed that run into each
+        # other's part of the file would otherwise fetch the same pieces from
+        # it in lockstep, where random picks leave them pieces to trade
+        piece_idx = rarest
+        if length < self.MAX_RUN_LENGTH:
+            piece_idx = self._run_start(priority, count, available, rarest)
+        self.run_ends[holder] = (piece_idx, 1)
+        return piece_idx
+
+    def _run_start(self, priority, count, available, rarest):
+        # Join the run of another holder right behind its end, if that run
+        # came from the same bucket
+        for end, _ in self.run_ends.values():
+            if (
+                end + 1 < self.num_pieces
+                and self.priority[end] == priority
+                and self.availability[end] == count
+                and available(end + 1)
+            ):
+                return end + 1
+        # Or behind a piece that is no longer pending. The first run starts at
+        # the random rarest pick, so downloaders that see the same swarm
+        # still fill in different parts of the file and can trade
+        for piece_idx in self.buckets[priority][count][: self.RUN_START_CANDIDATES]:
+            if (
+                piece_idx > 0
+                and piece_idx - 1 not in self.pending
+                and available(piece_idx)
+            ):
+                return piece_idx
+        return rarest
+
+    def _move(self, piece_idx: int, delta: int):
+        """Change a piece's availability, moving it to its new bucket if pending."""
+        if piece_idx not in self.pending:
+            self.availability[piece_idx] += delta
+            return
+        self._bucket_remove(piece_idx)
+        self.availability[piece_idx] += delta
+        self._bucket_add(piece_idx)
+
+    def _take(self, piece_idx: int, holder):
+        self._bucket_remove(piece_idx)
+        self.pending.remove(piece_idx)
+        self.in_flight[piece_idx] = {holder}
+        self.taken_at[piece_idx] = time.monotonic()
+        return piece_idx
+
+    def _add_pending(self, piece_idx: int):
+        if self.priority[piece_idx] == SKIP:
+            self.skipped.add(piece_idx)
+            return
+        self.pending.add(piece_idx)
+        self._bucket_add(piece_idx)
+
+    def _bucket_add(self, piece_idx: int):
+        buckets = self.buckets[self.priority[piece_idx]]
+        count = self.availability[piece_idx]
+        while count >= len(buckets):
+            buckets.append([])
+        # Insert at a random place so that peers with the same view of the
+        # swarm pick different pieces among the equally rare ones
+        bucket = buckets[count]
+        position = int(random.random() * (len(bucket) + 1))
+        if position < len(bucket):
+            other = bucket[position]
+            self.position[other] = len(bucket)
+            bucket.append(other)
+            bucket[position] = piece_idx
+        else:
+            bucket.append(piece_idx)
+        self.position[piece_idx] = position
+
+    def _bucket_remove(self, piece_idx: int):
+        # Swap with the bucket's last piece so the removal is O(1)
+        bucket = self.buckets[self.priority[piece_idx]][self.availability[piece_idx]]
+        last = bucket.pop()
+        if last != piece_idx:
+            position = self.position[piece_idx]
+            bucket[position] = last
+            self.position[last] = position
+
+    def _drop_holder(self, piece_idx, holder):
+        """Forget a holder, returns True if it was the last one of an unfinished piece."""
+        holders = self.in_flight.get(piece_idx)
+        if holders is None:
+            return False
+        holders.discard(holder)
+        if holders:
+            return False
+        del self.in_flight[piece_idx]
+        del self.taken_at[piece_idx]
+        return True
+
+    def _notify(self):
+        # Wake every waiting worker, later waiters use a fresh event
+        self.changed.set()
+        self.changed = asyncio.Event()
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+import weakref
+
+
+class TokenBucket:
+    """Token bucket for a byte rate. A rate of None means unlimited."""
+
+    def __init__(self, rate=None):
+        self.rate = None
+        self.capacity = 0
+        self.tokens = 0.0
+        self.last_refill = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """Change the rate (bytes/s) at runtime, None or 0 removes the limit."""
+        self.rate = rate or None
+        # Allow up to one second worth of burst
+        self.capacity = self.rate or 0
+        self.tokens = min(self.tokens, self.capacity)
+        self.last_refill = time.monotonic()
+
+    def take(self, amount: int):
+        """Take amount tokens, returns how long the caller must wait in seconds.
+
+        The bucket may go into debt, which is paid back by the wait. This keeps
+        the cost of a single call constant regardless of the message size.
+        """
+        rate = self.rate
+        if rate is None:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * rate)
+        self.last_refill = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / rate
+
+
+class SessionLimiter:
+    """The buckets one peer session has to pass: per-peer, per-torrent and global."""
+
+    def __init__(self, upload_buckets: list, download_buckets: list):
+        self.upload_buckets = upload_buckets
+        self.download_buckets = download_buckets
+
+    async def throttle_upload(self, amount: int):
+        """Wait until amount bytes may be sent, returns the time waited."""
+        return await self._throttle(self.upload_buckets, amount)
+
+    async def throttle_download(self, amount: int):
+        """Wait until amount bytes may be received, returns the time waited."""
+        return await self._throttle(self.download_buckets, amount)
+
+    @staticmethod
+    async def _throttle(buckets, amount):
+        wait = 0.0
+        for bucket in buckets:
+            if bucket.rate is not None:
+                wait = max(wait, bucket.take(amount))
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+    """Global, per-torrent and per-peer upload/download limits.
+
+    Limits are in bytes per second and can be changed at any time from any
+    thread; sessions see the new rate on their next message. Unlimited buckets
+    are skipped, so no limit means no extra waiting on the data path.
+    """
+
+    DIRECTIONS = ("upload", "download")
+
+    def __init__(self):
+        self.global_buckets = {d: TokenBucket() for d in self.DIRECTIONS}
+        self.torrent_buckets: dict[str, dict[str, TokenBucket]] = {}
+        self.peer_rates: dict[str, int | None] = {d: None for d in self.DIRECTIONS}
+        self.peer_buckets: dict[str, weakref.WeakSet] = {
+            d: weakref.WeakSet() for d in self.DIRECTIONS
+        }
+        self.lock = threading.Lock()
+
+    def set_global_limit(self, direction: str, rate):
+        self.global_buckets[direction].set_rate(rate)
+
+    def set_torrent_limit(self, infohash: str, direction: str, rate):
+        with self.lock:
+            buckets = self._get_torrent_buckets(infohash)
+        buckets[direction].set_rate(rate)
+
+    def set_peer_limit(self, direction: str, rate):
+        """Set the limit applied to every peer session, existing ones included."""
+        with self.lock:
+            self.peer_rates[direction] = rate or None
+            peer_buckets = list(self.peer_buckets[direction])
+        for bucket in peer_buckets:
+            bucket.set_rate(rate)
+
+    def get_limits(self):
+        """Returns the configured limits, None meaning unlimited."""
+        with self.lock:
+            return {
+                "global": {d: b.rate for d, b in self.global_buckets.items()},
+                "peer": dict(self.peer_rates),
+                "torrent": {
+                    infohash: {d: b.rate for d, b in buckets.items()}
+                    for infohash, buckets in self.torrent_buckets.items()
+                },
+            }
+
+    def session(self, infohash: str):
+        """Create the limiter for a new peer session of the torrent."""
+        with self.lock:
+            torrent_buckets = self._get_torrent_buckets(infohash)
+            peer_buckets = {}
+            for direction in self.DIRECTIONS:
+                peer_buckets[direction] = TokenBucket(self.peer_rates[direction])
+                self.peer_buckets[direction].add(peer_buckets[direction])
+        return SessionLimiter(
+            *(
+                [
+                    peer_buckets[direction],
+                    torrent_buckets[direction],
+                    self.global_buckets[direction],
+                ]
+                for direction in self.DIRECTIONS
+            )
+        )
+
+    def _get_torrent_buckets(self, infohash: str):
+        if infohash not in self.torrent_buckets:
+            self.torrent_buckets[infohash] = {d: TokenBucket() for d in self.DIRECTIONS}
+        return self.torrent_buckets[infohash]
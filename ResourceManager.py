@@ -0,0 +1,187 @@
+import asyncio
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ResourceManager:
+    """Node-wide budget of connections, downloads, worker threads and memory.
+
+    Shared by the download and upload managers so that the limits hold across
+    every torrent. Outgoing connections wait for a free slot, incoming ones
+    are refused when none is left. Downloads beyond max_active_downloads wait
+    in a priority queue, lower numbers first and in arrival order within a
+    priority. Blocking work of every session runs on one bounded executor.
+    Download staging buffers and pieces read for upload reserve their size
+    from max_memory first, and wait while it is used up.
+
+    The connection, download and memory methods are only used from the peer
+    engine's event loop; the queue is also read by the user interface, under
+    a lock, and the memory usage without one.
+    """
+
+    def __init__(
+        self,
+        max_connections=200,
+        max_torrent_connections=50,
+        max_half_open=8,
+        max_active_downloads=4,
+        max_worker_threads=8,
+        max_memory=256 * 1024 * 1024,
+    ):
+        self.max_connections = max_connections
+        self.max_torrent_connections = max_torrent_connections
+        self.max_active_downloads = max_active_downloads
+        self.connections = 0
+        self.torrent_connections: dict[str, int] = {}
+        # Connections being opened and handshaked at the same time
+        self.half_open = asyncio.Semaphore(max_half_open)
+        self.active_downloads: set[str] = set()
+        # (priority, arrival, infohash, future) of the downloads waiting to start
+        self.download_queue: list[tuple] = []
+        self.arrivals = itertools.count()
+        # Bytes of piece data held in memory, see reserve_memory
+        self.max_memory = max_memory
+        self.memory_used = 0
+        self.memory_peak = 0
+        # Reservations waiting for memory to be released
+        self.memory_waiting = 0
+        self.lock = threading.Lock()
+        self.changed = asyncio.Event()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_worker_threads, thread_name_prefix="worker"
+        )
+
+    def connection_available(self, infohash: str):
+        return (
+            self.connections < self.max_connections
+            and self.torrent_connections.get(infohash, 0) < self.max_torrent_connections
+        )
+
+    def free_connections(self, infohash: str):
+        """Returns how many more connections the torrent may open right now."""
+        return max(
+            min(
+                self.max_connections - self.connections,
+                self.max_torrent_connections
+                - self.torrent_connections.get(infohash, 0),
+            ),
+            0,
+        )
+
+    async def acquire_connection(self, infohash: str):
+        """Wait for a connection slot of the torrent."""
+        while not self.connection_available(infohash):
+            await self.changed.wait()
+        self._take_connection(infohash)
+
+    def try_acquire_connection(self, infohash: str):
+        """Take a connection slot if one is free, returns False otherwise."""
+        if not self.connection_available(infohash):
+            return False
+        self._take_connection(infohash)
+        return True
+
+    def release_connection(self, infohash: str):
+        self.connections -= 1
+        self.torrent_connections[infohash] -= 1
+        if self.torrent_connections[infohash] == 0:
+            del self.torrent_connections[infohash]
+        self._notify()
+
+    async def acquire_download(self, infohash: str, priority=0):
+        """Wait until the download may start, see the class docstring for the order."""
+        with self.lock:
+            if (
+                len(self.active_downloads) < self.max_active_downloads
+                and not self.download_queue
+            ):
+                self.active_downloads.add(infohash)
+                return
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(
+                self.download_queue,
+                (priority, next(self.arrivals), infohash, future),
+            )
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.lock:
+                self.download_queue = [
+                    entry for entry in self.download_queue if entry[3] is not future
+                ]
+                heapq.heapify(self.download_queue)
+            if future.done() and not future.cancelled():
+                # Started and cancelled at the same time, pass the turn on
+                self.release_download(infohash)
+            raise
+
+    def release_download(self, infohash: str):
+        """Free the download's place and start the next queued download."""
+        with self.lock:
+            self.active_downloads.discard(infohash)
+            while (
+                self.download_queue
+                and len(self.active_downloads) < self.max_active_downloads
+            ):
+                _, _, next_infohash, future = heapq.heappop(self.download_queue)
+                if future.done():
+                    continue
+                self.active_downloads.add(next_infohash)
+                future.set_result(None)
+
+    def memory_available(self, num_bytes: int):
+        # A reservation larger than the whole budget gets it to itself
+        return self.memory_used == 0 or self.memory_used + num_bytes <= self.max_memory
+
+    async def reserve_memory(self, num_bytes: int):
+        """Wait until num_bytes more piece data fit in the memory budget."""
+        if not self.memory_available(num_bytes):
+            self.memory_waiting += 1
+            try:
+                while not self.memory_available(num_bytes):
+                    await self.changed.wait()
+            finally:
+                self.memory_waiting -= 1
+        self._take_memory(num_bytes)
+
+    def try_reserve_memory(self, num_bytes: int):
+        """Reserve the memory if it fits right now, returns False otherwise."""
+        if not self.memory_available(num_bytes):
+            return False
+        self._take_memory(num_bytes)
+        return True
+
+    def release_memory(self, num_bytes: int):
+        self.memory_used -= num_bytes
+        self._notify()
+
+    def get_memory_usage(self):
+        """Returns the bytes of piece data in memory, their peak and the budget."""
+        return {
+            "used": self.memory_used,
+            "peak": self.memory_peak,
+            "limit": self.max_memory,
+            "waiting": self.memory_waiting,
+        }
+
+    def get_queued_downloads(self):
+        """Returns the infohashes of the waiting downloads, next to start first."""
+        with self.lock:
+            return [entry[2] for entry in sorted(self.download_queue)]
+
+    def _take_connection(self, infohash: str):
+        self.connections += 1
+        self.torrent_connections[infohash] = (
+            self.torrent_connections.get(infohash, 0) + 1
+        )
+
+    def _take_memory(self, num_bytes: int):
+        self.memory_used += num_bytes
+        self.memory_peak = max(self.memory_peak, self.memory_used)
+
+    def _notify(self):
+        # Wake every waiting connection, later waiters use a fresh event
+        self.changed.set()
+        self.changed = asyncio.Event()
@@ -0,0 +1,125 @@
+import json
+import os
+import random
+import time
+
+from PieceManager import PieceManager
+
+
+class ResumeState:
+    """Verified pieces of an unfinished download, kept next to its files.
+
+    The state of each torrent is a JSON file in <dest_dir>/.resume/ that
+    records the file layout, the verified pieces, the file priorities and the
+    last peer list. On load the layout must match the torrent and the
+    selected files on disk, and a sample of the recorded pieces is hashed;
+    only if a sample piece fails are all of them checked.
+    """
+
+    VERSION = 1
+    DIRECTORY = ".resume"
+    # Recorded pieces hashed on load before the rest are trusted
+    SAMPLE_SIZE = 8
+
+    def __init__(self, dest_dir: str, infohash: str):
+        self.infohash = infohash
+        self.path = os.path.join(dest_dir, self.DIRECTORY, f"{infohash}.json")
+
+    @classmethod
+    def list_unfinished(cls, dest_dir: str):
+        """Returns the infohashes of the downloads that have a resume state."""
+        directory = os.path.join(dest_dir, cls.DIRECTORY)
+        if not os.path.isdir(directory):
+            return []
+        return [
+            file_name[: -len(".json")]
+            for file_name in sorted(os.listdir(directory))
+            if file_name.endswith(".json")
+        ]
+
+    def save(self, pieceManager: PieceManager, peer_list: list, file_priorities=None):
+        """Write the state atomically, a crash never leaves half a file behind."""
+        torrent = pieceManager.torrent
+        with pieceManager.lock:
+            pieces = "".join(str(bit) for bit in pieceManager.bitfield)
+        state = {
+            "version": self.VERSION,
+            "infohash": self.infohash,
+            "piece_size": torrent.piece_size,
+            "files": [[str(path), size] for path, size in torrent.files],
+            "pieces": pieces,
+            "file_priorities": file_priorities,
+            "peer_list": peer_list,
+            "saved_at": time.time(),
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"[ERROR-ResumeState-save] {e}")
+
+    def read(self):
+        """Returns the saved state, or None if there is none or it is unreadable."""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"[ERROR-ResumeState-read] {e}")
+            return None
+        if state.get("version") != self.VERSION or state.get("infohash") != (
+            self.infohash
+        ):
+            return None
+        return state
+
+    def load(self, pieceManager: PieceManager):
+        """Returns the recorded pieces that are still intact on disk."""
+        state = self.read()
+        if state is None:
+            return []
+        torrent = pieceManager.torrent
+        files = [[str(path), size] for path, size in torrent.files]
+        if (
+            state["piece_size"] != torrent.piece_size
+            or state["files"] != files
+            or len(state["pieces"]) != pieceManager.num_pieces
+        ):
+            print(f"[INFO-ResumeState-load] Layout changed for {torrent.name}")
+            return []
+        skipped = {str(path) for path in pieceManager.skipped_files}
+        for path, size in files:
+            if path in skipped:
+                continue
+            file_path = os.path.join(pieceManager.file_path, path)
+            if not os.path.isfile(file_path) or os.path.getsize(file_path) != size:
+                print(f"[INFO-ResumeState-load] {path} is missing or resized")
+                return []
+
+        recorded = [idx for idx, bit in enumerate(state["pieces"]) if bit == "1"]
+        sample = random.sample(recorded, min(self.SAMPLE_SIZE, len(recorded)))
+        if all(self._verify(pieceManager, idx) for idx in sample):
+            return recorded
+        print(f"[INFO-ResumeState-load] Rechecking every piece of {torrent.name}")
+        return [idx for idx in recorded if self._verify(pieceManager, idx)]
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _verify(pieceManager: PieceManager, piece_idx: int):
+        try:
+            piece_data = pieceManager.get_piece_data(piece_idx)
+        except OSError:
+            # A piece partly in a skipped file, whose part was never written
+            return False
+        return pieceManager.verify_piece(piece_data, piece_idx)
@@ -0,0 +1,76 @@
+class SessionTimeouts:
+    """Per-peer deadlines derived from measured round-trip time and throughput.
+
+    Round-trip samples (handshake and request -> first byte) feed a smoothed
+    RTT and RTT variance as in RFC 6298, and piece transfers feed an EWMA of the
+    throughput. Until a sample exists the conservative defaults are used.
+    """
+
+    MIN_TIMEOUT = 1.0
+    MAX_TIMEOUT = 60.0
+
+    def __init__(
+        self,
+        handshake_timeout=5.0,
+        first_byte_timeout=10.0,
+        min_throughput=16 * 1024,
+        alpha=0.125,
+        beta=0.25,
+    ):
+        self.default_handshake_timeout = handshake_timeout
+        self.default_first_byte_timeout = first_byte_timeout
+        self.min_throughput = min_throughput
+        self.alpha = alpha
+        self.beta = beta
+
+        self.srtt: float | None = None
+        self.rttvar: float | None = None
+        self.throughput: float | None = None
+
+    def add_rtt_sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(
+                self.srtt - rtt
+            )
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+
+    def add_throughput_sample(self, num_bytes: int, seconds: float):
+        # Tiny transfers say more about scheduling noise than about the link
+        if num_bytes < 16 * 1024 or seconds <= 0:
+            return
+        sample = num_bytes / seconds
+        if self.throughput is None:
+            self.throughput = sample
+        else:
+            self.throughput = (1 - self.alpha) * self.throughput + self.alpha * sample
+
+    @property
+    def rto(self):
+        """Retransmission-style timeout: srtt + 4 * rttvar."""
+        return self._clamp(self.srtt + 4 * self.rttvar)
+
+    def handshake(self):
+        """Deadline for connecting and exchanging handshakes."""
+        if self.srtt is None:
+            return self.default_handshake_timeout
+        return self._clamp(2 * self.rto)
+
+    def first_byte(self):
+        """Deadline between sending a request and the first byte of the answer."""
+        if self.srtt is None:
+            return self.default_first_byte_timeout
+        return self.rto
+
+    def piece(self, piece_size: int):
+        """Deadline for the rest of a piece once its first byte has arrived."""
+        throughput = max(self.throughput or 0, self.min_throughput)
+        # Allow the peer to slow down to a third of its measured rate
+        transfer_time = 3 * piece_size / throughput
+        rto = self.rto if self.srtt is not None else self.MIN_TIMEOUT
+        return self._clamp(transfer_time + rto)
+
+    def _clamp(self, timeout: float):
+        return min(max(timeout, self.MIN_TIMEOUT), self.MAX_TIMEOUT)
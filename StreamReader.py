@@ -0,0 +1,109 @@
+import io
+import os
+
+
+class StreamReader(io.RawIOBase):
+    """Blocking file-like reader of one file of a download in progress.
+
+    A read waits until the piece under the read position is verified and on
+    disk, then returns the data of the downloaded pieces from there on. Each
+    read also moves the download's streaming window to its position, so the
+    pieces ahead of the reader are fetched first. Wrap the reader in
+    io.BufferedReader for many small reads.
+
+    Reads raise OSError if the download stops without the piece, and
+    TimeoutError if it has not arrived after timeout seconds.
+    """
+
+    # Seconds between checks that the download is still running
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, downloadManager, infohash: str, file_index=0, timeout=None):
+        super().__init__()
+        with downloadManager.lock:
+            download_info = downloadManager.active_downloads.get(infohash)
+            if download_info is None:
+                raise KeyError(f"No download for {infohash}")
+            self.download_future = download_info["download_future"]
+        self.downloadManager = downloadManager
+        self.infohash = infohash
+        self.pieceManager = download_info["piece_manager"]
+        self.timeout = timeout
+
+        files = download_info["torrent"].files
+        path, self.size = files[file_index]
+        if path in self.pieceManager.skipped_files:
+            raise ValueError(f"{path} is not selected for download")
+        self.path = os.path.join(downloadManager.dest_dir, str(path))
+        # Where the file starts in the torrent's concatenated payload
+        self.file_offset = sum(size for _, size in files[:file_index])
+        self.position = 0
+        self.fd = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset: int, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self.position = position
+        return position
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self.position >= self.size or len(buffer) == 0:
+            return 0
+        piece_size = self.pieceManager.piece_size
+        start = self.file_offset + self.position
+        first_piece = start // piece_size
+        self.downloadManager.set_stream_position(self.infohash, first_piece)
+        self._wait_for_piece(first_piece)
+
+        # Read on through the pieces that are already here
+        end = min(start + len(buffer), self.file_offset + self.size)
+        last_piece = first_piece
+        with self.pieceManager.lock:
+            while (last_piece + 1) * piece_size < end and self.pieceManager.bitfield[
+                last_piece + 1
+            ]:
+                last_piece += 1
+        end = min(end, (last_piece + 1) * piece_size)
+
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        data = os.pread(self.fd, end - start, self.position)
+        buffer[: len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        super().close()
+
+    def _wait_for_piece(self, piece_idx: int):
+        waited = 0.0
+        while not self.pieceManager.wait_for_pieces(
+            piece_idx, piece_idx, self.POLL_INTERVAL
+        ):
+            if self.download_future.done():
+                raise OSError(f"Download stopped before piece {piece_idx} arrived")
+            waited += self.POLL_INTERVAL
+            if self.timeout is not None and waited >= self.timeout:
+                raise TimeoutError(f"Piece {piece_idx} did not arrive in time")
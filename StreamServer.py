@@ -0,0 +1,127 @@
+import mimetypes
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from DownloadManager import DownloadManager
+
+
+class StreamServer:
+    """Localhost HTTP server for the files of downloads in progress.
+
+    GET /<infohash>/<file index> sends the file through a StreamReader, so a
+    media player can start playing before the download finishes. A single
+    byte range is answered with 206 Partial Content, which players use to
+    seek; the pieces at the new position are then fetched first.
+    """
+
+    def __init__(self, downloadManager: DownloadManager, port=8080, host="127.0.0.1"):
+        self.downloadManager = downloadManager
+        self.host = host
+        self.port = port
+        self.server = None
+
+    def start(self):
+        """Serve from a background thread, returns once the server is bound."""
+        self.server = ThreadingHTTPServer((self.host, self.port), _StreamRequestHandler)
+        self.server.daemon_threads = True
+        self.server.downloadManager = self.downloadManager
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def get_url(self, infohash: str, file_index=0):
+        return f"http://{self.host}:{self.port}/{infohash}/{file_index}"
+
+
+class _StreamRequestHandler(BaseHTTPRequestHandler):
+    CHUNK_SIZE = 64 * 1024
+
+    def do_GET(self):
+        self._serve(send_body=True)
+
+    def do_HEAD(self):
+        self._serve(send_body=False)
+
+    def log_message(self, format, *args):
+        # Keep the console to the user interface
+        pass
+
+    def _serve(self, send_body: bool):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        try:
+            infohash, file_index = parts[0], int(parts[1])
+            reader = self.server.downloadManager.open_stream(infohash, file_index)
+        except (IndexError, ValueError, KeyError):
+            self.send_error(404, "No such download")
+            return
+
+        with reader:
+            try:
+                byte_range = self._parse_range(self.headers.get("Range"), reader.size)
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{reader.size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if byte_range is None:
+                start, end = 0, reader.size - 1
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{reader.size}")
+            content_type, _ = mimetypes.guess_type(reader.path)
+            self.send_header("Content-Type", content_type or "application/octet-stream")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+            if not send_body:
+                return
+
+            reader.seek(start)
+            remaining = end - start + 1
+            try:
+                while remaining > 0:
+                    data = reader.read(min(self.CHUNK_SIZE, remaining))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    remaining -= len(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # The player went away, usually to seek elsewhere
+                pass
+            except OSError as e:
+                print(
+                    f"[ERROR-StreamServer-_serve] {os.path.basename(reader.path)}: {e}"
+                )
+                self.close_connection = True
+
+    @staticmethod
+    def _parse_range(header, size: int):
+        """Returns the (first, last) byte of the requested range.
+
+        None means the whole file: no header, a malformed one or several
+        ranges. Raises ValueError if the range lies outside the file.
+        """
+        if header is None or not header.startswith("bytes=") or "," in header:
+            return None
+        first, _, last = header[len("bytes=") :].strip().partition("-")
+        if not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+            return None
+        if first == "":
+            # The last bytes of the file
+            if last == "" or int(last) == 0 or size == 0:
+                raise ValueError(f"Unsatisfiable range {header}")
+            return max(size - int(last), 0), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start >= size or end < start:
+            raise ValueError(f"Unsatisfiable range {header}")
+        return start, end
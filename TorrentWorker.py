@@ -0,0 +1,192 @@
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import socket
+import threading
+from multiprocessing.reduction import recv_handle, send_handle
+
+from PeerEngine import PeerEngine
+from RateLimiter import RateLimiter
+from ResourceManager import ResourceManager
+from Torrent import Torrent
+from UploadManager import UploadManager
+
+
+class TorrentWorker:
+    """One download running in a process of its own, see DownloadManager.
+
+    The process has its own event loop, DownloadManager and UploadManager,
+    so the protocol handling and hashing of each torrent run on their own
+    core. The coordinating process talks to it over a pipe of tuples: the
+    worker sends its DownloadStatus and banned peers every STATUS_INTERVAL
+    seconds and whether it succeeded at the end; the coordinator sends stop
+    commands and the peer connections it accepted for the torrent, the
+    socket itself passed along as a file descriptor.
+    """
+
+    # Seconds between the worker's status messages
+    STATUS_INTERVAL = 0.5
+    # Seconds to wait for a stopped worker to save its state and exit
+    STOP_TIMEOUT = 10.0
+
+    def __init__(
+        self, config: dict, torrent: Torrent, peer_list: list, file_priorities
+    ):
+        # Fork is unsafe with the coordinator's threads running
+        context = multiprocessing.get_context("spawn")
+        self.connection, self.worker_connection = context.Pipe()
+        self.process = context.Process(
+            target=_run_worker,
+            args=(self.worker_connection, config, torrent, peer_list, file_priorities),
+            name=f"torrent-{torrent.infohash[:8]}",
+            daemon=True,
+        )
+        self.name = torrent.name
+        # Guards the pipe against messages sent from several threads at once
+        self.send_lock = threading.Lock()
+        # Latest DownloadStatus and BannedPeer list the worker sent
+        self.status = None
+        self.banned = []
+
+    def start(self):
+        self.process.start()
+        # Only the worker uses its end from now on
+        self.worker_connection.close()
+
+    async def wait(self):
+        """Follow the worker's status until it exits, returns whether it succeeded."""
+        loop = asyncio.get_running_loop()
+        finished = loop.create_future()
+
+        def receive():
+            try:
+                while self.connection.poll():
+                    message = self.connection.recv()
+                    if message[0] == "status":
+                        _, self.status, self.banned = message
+                    elif message[0] == "finished" and not finished.done():
+                        finished.set_result(message[1])
+            except (EOFError, OSError):
+                if not finished.done():
+                    print(
+                        f"[ERROR-TorrentWorker-wait] Worker for {self.name} exited unexpectedly"
+                    )
+                    finished.set_result(False)
+
+        loop.add_reader(self.connection.fileno(), receive)
+        try:
+            return await finished
+        finally:
+            loop.remove_reader(self.connection.fileno())
+            await asyncio.to_thread(self.process.join)
+
+    def hand_off(self, fd: int, handshake: bytes):
+        """Pass a peer connection whose handshake was read to the worker.
+
+        Blocks while the pipe is full, raises OSError if the worker is gone.
+        """
+        with self.send_lock:
+            self.connection.send(("connection", handshake))
+            send_handle(self.connection, fd, self.process.pid)
+
+    def stop(self):
+        """Have the worker save its resume state and exit, and wait for it."""
+        try:
+            with self.send_lock:
+                self.connection.send(("stop",))
+        except OSError:
+            # Already gone
+            pass
+        self.process.join(self.STOP_TIMEOUT)
+
+
+def _run_worker(connection, config: dict, torrent: Torrent, peer_list, file_priorities):
+    """Entry point of the worker process, runs the download to its end."""
+    # DownloadManager imports this module
+    from DownloadManager import DownloadManager
+
+    resourceManager = ResourceManager(
+        max_connections=config["max_connections"],
+        max_torrent_connections=config["max_connections"],
+        max_memory=config["max_memory"],
+    )
+    peerEngine = PeerEngine(resourceManager.executor)
+    peerEngine.start()
+
+    # The limits in force when the worker started apply to it alone
+    rateLimiter = RateLimiter()
+    limits = config["limits"]
+    for direction, rate in limits["global"].items():
+        rateLimiter.set_global_limit(direction, rate)
+    for direction, rate in limits["peer"].items():
+        rateLimiter.set_peer_limit(direction, rate)
+    for direction, rate in limits["torrent"].get(torrent.infohash, {}).items():
+        rateLimiter.set_torrent_limit(torrent.infohash, direction, rate)
+
+    # The coordinator owns the listening socket and hands connections over
+    uploadManager = UploadManager(
+        config["id"],
+        config["ip"],
+        config["port"],
+        config["torrent_dir"],
+        config["dest_dir"],
+        peerEngine,
+        config["extensions"],
+        rateLimiter,
+        resourceManager,
+    )
+    downloadManager = DownloadManager(
+        config["id"],
+        config["torrent_dir"],
+        config["dest_dir"],
+        uploadManager,
+        config["tracker"],
+        peerEngine,
+        config["extensions"],
+        rateLimiter,
+        resourceManager,
+    )
+    downloadManager.CONTIGUOUS_RUNS = config["contiguous_runs"]
+    threading.Thread(
+        target=_receive_commands,
+        args=(connection, downloadManager, uploadManager),
+        daemon=True,
+    ).start()
+
+    downloadManager.new_download(torrent, peer_list, file_priorities=file_priorities)
+    future = downloadManager.active_downloads[torrent.infohash]["download_future"]
+    while not concurrent.futures.wait(
+        [future], timeout=TorrentWorker.STATUS_INTERVAL
+    ).done:
+        status = downloadManager.snapshot()
+        connection.send(
+            (
+                "status",
+                status[0] if status else None,
+                downloadManager.get_banned_peers(),
+            )
+        )
+    # A finished download is removed, a failed one stays
+    succeeded = (
+        future.exception() is None
+        and torrent.infohash not in downloadManager.active_downloads
+    )
+    connection.send(("finished", succeeded))
+    peerEngine.stop()
+
+
+def _receive_commands(connection, downloadManager, uploadManager: UploadManager):
+    while True:
+        try:
+            command, *args = connection.recv()
+        except (EOFError, OSError):
+            # The coordinator is gone
+            command = "stop"
+        if command == "connection":
+            fd = recv_handle(connection)
+            uploadManager.serve_socket(socket.socket(fileno=fd), *args)
+        elif command == "stop":
+            downloadManager.stop()
+            # Nothing is left to do once the resume state is saved
+            os._exit(0)
@@ -23,6 +23,11 @@ class TrackerCommunicator:
         params = self._prepare_announce_request("started", torrent_file)
         return self._send_announce_request(params)
 
+    def download_reannounce(self, torrent_file: Torrent, left: int):
+        """Announce a running download again, returns the tracker's current peers."""
+        params = self._prepare_announce_request("", torrent_file, left=left)
+        return self._send_announce_request(params)
+
     def upload_announce(self, torrent_file: Torrent):
         params = self._prepare_announce_request("completed", torrent_file)
         self.announced_torrents.add(torrent_file.infohash)
@@ -79,12 +84,14 @@ class TrackerCommunicator:
         event: str = "",
         torrent_file=None,
         infohash: str = "",
+        left: int | None = None,
     ):
         """Base for preparing an announce request to the tracker
         Args:
             event (str): The event type of the announce request
             torrent_file (Torrent): The torrent file object
             infohash (str): The infohash of the torrent
+            left (int): Bytes still to download, if known
         Returns:
             params (dict): The parameters for the announce request
         """
@@ -93,12 +100,13 @@ class TrackerCommunicator:
         else:
             infohash = infohash
 
-        if event == "completed":
-            left = 0
-        elif event == "started":
-            left = torrent_file.size
-        else:  # TODO: Fix this, left should be the bytes left to download
-            left = 0
+        if left is None:
+            if event == "completed":
+                left = 0
+            elif event == "started":
+                left = torrent_file.size
+            else:  # TODO: Fix this, left should be the bytes left to download
+                left = 0
         params = {
             "info_hash": infohash,
             "peer_id": self.id,
@@ -1,12 +1,24 @@
+import asyncio
 import socket
+import struct
 import threading
-from threading import Thread
+from typing import Callable
 
 from Torrent import Torrent
 
+from Compression import CompressionStats
 from FileManager import FileManager
-from PeerCommunicator import PeerCommunicator
+from PeerCommunicator import (
+    EXTENDED,
+    MAX_PEX_PEERS,
+    PeerCommunicator,
+    SUPPORTED_EXTENSIONS,
+    allowed_fast_set,
+)
+from PeerEngine import PeerEngine
 from PieceManager import PieceManager
+from RateLimiter import RateLimiter
+from ResourceManager import ResourceManager
 
 
 class UploadManager:
@@ -17,59 +29,158 @@ class UploadManager:
         port: int,
         torrent_dir: str,
         original_dir: str,
+        peerEngine: PeerEngine,
+        extensions=SUPPORTED_EXTENSIONS,
+        rateLimiter: RateLimiter | None = None,
+        resourceManager: ResourceManager | None = None,
     ):
         self.torrent_dir = torrent_dir
         self.original_dir = original_dir
         self.id = id
         self.ip = ip
         self.port = port
+        self.peerEngine = peerEngine
+        self.extensions = extensions
+        self.rateLimiter = rateLimiter or RateLimiter()
+        self.resourceManager = resourceManager or ResourceManager()
 
         self.active_uploads: dict[str, dict] = {}
+        # Infohash -> callback taking (socket fd, handshake) for the torrents
+        # downloading in a worker process, see set_handoff
+        self.handoffs: dict[str, Callable[[int, bytes], None]] = {}
         self.lock = threading.Lock()
         self.stopping_event = threading.Event()
+        self.server: asyncio.Server | None = None
+
+        # Upload slots; only touched from the peer engine's event loop
+        self.MAXIMUM_UNCHOKED_PEERS = 8
+        self.NUM_ALLOWED_FAST = 10
+        self.unchoked_peers: set[PeerCommunicator] = set()
+        self.choked_peers: list[PeerCommunicator] = []
+        # Seconds between ut_pex updates to a peer, BEP 11 asks for at least 60
+        self.PEX_INTERVAL = 60
 
     def stop(self):
         """Stop the upload manager."""
         self.stopping_event.set()
+        if self.server is not None:
+            self.peerEngine.call_soon(self.server.close)
 
     def run_server(self):
-        """Act as a server, listening for connections from peers."""
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.bind((self.ip, self.port))
+        """Act as a server, listening for connections from peers.
 
-        server_socket.listen(50)
+        The listening socket and every accepted connection are served by the
+        peer engine's event loop; this call returns once the server is bound.
+        """
+        self.peerEngine.submit(self._start_server()).result()
 
-        while not self.stopping_event.is_set():
-            try:
-                client_socket, addr = server_socket.accept()
-                print(f"{addr} is connecting")
-                Thread(
-                    target=self._upload_piece_thread,
-                    args=(client_socket,),
-                ).start()
-            except KeyboardInterrupt:
-                break
-
-        server_socket.close()
-
-    def new_upload(self, torrent: Torrent):
+    async def _start_server(self):
+        self.server = await asyncio.start_server(
+            self._upload_piece_session, self.ip, self.port, backlog=50
+        )
+
+    def new_upload(self, torrent: Torrent, pieceManager: PieceManager | None = None):
+        """Start seeding the torrent.
+
+        A download in progress passes its PieceManager: peers are then sent
+        the pieces verified so far and learn of the others by HAVE as they
+        arrive. Without one the files are hashed once, when the first peer
+        connects, see _hash_files. Seeding a torrent again only swaps its
+        PieceManager.
+        """
         with self.lock:
             infohash = torrent.infohash
+            if infohash in self.active_uploads:
+                self.active_uploads[infohash]["piece_manager"] = pieceManager
+                self.active_uploads[infohash]["hashing"] = None
+                return
             self.active_uploads[infohash] = {
                 "torrent": torrent,
                 "upload_rate": 0,
                 "uploaded_total": 0,
                 "num_connected_peers": 0,
+                "compression": CompressionStats(),
+                # Listen addresses of swarm members, shared through ut_pex
+                "swarm": set(),
+                # Peers being served, with the bitfield they were sent
+                "peers": {},
+                # The download's PieceManager while it is partial, or the
+                # one of the files on disk once they are hashed
+                "piece_manager": pieceManager,
+                # Future of the hashing of the files on disk, see _hash_files
+                "hashing": None,
             }
 
-    def _upload_piece_thread(
+    def set_handoff(
+        self, infohash: str, handoff: Callable[[int, bytes], None] | None = None
+    ):
+        """Pass the torrent's incoming connections to handoff, or stop if None.
+
+        handoff is called in a thread with the connection's socket file
+        descriptor and the handshake read from it, and raises OSError if the
+        connection cannot be passed on.
+        """
+        with self.lock:
+            if handoff is None:
+                self.handoffs.pop(infohash, None)
+            else:
+                self.handoffs[infohash] = handoff
+
+    def serve_socket(self, sock: socket.socket, handshake: bytes):
+        """Serve a connection another process accepted and read the handshake of."""
+        self.peerEngine.submit(self._serve_socket(sock, handshake))
+
+    async def _serve_socket(self, sock: socket.socket, handshake: bytes):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        await self._upload_piece_session(reader, writer, handshake)
+
+    def broadcast_have(self, infohash: str, piece_idx: int):
+        """Tell every peer served this torrent that we now have a piece.
+
+        Safe to call from any thread, the messages are sent by the peer engine.
+        """
+        self.peerEngine.submit(self._broadcast_have(infohash, piece_idx))
+
+    async def _broadcast_have(self, infohash: str, piece_idx: int):
+        with self.lock:
+            if infohash not in self.active_uploads:
+                return
+            peers = list(self.active_uploads[infohash]["peers"].items())
+        for peer_communicator, bitfield in peers:
+            if bitfield[piece_idx]:
+                continue
+            bitfield[piece_idx] = 1
+            try:
+                await peer_communicator.send_have(piece_idx)
+            except (ConnectionError, OSError) as e:
+                print(f"[INFO-UploadManager-_broadcast_have] {e}")
+
+    async def _upload_piece_session(
         self,
-        client_socket: socket.socket,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        handshake: bytes | None = None,
     ):
-        peer_communicator = PeerCommunicator(client_socket)
+        # print(f"{writer.get_extra_info('peername')} is connecting")
+        peer_communicator = PeerCommunicator(reader, writer, extensions=self.extensions)
+        try:
+            await self._serve_peer(peer_communicator, handshake)
+        except (ConnectionError, TimeoutError, OSError) as e:
+            print(f"[INFO-UploadManager-_upload_piece_session] {e}")
+        except asyncio.CancelledError:
+            # The peer engine is shutting down
+            pass
+        finally:
+            writer.close()
 
-        # Receive handshake from the peer
-        handshake = peer_communicator.receive_handshake()
+    async def _serve_peer(
+        self, peer_communicator: PeerCommunicator, handshake: bytes | None = None
+    ):
+        # Receive handshake from the peer, unless another process already did
+        if handshake is None:
+            handshake = await peer_communicator.receive_handshake()
+        else:
+            peer_communicator.note_extensions(handshake)
         # print("received handshake")
         infohash = handshake[28:48].hex()
         peer_id = handshake[48:].decode("utf-8")
@@ -77,52 +188,405 @@ class UploadManager:
         # Validate handshake
         val = peer_communicator.validate_handshake(handshake, infohash, peer_id)
         if not val:
-            print("[INFO-UploadManager-_upload_piece_thread] Handshake failed")
-            client_socket.close()
+            print("[INFO-UploadManager-_serve_peer] Handshake failed")
+            return None
+
+        with self.lock:
+            handoff = self.handoffs.get(infohash)
+        if handoff is not None:
+            # The peer waits for our handshake before it sends anything else,
+            # so nothing past its handshake has been read from the socket
+            peer_communicator.writer.transport.pause_reading()
+            fd = peer_communicator.writer.get_extra_info("socket").fileno()
+            try:
+                # Off the loop, a busy worker must not hold up other peers
+                await asyncio.to_thread(handoff, fd, handshake)
+            except OSError as e:
+                # The worker is gone, the connection is closed with the session
+                print(f"[INFO-UploadManager-_serve_peer] Handoff failed: {e}")
             return None
 
         # Check if local torrent folder has the requested infohash
-        torrent_exist = FileManager.check_local_torrent(infohash, self.torrent_dir)
+        torrent_exist = await asyncio.to_thread(
+            FileManager.check_local_torrent, infohash, self.torrent_dir
+        )
         if not torrent_exist:
-            print("[INFO-UploadManager-_upload_piece_thread] Torrent does not exist")
-            client_socket.close()
+            print("[INFO-UploadManager-_serve_peer] Torrent does not exist")
             return None
 
         with self.lock:
             try:
                 torrent = self.active_uploads[infohash]["torrent"]
+                compression = self.active_uploads[infohash]["compression"]
+                pieceManager = self.active_uploads[infohash]["piece_manager"]
             except KeyError:
                 print(
-                    "[INFO-UploadManager-_upload_piece_thread] Peer is not ready to seed this torrent"
+                    "[INFO-UploadManager-_serve_peer] Peer is not ready to seed this torrent"
                 )
-                client_socket.close()
                 return None
-        pieceManager = PieceManager(torrent, self.original_dir)
+        if not self.resourceManager.try_acquire_connection(infohash):
+            print("[INFO-UploadManager-_serve_peer] Connection limit reached")
+            return None
+        try:
+            await self._serve_torrent(
+                peer_communicator, infohash, torrent, compression, pieceManager
+            )
+        finally:
+            self.resourceManager.release_connection(infohash)
+
+    async def _serve_torrent(
+        self,
+        peer_communicator: PeerCommunicator,
+        infohash: str,
+        torrent: Torrent,
+        compression: CompressionStats,
+        pieceManager: PieceManager | None,
+    ):
+        peer_communicator.limiter = self.rateLimiter.session(infohash)
 
         # Communicate with the peer
-        peer_communicator.send_handshake(self.id, infohash)
+        await peer_communicator.send_handshake(self.id, infohash)
         # print("sent handshake")
-        peer_communicator.send_unchoke()
-        # print("sent unchoke")
-        peer_communicator.receive_interested()
-        # print("received interested")
-        peer_communicator.send_bitfield(pieceManager.generate_bitfield())
-        # print("sent bitfield")
+        if pieceManager is None:
+            pieceManager = await self._hash_files(infohash, torrent)
+        # The pieces verified so far, the others follow as HAVE
+        with pieceManager.lock:
+            bitfield = bytearray(pieceManager.bitfield)
+        allowed_fast = set()
+        pex_sent: set[tuple[str, int]] = set()
+        pex_task = None
+        try:
+            if peer_communicator.supports("fast"):
+                allowed_fast = await self._start_fast_session(
+                    peer_communicator, pieceManager, infohash, bitfield
+                )
+            else:
+                self.unchoked_peers.add(peer_communicator)
+                await peer_communicator.send_unchoke()
+                # print("sent unchoke")
+                await peer_communicator.receive_interested()
+                # print("received interested")
+                await peer_communicator.send_bitfield(bitfield)
+                # print("sent bitfield")
+            with self.lock:
+                self.active_uploads[infohash]["peers"][peer_communicator] = bitfield
+            # Pieces verified while the bitfield was on its way
+            with pieceManager.lock:
+                verified = [
+                    piece_idx
+                    for piece_idx, bit in enumerate(pieceManager.bitfield)
+                    if bit and not bitfield[piece_idx]
+                ]
+            for piece_idx in verified:
+                if not bitfield[piece_idx]:
+                    bitfield[piece_idx] = 1
+                    await peer_communicator.send_have(piece_idx)
 
-        while True:
-            piece_idx = peer_communicator.receive_request()
-            # print(f"received request for piece {piece_idx}")
-            if piece_idx is None:
-                # print("received choke")
-                break
-            piece_data = pieceManager.get_piece_data(piece_idx)
-            peer_communicator.send_piece(piece_idx, piece_data)
-            # print(f"sent piece {piece_idx}")
-            # Update the total uploaded size
+            if peer_communicator.supports("extended"):
+                await peer_communicator.send_extended_handshake(self.port)
+                pex_task = asyncio.create_task(
+                    self._exchange_peers(peer_communicator, infohash, pex_sent)
+                )
+
+            await self._serve_requests(
+                peer_communicator,
+                pieceManager,
+                compression,
+                infohash,
+                bitfield,
+                allowed_fast,
+                pex_sent,
+            )
+        finally:
+            if pex_task is not None:
+                pex_task.cancel()
             with self.lock:
-                self.active_uploads[infohash]["uploaded_total"] += len(piece_data)
+                if infohash in self.active_uploads:
+                    self.active_uploads[infohash]["peers"].pop(peer_communicator, None)
+            self._leave_swarm(peer_communicator, infohash)
+            await self._release_slot(peer_communicator)
 
-        client_socket.close()
+    async def _hash_files(self, infohash: str, torrent: Torrent):
+        """PieceManager of a torrent seeded from disk, its intact pieces marked.
+
+        The files are hashed once per registration, when the first peer
+        connects; peers connecting meanwhile wait for the same hashing. The
+        PieceManager is then kept in the registration.
+        """
+        with self.lock:
+            upload = self.active_uploads[infohash]
+            hashing = upload["hashing"]
+            if hashing is None:
+                hashing = upload["hashing"] = asyncio.ensure_future(
+                    self._hash_pieces(torrent)
+                )
+        # A peer that leaves does not cancel the hashing for the others
+        pieceManager = await asyncio.shield(hashing)
+        with self.lock:
+            if upload["hashing"] is hashing:
+                upload["piece_manager"] = pieceManager
+        return pieceManager
+
+    async def _hash_pieces(self, torrent: Torrent):
+        pieceManager = PieceManager(torrent, self.original_dir)
+        # The piece being hashed is held in memory
+        await self.resourceManager.reserve_memory(torrent.piece_size)
+        try:
+            bitfield = await asyncio.to_thread(pieceManager.generate_bitfield)
+        finally:
+            self.resourceManager.release_memory(torrent.piece_size)
+        for piece_idx, bit in enumerate(bitfield):
+            if bit:
+                pieceManager.mark_downloaded(piece_idx)
+        return pieceManager
+
+    async def _start_fast_session(
+        self,
+        peer_communicator: PeerCommunicator,
+        pieceManager: PieceManager,
+        infohash: str,
+        bitfield: bytearray,
+    ):
+        """Start a session with a peer that negotiated the Fast Extension (BEP 6).
+
+        The bitfield goes out right after the handshake, as have_all or
+        have_none when possible. Peers beyond the upload slots stay choked but
+        may fetch the pieces of their allowed-fast set, which is returned.
+        """
+        if all(bitfield):
+            await peer_communicator.send_have_all()
+        elif not any(bitfield):
+            await peer_communicator.send_have_none()
+        else:
+            await peer_communicator.send_bitfield(bitfield)
+
+        allowed_fast = set()
+        if len(self.unchoked_peers) < self.MAXIMUM_UNCHOKED_PEERS:
+            self.unchoked_peers.add(peer_communicator)
+            await peer_communicator.send_unchoke()
+            return allowed_fast
+
+        self.choked_peers.append(peer_communicator)
+        peer_ip = peer_communicator.writer.get_extra_info("peername")[0]
+        for piece_idx in allowed_fast_set(
+            peer_ip, infohash, pieceManager.num_pieces, self.NUM_ALLOWED_FAST
+        ):
+            if bitfield[piece_idx]:
+                allowed_fast.add(piece_idx)
+                await peer_communicator.send_allowed_fast(piece_idx)
+        return allowed_fast
+
+    async def _serve_requests(
+        self,
+        peer_communicator: PeerCommunicator,
+        pieceManager: PieceManager,
+        compression: CompressionStats,
+        infohash: str,
+        bitfield: bytearray,
+        allowed_fast: set,
+        pex_sent: set,
+    ):
+        """Answer the peer's requests until it chokes us.
+
+        Messages are read by a separate task so that a cancel is seen while a
+        piece is being sent. Every request gets one answer: the piece, or for
+        a cancelled request an empty last block (a reject with the Fast
+        Extension). With the Fast Extension every request that will not be
+        served (choked and not allowed-fast, a missing piece) is rejected.
+        """
+        fast = peer_communicator.supports("fast")
+        requests: asyncio.Queue = asyncio.Queue()
+        # Requests that are queued or being sent, only those can be cancelled
+        outstanding: set[int] = set()
+        reader = asyncio.create_task(
+            self._read_requests(
+                peer_communicator, infohash, pex_sent, requests, outstanding
+            )
+        )
+        try:
+            while True:
+                piece_idx = await requests.get()
+                if piece_idx is None:
+                    # print("received choke")
+                    break
+                if isinstance(piece_idx, Exception):
+                    raise piece_idx
+                try:
+                    # print(f"received request for piece {piece_idx}")
+                    if piece_idx in peer_communicator.cancelled_requests:
+                        peer_communicator.cancelled_requests.discard(piece_idx)
+                        await peer_communicator.send_cancelled_piece(piece_idx)
+                        continue
+                    if fast and (
+                        piece_idx >= pieceManager.num_pieces
+                        or not bitfield[piece_idx]
+                        or (
+                            peer_communicator in self.choked_peers
+                            and piece_idx not in allowed_fast
+                        )
+                    ):
+                        await peer_communicator.send_reject_request(piece_idx)
+                        continue
+                    if piece_idx >= pieceManager.num_pieces or not bitfield[piece_idx]:
+                        # A piece we do not have, answered like a cancel
+                        await peer_communicator.send_cancelled_piece(piece_idx)
+                        continue
+                    # The piece is only read once it fits in the memory budget
+                    length = pieceManager.get_piece_length(piece_idx)
+                    await self.resourceManager.reserve_memory(length)
+                    try:
+                        piece_data = await asyncio.to_thread(
+                            pieceManager.get_piece_data, piece_idx
+                        )
+                        sent = await self._send_piece(
+                            peer_communicator, compression, piece_idx, piece_data
+                        )
+                    finally:
+                        self.resourceManager.release_memory(length)
+                finally:
+                    outstanding.discard(piece_idx)
+                    peer_communicator.cancelled_requests.discard(piece_idx)
+                # print(f"sent piece {piece_idx}")
+                # Update the total uploaded size
+                if sent:
+                    with self.lock:
+                        self.active_uploads[infohash]["uploaded_total"] += len(
+                            piece_data
+                        )
+        finally:
+            reader.cancel()
+
+    async def _read_requests(
+        self,
+        peer_communicator: PeerCommunicator,
+        infohash: str,
+        pex_sent: set,
+        requests: asyncio.Queue,
+        outstanding: set,
+    ):
+        """Queue the peer's requests and note its cancels until it chokes us."""
+        try:
+            while True:
+                message_id, payload = await peer_communicator.receive_message()
+                if message_id == 0:
+                    break
+                if message_id == EXTENDED:
+                    await self._handle_extended(
+                        peer_communicator, infohash, payload, pex_sent
+                    )
+                elif message_id == 6:
+                    piece_idx = struct.unpack(">I", payload)[0]
+                    outstanding.add(piece_idx)
+                    requests.put_nowait(piece_idx)
+                elif message_id == 8:
+                    piece_idx = struct.unpack(">I", payload)[0]
+                    # A cancel that crossed the last block of its piece is moot
+                    if piece_idx in outstanding:
+                        peer_communicator.cancelled_requests.add(piece_idx)
+        except (ConnectionError, TimeoutError, OSError) as e:
+            requests.put_nowait(e)
+            return
+        requests.put_nowait(None)
+
+    async def _release_slot(self, peer_communicator: PeerCommunicator):
+        """Give the peer's upload slot to the longest waiting choked peer."""
+        if peer_communicator in self.choked_peers:
+            self.choked_peers.remove(peer_communicator)
+            return
+        self.unchoked_peers.discard(peer_communicator)
+        while (
+            self.choked_peers and len(self.unchoked_peers) < self.MAXIMUM_UNCHOKED_PEERS
+        ):
+            waiting = self.choked_peers.pop(0)
+            try:
+                await waiting.send_unchoke()
+                self.unchoked_peers.add(waiting)
+            except (ConnectionError, OSError):
+                pass
+
+    async def _handle_extended(
+        self,
+        peer_communicator: PeerCommunicator,
+        infohash: str,
+        payload: bytes,
+        pex_sent: set,
+    ):
+        """Grow the torrent's swarm from the peer's extended messages."""
+        name = peer_communicator.handle_extended(payload)
+        with self.lock:
+            swarm = self.active_uploads[infohash]["swarm"]
+            if name == "ut_pex":
+                swarm.update(peer_communicator.pex_peers)
+                peer_communicator.pex_peers.clear()
+        if name == "handshake":
+            await self._send_swarm(peer_communicator, infohash, pex_sent)
+            address = self._swarm_address(peer_communicator)
+            if address is not None:
+                with self.lock:
+                    swarm.add(address)
+
+    async def _exchange_peers(
+        self, peer_communicator: PeerCommunicator, infohash: str, pex_sent: set
+    ):
+        """Periodically tell the peer about swarm members it has not heard of."""
+        while True:
+            await asyncio.sleep(self.PEX_INTERVAL)
+            if peer_communicator.peer_extended_ids is None:
+                continue
+            try:
+                await self._send_swarm(peer_communicator, infohash, pex_sent)
+            except (ConnectionError, OSError):
+                return
+
+    async def _send_swarm(
+        self, peer_communicator: PeerCommunicator, infohash: str, pex_sent: set
+    ):
+        own_address = self._swarm_address(peer_communicator)
+        with self.lock:
+            swarm = self.active_uploads[infohash]["swarm"]
+            added = [
+                address
+                for address in swarm
+                if address not in pex_sent and address != own_address
+            ][:MAX_PEX_PEERS]
+        if added:
+            await peer_communicator.send_pex(added)
+            pex_sent.update(added)
+
+    def _leave_swarm(self, peer_communicator: PeerCommunicator, infohash: str):
+        address = self._swarm_address(peer_communicator)
+        if address is None:
+            return
+        with self.lock:
+            if infohash in self.active_uploads:
+                self.active_uploads[infohash]["swarm"].discard(address)
+
+    @staticmethod
+    def _swarm_address(peer_communicator: PeerCommunicator):
+        """The address other peers can reach this peer at, if it told us its port."""
+        if peer_communicator.peer_listen_port is None:
+            return None
+        peer_ip = peer_communicator.writer.get_extra_info("peername")[0]
+        return (peer_ip, peer_communicator.peer_listen_port)
+
+    async def _send_piece(
+        self,
+        peer_communicator: PeerCommunicator,
+        compression: CompressionStats,
+        piece_idx: int,
+        piece_data: bytes,
+    ):
+        """Send a piece, compressed if the peer supports it and it pays off.
+
+        Returns False if the peer cancelled the request while it was sent.
+        """
+        if peer_communicator.supports("compression") and compression.should_compress():
+            compressed = await asyncio.to_thread(compression.compress, piece_data)
+            if compressed is not None:
+                return await peer_communicator.send_compressed_piece(
+                    piece_idx, len(piece_data), compressed
+                )
+        return await peer_communicator.send_piece(piece_idx, piece_data)
 
     def get_total_uploaded(self):
         total_uploaded = 0
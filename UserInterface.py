@@ -7,6 +7,8 @@ from Torrent import Torrent
 
 from DownloadManager import DownloadManager
 from FileManager import FileManager
+from PieceScheduler import PRIORITY_NAMES
+from StreamServer import StreamServer
 from TrackerCommunicator import TrackerCommunicator
 from UploadManager import UploadManager
 
@@ -21,6 +23,7 @@ class UserInterface:
         downloadManager: DownloadManager,
         uploadManager: UploadManager,
         trackerCommunicator: TrackerCommunicator,
+        streamServer: StreamServer | None = None,
     ):
         self.ip = ip
         self.port = port
@@ -29,6 +32,7 @@ class UserInterface:
         self.downloadManager = downloadManager
         self.uploadManager = uploadManager
         self.trackerCommunicator = trackerCommunicator
+        self.streamServer = streamServer
 
     def run(self):
         while True:
@@ -48,9 +52,15 @@ class UserInterface:
             #     self._clear()
             #     self.show_uploading()
             elif option == "4":
+                self._clear()
+                self.set_bandwidth_limits()
+            elif option == "5":
+                self._clear()
+                self.show_streams()
+            elif option == "6":
                 self.exit()
             else:
-                print("Invalid option, only input 1->4")
+                print("Invalid option, only input 1->6")
                 sleep(1)
 
     def menu(self):
@@ -60,7 +70,9 @@ class UserInterface:
         print("[1] Download a Torrent")
         print("[2] Upload a Torrent")
         print("[3] View downloading files")
-        print("[4] Exit")
+        print("[4] Set bandwidth limits")
+        print("[5] Stream downloading files")
+        print("[6] Exit")
         print("--------------------------------------------")
         option = input("Choose an option: ")
 
@@ -91,11 +103,17 @@ class UserInterface:
             input("Enter to return...")
             return
 
+        # Choose the files to download in a multi-file torrent
+        file_priorities = None
+        if len(torrent.files) > 1:
+            file_priorities = self._input_file_priorities(torrent)
+
         # Start the download process
         print("Download started for infohash: ", torrent.infohash)
         self.downloadManager.new_download(
             torrent,
             peer_list,
+            file_priorities=file_priorities,
         )
 
         # print("--------------------------------------------")
@@ -132,27 +150,50 @@ class UserInterface:
         input("Enter to return...")
 
     def show_downloading(self):
-        last_it_progresses = [0] * len(self.downloadManager.get_downloaded())
-        last_it_totals = [0] * len(self.downloadManager.get_total())
+        # Downloaded bytes of each torrent at the previous refresh
+        last_progresses = {
+            status.infohash: status.downloaded
+            for status in self.downloadManager.snapshot()
+        }
 
         while True:
             self._clear()
-            download_info = self._get_download_info(last_it_progresses, last_it_totals)
+            download_info = self._get_download_info(last_progresses)
 
             print(
                 "----------------------------------------------------------------------------------------"
             )
             print(f"Currently downloading: {len(download_info)}")
+            memory = self.downloadManager.get_memory_usage()
+            print(
+                f"Piece memory: {self._format_size(memory['used'])} / {self._format_size(memory['limit'])}"
+                f" (peak {self._format_size(memory['peak'])}, {memory['waiting']} waiting)"
+            )
             print(
                 "----------------------------------------------------------------------------------------"
             )
             print(
                 f"{'File Name':<20}{'Progress':<30}{'Speed':<15}{'Peers':<10}{'Connected':<10}"
             )
+            print(
+                f"  {'Peer ID':<22}{'Speed':<15}{'Latency':<10}{'Pieces':<8}{'Fails':<6}{'Hash':<6}"
+            )
             for info in download_info:
                 print(
                     f"{info['file_name']:<20}{info['progress']:<30}{info['rate']:<15}{info['peers']:<10}{info['connected_peers']:<10}"
                 )
+                for peer in info["peer_stats"]:
+                    print(
+                        f"  {peer['peer_id']:<22}{peer['rate']:<15}{peer['latency']:<10}{peer['pieces']:<8}{peer['failures']:<6}{peer['hash_failures']:<6}"
+                    )
+
+            banned = self.downloadManager.get_banned_peers()
+            if banned:
+                print(f"Banned peers: {len(banned)}")
+                for ban in banned:
+                    print(
+                        f"  {ban.ip + ':' + str(ban.port):<22}{ban.hash_failures} bad pieces, {ban.expires_in / 60:.0f} min left"
+                    )
 
             print(
                 "----------------------------------------------------------------------------------------"
@@ -164,6 +205,21 @@ class UserInterface:
             if self._input_quit():
                 break
 
+    def show_streams(self):
+        """List the URLs to play the downloading files from while they download."""
+        print("--------------------------------------------")
+        if self.streamServer is None:
+            print("Streaming is disabled.")
+        else:
+            for torrent in self.downloadManager.get_torrents():
+                for file_index, (path, size) in enumerate(torrent.files):
+                    print(f"{str(path):<40}{self._format_size(size):<12}")
+                    print(
+                        f"    {self.streamServer.get_url(torrent.infohash, file_index)}"
+                    )
+        print("--------------------------------------------")
+        input("Enter to return...")
+
     def show_uploading(self):
         uploading = self.uploadManager.get_num_uploading()
 
@@ -175,6 +231,62 @@ class UserInterface:
         print("--------------------------------------------")
         input("Enter to return...")
 
+    def set_bandwidth_limits(self):
+        rateLimiter = self.downloadManager.rateLimiter
+        limits = rateLimiter.get_limits()
+
+        print("--------------------------------------------")
+        print("Current bandwidth limits:")
+        print(
+            f"Global:   up {self._format_limit(limits['global']['upload'])}, "
+            f"down {self._format_limit(limits['global']['download'])}"
+        )
+        print(
+            f"Per peer: up {self._format_limit(limits['peer']['upload'])}, "
+            f"down {self._format_limit(limits['peer']['download'])}"
+        )
+        for infohash, torrent_limits in limits["torrent"].items():
+            print(
+                f"{infohash[:8]}: up {self._format_limit(torrent_limits['upload'])}, "
+                f"down {self._format_limit(torrent_limits['download'])}"
+            )
+        print("--------------------------------------------")
+        print("[1] Global limit")
+        print("[2] Per-torrent limit")
+        print("[3] Per-peer limit")
+        print("--------------------------------------------")
+        option = input("Choose a limit to change or 'q' to return: ")
+        if option not in ("1", "2", "3"):
+            return
+
+        infohash = None
+        if option == "2":
+            torrent = self._input_torrent()
+            if torrent is None:
+                return
+            infohash = torrent.infohash
+
+        direction = input("Direction (upload/download): ").strip().lower()
+        if direction not in ("upload", "download"):
+            print("Invalid direction.")
+            input("Enter to return...")
+            return
+        try:
+            rate = int(float(input("Limit in KB/s (0 = unlimited): ")) * 1_000)
+        except ValueError:
+            print("Invalid limit.")
+            input("Enter to return...")
+            return
+
+        if option == "1":
+            rateLimiter.set_global_limit(direction, rate)
+        elif option == "2":
+            rateLimiter.set_torrent_limit(infohash, direction, rate)
+        else:
+            rateLimiter.set_peer_limit(direction, rate)
+        print(f"{direction.capitalize()} limit set to {self._format_limit(rate)}")
+        input("Enter to return...")
+
     def _input_file(self):
         """Get user input the path to a file and return the file path.
 
@@ -205,6 +317,29 @@ class UserInterface:
                 input("Enter to continue...")
                 self._clear()
 
+    def _input_file_priorities(self, torrent: Torrent):
+        """Ask for the priority of every file of the torrent.
+
+        Returns:
+            file_priorities: One priority per file, or None for all normal.
+        """
+        print("File priorities: skip, low, normal, high (Enter for normal)")
+        print("--------------------------------------------")
+        file_priorities = []
+        for i, (path, size) in enumerate(torrent.files):
+            while True:
+                name = input(f"[{i}] {path} ({self._format_size(size)}): ")
+                name = name.strip().lower() or "normal"
+                if name in PRIORITY_NAMES:
+                    break
+                print("Invalid priority, use skip, low, normal or high.")
+            file_priorities.append(PRIORITY_NAMES[name])
+        print("--------------------------------------------")
+        if all(priority == PRIORITY_NAMES["skip"] for priority in file_priorities):
+            print("Every file is skipped, downloading all of them.")
+            return None
+        return file_priorities
+
     def _input_torrent(self):
         """Get user input the path to a torrent file and return the Torrent object.
 
@@ -241,34 +376,52 @@ class UserInterface:
                 self._clear()
                 continue
 
-    def _get_download_info(self, last_it_progresses, last_it_totals):
-        # Get the current state of downloads
-        file_names = self.downloadManager.get_file_names()
-        progresses = self.downloadManager.get_downloaded()
-        totals = self.downloadManager.get_total()
-        num_peers = self.downloadManager.get_num_peers()
-        num_connected_peers = self.downloadManager.get_num_connected_peers()
+    def _get_download_info(self, last_progresses):
+        # Get the current state of downloads, all from one snapshot
+        snapshot = self.downloadManager.snapshot()
 
-        # Calculate download rates and format them appropriately
-        download_rates = []
-        for i, progress in enumerate(progresses):
-            rate = (progress - last_it_progresses[i]) * 2
-            download_rates.append(self._format_rate(rate))
+        info = []
+        for status in snapshot:
+            # Calculate the download rate and format it appropriately
+            if status.queued:
+                rate = "queued"
+            else:
+                progress = status.downloaded - last_progresses.get(status.infohash, 0)
+                rate = self._format_rate(progress * 2)
+            info.append(
+                {
+                    "file_name": status.name,
+                    "progress": f"{self._format_size(status.downloaded)} / {self._format_size(status.total)}",
+                    "rate": rate,
+                    "peers": status.num_peers,
+                    "connected_peers": status.num_connected_peers,
+                    "peer_stats": [
+                        {
+                            "peer_id": peer.peer_id,
+                            "rate": (
+                                self._format_rate(peer.download_rate)
+                                if peer.download_rate is not None
+                                else "-"
+                            ),
+                            "latency": (
+                                f"{peer.latency * 1000:.0f} ms"
+                                if peer.latency is not None
+                                else "-"
+                            ),
+                            "pieces": peer.pieces,
+                            "failures": peer.failures,
+                            "hash_failures": peer.hash_failures,
+                        }
+                        for peer in status.peers
+                    ],
+                }
+            )
 
         # Update the last iteration's values
-        last_it_progresses[:] = progresses[:]
-        last_it_totals[:] = totals[:]
-
-        info = [
-            {
-                "file_name": file_names[i],
-                "progress": f"{self._format_size(progress)} / {self._format_size(total)}",
-                "rate": download_rates[i],
-                "peers": num_peers[i],
-                "connected_peers": num_connected_peers[i],
-            }
-            for i, (progress, total) in enumerate(zip(progresses, totals))
-        ]
+        last_progresses.clear()
+        last_progresses.update(
+            (status.infohash, status.downloaded) for status in snapshot
+        )
 
         return info
 
@@ -288,6 +441,9 @@ class UserInterface:
         else:
             return f"{rate} B/s"
 
+    def _format_limit(self, rate):
+        return self._format_rate(rate) if rate else "unlimited"
+
     def _input_quit(self):
         if sys.platform == "win32":
             import msvcrt
@@ -312,6 +468,9 @@ class UserInterface:
 
     def exit(self):
         print("Exiting...")
+        self.downloadManager.stop()
         self.uploadManager.stop()
+        if self.streamServer is not None:
+            self.streamServer.stop()
         self.trackerCommunicator.stopping_announce()
         exit()
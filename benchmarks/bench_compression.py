@@ -0,0 +1,161 @@
+"""Benchmark: on-the-wire piece compression over bandwidth-limited links.
+
+Serves a compressible (log-like text) and an incompressible (random) payload
+from an UploadManager with and without the 'compression' extension, through a
+localhost proxy that caps the seeder -> leecher bandwidth. The leecher fetches
+every piece in one session and verifies each one against the torrent hashes.
+
+Usage:
+    python benchmarks/bench_compression.py --size 8000000
+"""
+
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PeerCommunicator import PeerCommunicator, SUPPORTED_EXTENSIONS  # noqa: E402
+from PeerEngine import PeerEngine  # noqa: E402
+from Torrent import Torrent  # noqa: E402
+from UploadManager import UploadManager  # noqa: E402
+
+
+def make_payload(kind, size):
+    if kind == "random":
+        return os.urandom(size)
+    rng = random.Random(0)
+    levels = ["INFO", "DEBUG", "WARN", "ERROR"]
+    lines = []
+    total = 0
+    while total < size:
+        line = (
+            f"2024-05-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:"
+            f"{rng.randint(0, 59):02d}:{rng.randint(0, 59):02d} "
+            f"{rng.choice(levels)} worker-{rng.randint(1, 16)} "
+            f"request id={rng.getrandbits(32):08x} latency={rng.random():.4f}s\n"
+        )
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode()[:size]
+
+
+async def relay(reader, writer, bandwidth):
+    """Copy reader to writer, sleeping so the rate stays under bandwidth bytes/s."""
+    try:
+        start = time.perf_counter()
+        sent = 0
+        while data := await reader.read(16 * 1024):
+            writer.write(data)
+            await writer.drain()
+            sent += len(data)
+            if bandwidth:
+                delay = sent / bandwidth - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def fetch_all(proxy_port, seed_port, bandwidth, torrent):
+    relays = []
+
+    async def handle(client_reader, client_writer):
+        relays.append(asyncio.current_task())
+        seed_reader, seed_writer = await asyncio.open_connection("127.0.0.1", seed_port)
+        await asyncio.gather(
+            relay(client_reader, seed_writer, None),
+            relay(seed_reader, client_writer, bandwidth),
+        )
+
+    proxy = await asyncio.start_server(handle, "127.0.0.1", proxy_port)
+    reader, writer = await asyncio.open_connection("127.0.0.1", proxy_port)
+    peer_communicator = PeerCommunicator(reader, writer)
+    start = time.perf_counter()
+    await peer_communicator.send_handshake("-BM0001-000000000001", torrent.infohash)
+    await peer_communicator.receive_handshake()
+    await peer_communicator.receive_session_start(torrent.pieces)
+    for piece_idx, expected_hash in enumerate(torrent.hashes):
+        await peer_communicator.send_request(piece_idx)
+        _, piece_data = await peer_communicator.receive_piece()
+        assert hashlib.sha1(piece_data).digest() == expected_hash
+    elapsed = time.perf_counter() - start
+    await peer_communicator.send_choke()
+    await peer_communicator.close()
+    await asyncio.gather(*relays)
+    proxy.close()
+    return elapsed
+
+
+def run(kind, compression, bandwidth, args, port):
+    with tempfile.TemporaryDirectory() as tmp:
+        seed_dir = os.path.join(tmp, "seed") + "/"
+        torrent_dir = os.path.join(tmp, "torrents") + "/"
+        os.makedirs(seed_dir)
+        with open(os.path.join(seed_dir, "payload"), "wb") as f:
+            f.write(make_payload(kind, args.size))
+        torrent = Torrent.read(
+            Torrent.generate_torrent(
+                os.path.join(seed_dir, "payload"), torrent_dir, args.piece_size
+            )
+        )
+
+        peerEngine = PeerEngine()
+        peerEngine.start()
+        uploadManager = UploadManager(
+            "-BM0001-000000000000",
+            "127.0.0.1",
+            port,
+            torrent_dir,
+            seed_dir,
+            peerEngine,
+            extensions=SUPPORTED_EXTENSIONS if compression else frozenset(),
+        )
+        uploadManager.run_server()
+        uploadManager.new_upload(torrent)
+        elapsed = asyncio.run(fetch_all(port + 1, port, bandwidth, torrent))
+        ratio = uploadManager.active_uploads[torrent.infohash]["compression"].ratio
+        uploadManager.stop()
+        peerEngine.stop()
+    return elapsed, ratio
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Piece compression benchmark")
+    parser.add_argument("--size", type=int, default=8_000_000)
+    parser.add_argument("--piece-size", type=int, default=256 * 1024)
+    parser.add_argument("--port", type=int, default=16981)
+    args = parser.parse_args()
+
+    bandwidths = [1_000_000, 10_000_000, 100_000_000, None]
+    rows = []
+    port = args.port
+    for kind in ("text", "random"):
+        for bandwidth in bandwidths:
+            raw, _ = run(kind, False, bandwidth, args, port)
+            compressed, ratio = run(kind, True, bandwidth, args, port + 2)
+            port += 4
+            rows.append((kind, bandwidth, raw, compressed, ratio))
+
+    print(
+        f"{'payload':<8}{'link':<12}{'raw MB/s':>10}{'zlib MB/s':>11}"
+        f"{'speedup':>9}{'ratio':>8}"
+    )
+    for kind, bandwidth, raw, compressed, ratio in rows:
+        link = f"{bandwidth / 1_000_000:g} MB/s" if bandwidth else "unlimited"
+        print(
+            f"{kind:<8}{link:<12}{args.size / raw / 1_000_000:>10.2f}"
+            f"{args.size / compressed / 1_000_000:>11.2f}"
+            f"{raw / compressed:>8.2f}x{ratio:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""Benchmark: endgame mode against a swarm with one slow peer.
+
+Serves the same torrent from a fast seed and from a seed whose upload rate is
+capped, then downloads it with DownloadManager once with endgame disabled and
+once with the default threshold. Without endgame the last pieces wait for the
+slow seed; with it idle workers duplicate them on the fast seed. The tail is
+the time from 90% to 100% of the payload.
+
+Usage:
+    python benchmarks/bench_endgame.py --size 8000000 --slow-rate 200000
+"""
+
+import argparse
+import filecmp
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DownloadManager import DownloadManager  # noqa: E402
+from PeerEngine import PeerEngine  # noqa: E402
+from RateLimiter import RateLimiter  # noqa: E402
+from Torrent import Torrent  # noqa: E402
+from UploadManager import UploadManager  # noqa: E402
+
+
+class NoTracker:
+    announce_interval = 0
+
+    def download_reannounce(self, torrent, left):
+        return []
+
+    def upload_announce(self, torrent):
+        pass
+
+
+def start_seed(peer_id, port, torrent_dir, seed_dir, torrent, peerEngine, rate):
+    rateLimiter = RateLimiter()
+    if rate:
+        rateLimiter.set_global_limit("upload", rate)
+    uploadManager = UploadManager(
+        peer_id,
+        "127.0.0.1",
+        port,
+        torrent_dir,
+        seed_dir,
+        peerEngine,
+        rateLimiter=rateLimiter,
+    )
+    uploadManager.run_server()
+    uploadManager.new_upload(torrent)
+    return uploadManager
+
+
+def run_download(args, tmp, torrent, torrent_dir, peers, peerEngine, threshold, run):
+    dest_dir = os.path.join(tmp, f"dl{run}") + "/"
+    os.makedirs(dest_dir)
+    uploadManager = UploadManager(
+        f"-BM0001-{900 + run:012d}",
+        "127.0.0.1",
+        args.port + 10 + run,
+        torrent_dir,
+        dest_dir,
+        peerEngine,
+    )
+    downloadManager = DownloadManager(
+        f"-BM0001-{900 + run:012d}",
+        torrent_dir,
+        dest_dir,
+        uploadManager,
+        NoTracker(),
+        peerEngine,
+    )
+    downloadManager.ENDGAME_THRESHOLD = threshold
+
+    marks = {}
+
+    def sample_progress():
+        while "done" not in marks:
+            downloaded = sum(downloadManager.get_downloaded())
+            if downloaded >= 0.9 * torrent.size and "90" not in marks:
+                marks["90"] = time.perf_counter()
+            time.sleep(0.005)
+
+    start = time.perf_counter()
+    downloadManager.new_download(torrent, peers)
+    sampler = threading.Thread(target=sample_progress)
+    sampler.start()
+    downloadManager.active_downloads[torrent.infohash]["download_future"].result()
+    marks["done"] = time.perf_counter()
+    sampler.join()
+
+    ok = filecmp.cmp(
+        os.path.join(tmp, "seed", "payload.bin"),
+        os.path.join(dest_dir, "payload.bin"),
+        shallow=False,
+    )
+    uploadManager.stop()
+    total = marks["done"] - start
+    tail = marks["done"] - marks.get("90", marks["done"])
+    return total, tail, ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Endgame tail-latency benchmark")
+    parser.add_argument("--size", type=int, default=8_000_000)
+    parser.add_argument("--piece-size", type=int, default=256 * 1024)
+    parser.add_argument("--slow-rate", type=int, default=200_000)
+    parser.add_argument("--threshold", type=int, default=8)
+    parser.add_argument("--port", type=int, default=16981)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        seed_dir = os.path.join(tmp, "seed") + "/"
+        slow_dir = os.path.join(tmp, "slow") + "/"
+        torrent_dir = os.path.join(tmp, "torrents") + "/"
+        os.makedirs(seed_dir)
+        with open(os.path.join(seed_dir, "payload.bin"), "wb") as f:
+            f.write(os.urandom(args.size))
+        shutil.copytree(seed_dir, slow_dir)
+        torrent = Torrent.read(
+            Torrent.generate_torrent(
+                os.path.join(seed_dir, "payload.bin"), torrent_dir, args.piece_size
+            )
+        )
+
+        peerEngine = PeerEngine()
+        peerEngine.start()
+        seeds = [
+            start_seed(
+                "-BM0001-000000000001",
+                args.port,
+                torrent_dir,
+                seed_dir,
+                torrent,
+                peerEngine,
+                None,
+            ),
+            start_seed(
+                "-BM0001-000000000002",
+                args.port + 1,
+                torrent_dir,
+                slow_dir,
+                torrent,
+                peerEngine,
+                args.slow_rate,
+            ),
+        ]
+        peers = [
+            {"peer_id": seed.id, "ip": "127.0.0.1", "port": seed.port} for seed in seeds
+        ]
+
+        results = []
+        for run, threshold in enumerate([0, args.threshold]):
+            results.append(
+                (
+                    threshold,
+                    *run_download(
+                        args,
+                        tmp,
+                        torrent,
+                        torrent_dir,
+                        peers,
+                        peerEngine,
+                        threshold,
+                        run,
+                    ),
+                )
+            )
+
+        for seed in seeds:
+            seed.stop()
+        peerEngine.stop()
+
+    print(f"payload:   {args.size / 1_000_000:.1f} MB in {torrent.pieces} pieces")
+    print(f"slow seed: {args.slow_rate / 1000:.0f} KB/s")
+    print(f"{'threshold':>10} {'total (s)':>10} {'tail (s)':>10} {'ok':>4}")
+    for threshold, total, tail, ok in results:
+        print(f"{threshold:>10} {total:>10.2f} {tail:>10.2f} {str(ok):>4}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""Benchmark: hedged requests against a seed that stalls now and then.
+
+Serves the same torrent from two seeds with capped upload rates, one of which
+holds back a share of the pieces it is asked for for a while before sending
+them, then downloads it with DownloadManager once without hedging and once
+with HEDGE_PERCENTILE. The piece latency is the time from the scheduler
+handing a piece out to its completion. The upload column is what the seeds
+sent, as a multiple of the payload, i.e. the bandwidth cost of hedging.
+
+Usage:
+    python benchmarks/bench_hedge.py --size 16000000 --stall 0.5 --stall-share 0.05
+"""
+
+import argparse
+import asyncio
+import filecmp
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DownloadManager import DownloadManager  # noqa: E402
+from PeerEngine import PeerEngine  # noqa: E402
+from PieceScheduler import PieceScheduler  # noqa: E402
+from RateLimiter import RateLimiter  # noqa: E402
+from Torrent import Torrent  # noqa: E402
+from UploadManager import UploadManager  # noqa: E402
+
+
+class NoTracker:
+    announce_interval = 0
+
+    def download_reannounce(self, torrent, left):
+        return []
+
+    def upload_announce(self, torrent):
+        pass
+
+
+def start_seed(peer_id, port, torrent_dir, seed_dir, torrent, peerEngine, rate):
+    rateLimiter = RateLimiter()
+    rateLimiter.set_global_limit("upload", rate)
+    uploadManager = UploadManager(
+        peer_id,
+        "127.0.0.1",
+        port,
+        torrent_dir,
+        seed_dir,
+        peerEngine,
+        rateLimiter=rateLimiter,
+    )
+    uploadManager.run_server()
+    uploadManager.new_upload(torrent)
+    return uploadManager
+
+
+def add_stalls(uploadManager, share, seconds, seed):
+    """Hold back a share of the pieces the seed sends for seconds each."""
+    send_piece = uploadManager._send_piece
+    rng = random.Random(seed)
+
+    async def stalling_send_piece(peer_communicator, compression, piece_idx, data):
+        if rng.random() < share:
+            await asyncio.sleep(seconds)
+        return await send_piece(peer_communicator, compression, piece_idx, data)
+
+    uploadManager._send_piece = stalling_send_piece
+
+
+def record_latencies(latencies, hedges):
+    """Wrap the scheduler to record piece latencies and count hedged pieces.
+
+    Returns the original attributes, to be put back afterwards.
+    """
+    originals = {
+        name: PieceScheduler.__dict__[name] for name in ("complete", "hedge_piece")
+    }
+
+    def complete(self, piece_idx, holder=None):
+        taken_at = self.taken_at.get(piece_idx)
+        if taken_at is not None and piece_idx not in self.completed:
+            latencies.append(time.monotonic() - taken_at)
+        return originals["complete"](self, piece_idx, holder)
+
+    def hedge_piece(self, *args, **kwargs):
+        piece_idx = originals["hedge_piece"](self, *args, **kwargs)
+        if piece_idx is not None:
+            hedges.append(piece_idx)
+        return piece_idx
+
+    PieceScheduler.complete = complete
+    PieceScheduler.hedge_piece = hedge_piece
+    return originals
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(int(share * len(values)), len(values) - 1)]
+
+
+def run_download(args, tmp, torrent, torrent_dir, peers, peerEngine, hedge, run):
+    dest_dir = os.path.join(tmp, f"dl{run}") + "/"
+    os.makedirs(dest_dir)
+    uploadManager = UploadManager(
+        f"-BM0001-{900 + run:012d}",
+        "127.0.0.1",
+        args.port + 10 + run,
+        torrent_dir,
+        dest_dir,
+        peerEngine,
+    )
+    downloadManager = DownloadManager(
+        f"-BM0001-{900 + run:012d}",
+        torrent_dir,
+        dest_dir,
+        uploadManager,
+        NoTracker(),
+        peerEngine,
+    )
+    downloadManager.HEDGE_PERCENTILE = args.percentile if hedge else None
+
+    latencies = []
+    hedges = []
+    originals = record_latencies(latencies, hedges)
+    try:
+        start = time.perf_counter()
+        downloadManager.new_download(torrent, peers)
+        downloadManager.active_downloads[torrent.infohash]["download_future"].result()
+        elapsed = time.perf_counter() - start
+    finally:
+        for name, original in originals.items():
+            setattr(PieceScheduler, name, original)
+
+    ok = filecmp.cmp(
+        os.path.join(tmp, "seed", "payload.bin"),
+        os.path.join(dest_dir, "payload.bin"),
+        shallow=False,
+    )
+    uploadManager.stop()
+    return elapsed, latencies, len(hedges), ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hedged request benchmark")
+    parser.add_argument("--size", type=int, default=16_000_000)
+    parser.add_argument("--piece-size", type=int, default=64 * 1024)
+    parser.add_argument("--rate", type=int, default=4_000_000)
+    parser.add_argument("--stall", type=float, default=0.5)
+    parser.add_argument("--stall-share", type=float, default=0.05)
+    parser.add_argument("--percentile", type=float, default=0.95)
+    parser.add_argument("--port", type=int, default=16995)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        seed_dir = os.path.join(tmp, "seed") + "/"
+        stall_dir = os.path.join(tmp, "stall") + "/"
+        torrent_dir = os.path.join(tmp, "torrents") + "/"
+        os.makedirs(seed_dir)
+        with open(os.path.join(seed_dir, "payload.bin"), "wb") as f:
+            f.write(os.urandom(args.size))
+        shutil.copytree(seed_dir, stall_dir)
+        torrent = Torrent.read(
+            Torrent.generate_torrent(
+                os.path.join(seed_dir, "payload.bin"), torrent_dir, args.piece_size
+            )
+        )
+
+        peerEngine = PeerEngine()
+        peerEngine.start()
+        seeds = [
+            start_seed(
+                f"-BM0001-{i + 1:012d}",
+                args.port + i,
+                torrent_dir,
+                seed_dir if i == 0 else stall_dir,
+                torrent,
+                peerEngine,
+                args.rate,
+            )
+            for i in range(2)
+        ]
+        peers = [
+            {"peer_id": seed.id, "ip": "127.0.0.1", "port": seed.port} for seed in seeds
+        ]
+
+        results = []
+        for run, hedge in enumerate((False, True)):
+            # Both runs see the same stalls in the same order
+            add_stalls(seeds[1], args.stall_share, args.stall, seed=1)
+            uploaded_before = sum(seed.get_total_uploaded() for seed in seeds)
+            elapsed, latencies, hedged, ok = run_download(
+                args, tmp, torrent, torrent_dir, peers, peerEngine, hedge, run
+            )
+            uploaded = sum(seed.get_total_uploaded() for seed in seeds)
+            results.append(
+                (
+                    hedge,
+                    elapsed,
+                    percentile(latencies, 0.5),
+                    percentile(latencies, 0.99),
+                    max(latencies),
+                    hedged,
+                    (uploaded - uploaded_before) / args.size,
+                    ok,
+                )
+            )
+            # Back to the class's _send_piece
+            del seeds[1]._send_piece
+
+        for seed in seeds:
+            seed.stop()
+        peerEngine.stop()
+
+    print(f"payload: {args.size / 1_000_000:.1f} MB in {torrent.pieces} pieces")
+    print(
+        f"stalls:  {args.stall_share:.0%} of one seed's pieces held for {args.stall}s"
+    )
+    print(
+        f"{'hedge':>6} {'total s':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+        f" {'hedged':>7} {'upload':>7} {'ok':>4}"
+    )
+    for hedge, elapsed, p50, p99, longest, hedged, upload, ok in results:
+        print(
+            f"{'on' if hedge else 'off':>6} {elapsed:>8.2f} {p50 * 1000:>8.1f}"
+            f" {p99 * 1000:>8.1f} {longest * 1000:>8.1f} {hedged:>7}"
+            f" {upload:>6.2f}x {str(ok):>4}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Benchmark: many concurrent peer sessions served by one PeerEngine.
+
+Starts a seeding UploadManager on localhost and opens --connections download
+sessions against it at the same time. Every session performs the full
+handshake -> unchoke -> interested -> bitfield exchange, requests every piece
+of a small torrent and closes with a choke, exactly like DownloadManager.
+
+Usage:
+    python benchmarks/bench_peer_engine.py --connections 500
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PeerCommunicator import PeerCommunicator  # noqa: E402
+from PeerEngine import PeerEngine  # noqa: E402
+from ResourceManager import ResourceManager  # noqa: E402
+from Torrent import Torrent  # noqa: E402
+from UploadManager import UploadManager  # noqa: E402
+
+
+async def run_session(index, port, torrent, stats):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    # Without the Fast Extension every session is unchoked, whatever the slots
+    peer_communicator = PeerCommunicator(reader, writer, extensions={"compression"})
+    try:
+        await peer_communicator.send_handshake(
+            f"-BM0001-{index:012d}", torrent.infohash
+        )
+        await peer_communicator.receive_handshake()
+        await peer_communicator.receive_session_start(torrent.pieces)
+        for piece_idx in range(torrent.pieces):
+            await peer_communicator.send_request(piece_idx)
+            _, piece_data = await peer_communicator.receive_piece()
+            stats["bytes"] += len(piece_data)
+        await peer_communicator.send_choke()
+        stats["sessions"] += 1
+    finally:
+        await peer_communicator.close()
+
+
+async def run_clients(connections, port, torrent, stats, peak_threads):
+    async def sample_threads():
+        while True:
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            await asyncio.sleep(0.05)
+
+    sampler = asyncio.create_task(sample_threads())
+    results = await asyncio.gather(
+        *(run_session(i, port, torrent, stats) for i in range(connections)),
+        return_exceptions=True,
+    )
+    sampler.cancel()
+    return [r for r in results if isinstance(r, Exception)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PeerEngine concurrency benchmark")
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--size", type=int, default=256 * 1024)
+    parser.add_argument("--piece-size", type=int, default=32 * 1024)
+    parser.add_argument("--port", type=int, default=16881)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        seed_dir = os.path.join(tmp, "seed") + "/"
+        torrent_dir = os.path.join(tmp, "torrents") + "/"
+        os.makedirs(seed_dir)
+        with open(os.path.join(seed_dir, "payload.bin"), "wb") as f:
+            f.write(os.urandom(args.size))
+        torrent = Torrent.read(
+            Torrent.generate_torrent(
+                os.path.join(seed_dir, "payload.bin"), torrent_dir, args.piece_size
+            )
+        )
+
+        peerEngine = PeerEngine()
+        peerEngine.start()
+        uploadManager = UploadManager(
+            "-BM0001-000000000000",
+            "127.0.0.1",
+            args.port,
+            torrent_dir,
+            seed_dir,
+            peerEngine,
+            # Every benchmark session is admitted, whatever the node's defaults
+            resourceManager=ResourceManager(
+                max_connections=args.connections,
+                max_torrent_connections=args.connections,
+            ),
+        )
+        uploadManager.run_server()
+        uploadManager.new_upload(torrent)
+
+        stats = {"sessions": 0, "bytes": 0}
+        peak_threads = [threading.active_count()]
+        start = time.perf_counter()
+        errors = asyncio.run(
+            run_clients(args.connections, args.port, torrent, stats, peak_threads)
+        )
+        elapsed = time.perf_counter() - start
+
+        uploadManager.stop()
+        peerEngine.stop()
+
+    print(f"connections:        {args.connections}")
+    print(f"completed sessions: {stats['sessions']}")
+    print(f"failed sessions:    {len(errors)}")
+    print(f"elapsed:            {elapsed:.2f} s")
+    print(f"sessions/s:         {stats['sessions'] / elapsed:.1f}")
+    print(f"throughput:         {stats['bytes'] / elapsed / 1_000_000:.2f} MB/s")
+    print(f"peak threads:       {peak_threads[0]}")
+    if errors:
+        print(f"first error:        {errors[0]!r}")
+
+
+if __name__ == "__main__":
+    main()
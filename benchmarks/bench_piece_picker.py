@@ -0,0 +1,76 @@
+"""Benchmark: PieceScheduler availability updates and rarest-first picks.
+
+Builds a scheduler for --pieces pieces, connects --peers peers whose
+bitfields each hold a random --density share of the pieces, then times HAVE
+updates, picks (each immediately completed, as a fast download would) and
+disconnects.
+
+Usage:
+    python benchmarks/bench_piece_picker.py --pieces 100000 --peers 300
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PieceScheduler import PieceScheduler  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Piece picker benchmark")
+    parser.add_argument("--pieces", type=int, default=100_000)
+    parser.add_argument("--peers", type=int, default=300)
+    parser.add_argument("--density", type=float, default=0.5)
+    parser.add_argument("--haves", type=int, default=100_000)
+    parser.add_argument("--picks", type=int, default=50_000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    bitfields = [
+        bytearray(rng.random() < args.density for _ in range(args.pieces))
+        for _ in range(args.peers)
+    ]
+    scheduler = PieceScheduler(args.pieces)
+
+    start = time.perf_counter()
+    for bitfield in bitfields:
+        scheduler.add_peer(bitfield)
+    connect_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.haves):
+        bitfield = rng.choice(bitfields)
+        piece_idx = rng.randrange(args.pieces)
+        if not bitfield[piece_idx]:
+            bitfield[piece_idx] = 1
+            scheduler.add_have(piece_idx)
+    have_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    picked = 0
+    for i in range(args.picks):
+        piece_idx = scheduler.next_piece(bitfields[i % args.peers], holder=i)
+        if piece_idx is None:
+            break
+        scheduler.complete(piece_idx, i)
+        picked += 1
+    pick_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for bitfield in bitfields:
+        scheduler.remove_peer(bitfield)
+    disconnect_time = time.perf_counter() - start
+
+    print(f"pieces x peers:  {args.pieces} x {args.peers}")
+    print(f"connect:         {connect_time / args.peers * 1000:.2f} ms/peer")
+    print(f"have:            {have_time / args.haves * 1e6:.2f} us/update")
+    print(f"pick + complete: {pick_time / max(picked, 1) * 1e6:.2f} us/piece")
+    print(f"disconnect:      {disconnect_time / args.peers * 1000:.2f} ms/peer")
+
+
+if __name__ == "__main__":
+    main()
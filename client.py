@@ -2,9 +2,13 @@ from DownloadManager import DownloadManager
 from UploadManager import UploadManager
 from UserInterface import UserInterface
 from TrackerCommunicator import TrackerCommunicator
+from PeerCommunicator import SUPPORTED_EXTENSIONS
+from PeerEngine import PeerEngine
+from RateLimiter import RateLimiter
+from ResourceManager import ResourceManager
+from StreamServer import StreamServer
 import utils
 import argparse
-from threading import Thread
 
 
 def main(host: str, port: int):
@@ -16,15 +20,52 @@ def main(host: str, port: int):
         port,
     )
 
+    # Connection, download and worker thread limits shared by every torrent
+    resourceManager = ResourceManager()
+
+    # Start the event loop shared by every peer session
+    peerEngine = PeerEngine(resourceManager.executor)
+    peerEngine.start()
+
+    # Bandwidth limits shared by uploads and downloads
+    rateLimiter = RateLimiter()
+
     # Initialize the upload manager
-    uploadManager = UploadManager(id, host, port, torrent_dir, dest_dir)
-    server_thread = Thread(target=uploadManager.run_server, daemon=True)
-    server_thread.start()
+    uploadManager = UploadManager(
+        id,
+        host,
+        port,
+        torrent_dir,
+        dest_dir,
+        peerEngine,
+        extensions,
+        rateLimiter,
+        resourceManager,
+    )
+    uploadManager.run_server()
 
     # Initialize the download manager
     downloadManager = DownloadManager(
-        id, torrent_dir, dest_dir, uploadManager, trackerCommunicator
+        id,
+        torrent_dir,
+        dest_dir,
+        uploadManager,
+        trackerCommunicator,
+        peerEngine,
+        extensions,
+        rateLimiter,
+        resourceManager,
+        worker_processes,
     )
+    downloadManager.CONTIGUOUS_RUNS = contiguous_runs
+    # Pick up the downloads an earlier run did not finish
+    downloadManager.resume_downloads()
+
+    # Serve the downloading files over HTTP on localhost while they download
+    streamServer = None
+    if stream_port:
+        streamServer = StreamServer(downloadManager, stream_port)
+        streamServer.start()
 
     ui = UserInterface(
         host,
@@ -34,6 +75,7 @@ def main(host: str, port: int):
         downloadManager,
         uploadManager,
         trackerCommunicator,
+        streamServer,
     )
     ui.run()
 
@@ -48,6 +90,27 @@ if __name__ == "__main__":
     parser.add_argument("--torrent_dir", type=str, required=False)
     parser.add_argument("--dest-dir", type=str, required=False)
     parser.add_argument("--port", type=int, required=False)
+    parser.add_argument(
+        "--no-compression",
+        action="store_true",
+        help="do not offer on-the-wire piece compression to peers",
+    )
+    parser.add_argument(
+        "--stream-port",
+        type=int,
+        default=8080,
+        help="localhost port to stream downloading files from, 0 to disable",
+    )
+    parser.add_argument(
+        "--worker-processes",
+        action="store_true",
+        help="run each download in a process of its own to use several cores",
+    )
+    parser.add_argument(
+        "--contiguous-runs",
+        action="store_true",
+        help="download runs of consecutive pieces from each peer for sequential disk I/O",
+    )
     args = parser.parse_args()
 
     id = utils.get_id()
@@ -64,5 +127,11 @@ if __name__ == "__main__":
         dest_dir = args.torrent_dir
     if args.port:
         port = args.port
+    stream_port = args.stream_port
+    worker_processes = args.worker_processes
+    contiguous_runs = args.contiguous_runs
+    extensions = set(SUPPORTED_EXTENSIONS)
+    if args.no_compression:
+        extensions.discard("compression")
 
     main(host, port)